@@ -1,10 +1,127 @@
+import argparse
+import sys
+from pathlib import Path
+
 from .custom_classes import *
 from .installer_functions import *
 from .narchs_logos import *
 from .full_installation import *
+from .cache_server import CACHE_SERVER_PORT, serve_cache
+from .fleet import FleetError, create_loop_targets, detach_loop_targets, parse_targets, run_fleet
+from .golden_image import capture_image, deploy_image
+from .package_cache import open_package_cache
+from .package_prefetch import PACMAN_CACHE_DIR
+from .unattended import ConfigError, load_install_config
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(prog='sendune-installer', description='SENDUNE Arch Linux installer')
+    parser.add_argument('--serve-cache', action='store_true',
+                        help='run a LAN package cache for other machines instead of installing')
+    parser.add_argument('--port', type=int, default=CACHE_SERVER_PORT, help='cache server port')
+    parser.add_argument('--bind', default='0.0.0.0', help='cache server listen address')
+    parser.add_argument('--upstream', action='append',
+                        help='upstream mirror URL ($repo/$arch templates or file://); default: the mirrorlist')
+    parser.add_argument('--cache-dir', type=Path, help='directory the cache server stores packages in')
+    parser.add_argument('--cache-server', metavar='URL',
+                        help='install through the LAN package cache running at URL')
+    parser.add_argument('--config', type=Path, metavar='FILE',
+                        help='install unattended from an archinstall-style JSON config (see schema.json)')
+    parser.add_argument('--fleet', action='append', metavar='DEVICE[:MOUNT]',
+                        help='wipe DEVICE and install onto it; repeat to install several disks in parallel (needs --config)')
+    parser.add_argument('--fleet-loop', type=int, metavar='N',
+                        help='install onto N loop devices backed by sparse files, for testing fleet mode')
+    parser.add_argument('--fleet-parallel', type=int, metavar='N', help='install at most N targets at a time')
+    parser.add_argument('--capture-image', type=Path, metavar='DIR',
+                        help='capture the installed disk given by --source as a golden image into DIR')
+    parser.add_argument('--source', metavar='DEVICE', help='installed (unmounted) disk to capture')
+    parser.add_argument('--deploy-image', type=Path, metavar='DIR',
+                        help='write the golden image in DIR to the --fleet/--fleet-loop disks instead of installing')
+    parser.add_argument('--hostname', metavar='TEMPLATE',
+                        help='hostname of deployed disks; {hostname}, {index} and {name} are filled in '
+                             '(default {hostname}-{index})')
+    parser.add_argument('--log-format', choices=LOG_FORMATS, default=TEXT,
+                        help='write the installer log as plain text or as JSON lines with stage ids')
+    parser.add_argument('--record-transcript', type=Path, metavar='FILE',
+                        help='record every command, chroot command and answer to FILE for offline replay '
+                             '(python3 -m SENDUNE_installer.transcript FILE)')
+    args = parser.parse_args(argv)
+    if args.capture_image and not args.source:
+        parser.error('--capture-image needs --source DEVICE')
+    if args.deploy_image and not (args.fleet or args.fleet_loop):
+        parser.error('--deploy-image needs target disks (--fleet or --fleet-loop)')
+    if (args.fleet or args.fleet_loop) and not (args.config or args.deploy_image):
+        parser.error('fleet installs are unattended; pass --config')
+    return args
+
+
+def run_golden_image(args) -> int:
+    log = LogFile(LOGDIR.with_name('SENDUNE_installer.golden-image.log'), args.log_format)
+    loop_targets = []
+    try:
+        if args.capture_image:
+            manifest = capture_image(args.source, args.capture_image, log)
+            print(f"Captured {args.source} ({manifest['hostname']}, {', '.join(manifest['kernels'])}) "
+                  f"into {args.capture_image}")
+            return 0
+        targets = parse_targets(args.fleet or [])
+        if args.fleet_loop:
+            loop_targets = create_loop_targets(args.fleet_loop, log)
+            targets += loop_targets
+        return 0 if deploy_image(args.deploy_image, targets, log, args.hostname, args.fleet_parallel) else 1
+    except FleetError as e:
+        log.error(str(e))
+        print(f"Golden image failed: {e}")
+        return 1
+    finally:
+        detach_loop_targets(loop_targets, log)
+        log.close()
+
+
+def run_fleet_install(args) -> int:
+    try:
+        config = load_install_config(args.config)
+    except ConfigError as e:
+        print(f"Invalid install config {args.config}:")
+        for error in e.errors:
+            print(f"  {error}")
+        return 2
+    log = LogFile(LOGDIR.with_name('SENDUNE_installer.fleet.log'), args.log_format)
+    loop_targets = []
+    try:
+        targets = parse_targets(args.fleet or [])
+        if args.fleet_loop:
+            loop_targets = create_loop_targets(args.fleet_loop, log)
+            targets += loop_targets
+        ok = run_fleet(targets, config, log, args.fleet_parallel, args.cache_server)
+        return 0 if ok else 1
+    except FleetError as e:
+        log.error(str(e))
+        print(f"Fleet install failed: {e}")
+        return 1
+    finally:
+        detach_loop_targets(loop_targets, log)
+        log.close()
+
 
-def run_as_module():
-    starting_Sendune()
+def run_as_module(argv=None):
+    args = parse_arguments(argv)
+    if args.serve_cache:
+        log = LogFile(LOGDIR.with_name('SENDUNE_installer.cache-server.log'), args.log_format)
+        cache_dir = args.cache_dir
+        if cache_dir is None:
+            package_cache = open_package_cache(log)
+            cache_dir = package_cache.package_dir if package_cache is not None else PACMAN_CACHE_DIR
+        try:
+            serve_cache(log, args.port, args.bind, args.upstream, cache_dir)
+        finally:
+            log.close()
+        return
+    if args.capture_image or args.deploy_image:
+        sys.exit(run_golden_image(args))
+    if args.fleet or args.fleet_loop:
+        sys.exit(run_fleet_install(args))
+    starting_Sendune(args.cache_server, args.config, args.log_format, args.record_transcript)
 
 if __name__ == "__main__":
     run_as_module()
@@ -0,0 +1,452 @@
+import contextlib
+import hashlib
+import json
+import os
+import re
+import shutil
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from .chroot_session import ChrootResult, chroot_session_for, shell_quote
+from .commands import run
+from .custom_classes import LogFile
+from .package_index import PackageIndex, strip_version
+from .package_resolver import resolve_package_name
+from .tracing import BUILD, trace_span
+
+AUR_RPC_URL = 'https://aur.archlinux.org/rpc/v5'
+AUR_GIT_URL = 'https://aur.archlinux.org/{base}.git'
+AUR_CACHE_DIR = Path('/var/cache/SENDUNE_installer/aur')
+AUR_BUILD_USER = 'aurbuilder'
+AUR_BUILD_DIR = '/var/tmp/sendune-aur'
+TARGET_CCACHE_DIR = '/var/cache/sendune-ccache'
+MAKEPKG_DROPIN = 'etc/makepkg.conf.d/sendune-aur.conf'
+AUR_BUILD_WORKERS = max(1, min(4, (os.cpu_count() or 2) // 2))
+RPC_BATCH = 100
+RPC_TIMEOUT = 30
+# Tools every build needs on top of the packages' own (make)depends.
+BUILD_TOOLCHAIN = ['base-devel', 'git', 'ccache']
+# name-pkgver-pkgrel-arch.pkg.tar.ext; pkgver, pkgrel and arch never contain '-'.
+PACKAGE_FILE_RE = re.compile(r'^(?P<name>.+)-[^-]+-[^-]+-[^-]+\.pkg\.tar\.[a-z0-9]+$')
+
+
+@dataclass
+class AurPackage:
+    name: str
+    base: str
+    version: str
+    depends: list = field(default_factory=list)
+    makedepends: list = field(default_factory=list)
+    provides: list = field(default_factory=list)
+    last_modified: int = 0
+
+
+def _rpc(path: str, params: list = ()) -> list:
+    query = f"?{urllib.parse.urlencode(params)}" if params else ''
+    with urllib.request.urlopen(f"{AUR_RPC_URL}/{path}{query}", timeout=RPC_TIMEOUT) as response:
+        payload = json.load(response)
+    if payload.get('type') == 'error':
+        raise RuntimeError(payload.get('error') or 'AUR RPC error')
+    return payload.get('results') or []
+
+
+def _aur_package(result: dict) -> AurPackage:
+    return AurPackage(
+        name=result['Name'],
+        base=result.get('PackageBase') or result['Name'],
+        version=result.get('Version', ''),
+        depends=list(result.get('Depends') or []),
+        makedepends=list(result.get('MakeDepends') or []),
+        provides=list(result.get('Provides') or []),
+        last_modified=int(result.get('LastModified') or 0),
+    )
+
+
+def aur_info(names) -> dict:
+    """Look up `names` in the AUR with as few RPC requests as possible."""
+    names = list(names)
+    found = {}
+    for start in range(0, len(names), RPC_BATCH):
+        batch = names[start:start + RPC_BATCH]
+        for result in _rpc('info', [('arg[]', name) for name in batch]):
+            package = _aur_package(result)
+            found[package.name] = package
+    return found
+
+
+def aur_provider(name: str) -> AurPackage:
+    """Return the AUR package providing `name`, preferring one literally called `name`."""
+    results = _rpc(f"search/{urllib.parse.quote(name)}", [('by', 'provides')])
+    if not results:
+        return None
+    names = [result['Name'] for result in results]
+    chosen = name if name in names else sorted(names)[0]
+    return aur_info([chosen]).get(chosen)
+
+
+@dataclass
+class AurPlan:
+    """What to build from the AUR, in which order, and what the repos must supply."""
+    requested: list = field(default_factory=list)
+    packages: dict = field(default_factory=dict)
+    levels: list = field(default_factory=list)
+    base_dependencies: dict = field(default_factory=dict)
+    repo_dependencies: list = field(default_factory=list)
+    missing: dict = field(default_factory=dict)
+    skipped: list = field(default_factory=list)
+
+    @property
+    def bases(self) -> dict:
+        bases = {}
+        for package in self.packages.values():
+            bases.setdefault(package.base, []).append(package.name)
+        return bases
+
+    def format_lines(self) -> list:
+        lines = []
+        for number, level in enumerate(self.levels, 1):
+            lines.append(f"AUR build level {number}: {', '.join(level)}")
+        if self.repo_dependencies:
+            lines.append(f"Build dependencies from the repos: {len(self.repo_dependencies)} packages")
+        for name, required_by in self.missing.items():
+            where = f" (needed by {required_by})" if required_by else ''
+            lines.append(f"Not found in the repos or the AUR: {name}{where}")
+        if self.skipped:
+            lines.append(f"Cannot be built because of missing dependencies: {', '.join(self.skipped)}")
+        return lines
+
+    def log_to(self, log: LogFile) -> None:
+        log.info(
+            f"AUR plan: {len(self.packages)} packages in {len(self.bases)} builds over "
+            f"{len(self.levels)} levels, {len(self.missing)} missing"
+        )
+        for line in self.format_lines():
+            if line.startswith(('Not found', 'Cannot be built')):
+                log.warn(line)
+            else:
+                log.info(line)
+
+
+def plan_aur_build(names, index: PackageIndex) -> AurPlan:
+    """Classify `names` against the AUR and order the builds by their AUR dependencies.
+
+    Dependencies the sync repos can satisfy become `repo_dependencies`; the rest are looked
+    up in the AUR, by name first and then by provides, one RPC batch per dependency wave.
+    """
+    plan = AurPlan(requested=list(dict.fromkeys(names)))
+    provided = {}
+    repo_dependencies = {}
+    aur_edges = {}
+    wanted = {name: None for name in plan.requested}
+
+    while wanted:
+        found = aur_info(wanted)
+        for name, required_by in wanted.items():
+            package = found.get(name) or aur_provider(name)
+            if package is None:
+                plan.missing[name] = required_by
+                continue
+            provided[name] = package.name
+            if package.name in plan.packages:
+                continue
+            plan.packages[package.name] = package
+            for spec in package.provides:
+                provided.setdefault(strip_version(spec), package.name)
+
+        next_wanted = {}
+        for package in plan.packages.values():
+            if package.name in aur_edges:
+                continue
+            aur_edges[package.name] = set()
+            for spec in package.depends + package.makedepends:
+                dependency = strip_version(spec)
+                resolution = resolve_package_name(dependency, index)
+                if resolution.packages:
+                    for repo_package in resolution.packages:
+                        repo_dependencies.setdefault(repo_package, None)
+                else:
+                    aur_edges[package.name].add(dependency)
+                    if dependency not in provided and dependency not in plan.packages:
+                        next_wanted.setdefault(dependency, package.name)
+        wanted = {name: by for name, by in next_wanted.items() if name not in plan.missing}
+
+    plan.repo_dependencies = list(repo_dependencies)
+
+    # Drop every package that (transitively) depends on something nobody provides.
+    broken = {name for name, edges in aur_edges.items() if any(edge in plan.missing for edge in edges)}
+    changed = True
+    while changed:
+        changed = False
+        for name, edges in aur_edges.items():
+            if name not in broken and any(provided.get(edge, edge) in broken for edge in edges):
+                broken.add(name)
+                changed = True
+    plan.skipped = sorted(broken)
+    for name in broken:
+        plan.packages.pop(name, None)
+
+    # Kahn's algorithm over package bases; each level only depends on earlier levels.
+    bases = plan.bases
+    base_of = {name: package.base for name, package in plan.packages.items()}
+    base_deps = {base: set() for base in bases}
+    for name, package in plan.packages.items():
+        for edge in aur_edges[name]:
+            dependency_base = base_of.get(provided.get(edge, edge))
+            if dependency_base and dependency_base != package.base:
+                base_deps[package.base].add(dependency_base)
+    plan.base_dependencies = base_deps
+    remaining = dict(base_deps)
+    while remaining:
+        level = sorted(base for base, deps in remaining.items() if not deps & remaining.keys())
+        if not level:
+            raise RuntimeError(f"Dependency cycle between AUR packages: {', '.join(sorted(remaining))}")
+        plan.levels.append(level)
+        for base in level:
+            del remaining[base]
+    return plan
+
+
+def package_file_name(filename: str) -> str:
+    match = PACKAGE_FILE_RE.match(filename)
+    return match.group('name') if match else None
+
+
+class AurBuilder():
+    """Build AUR packages inside the target as an unprivileged user and install them in one go.
+
+    Independent package bases are built in parallel, each worker through its own shell of
+    the target's chroot pool so builds do not queue behind each other. Built packages are cached on the host
+    under the AUR version and last-modified time of their package base, so repeating an
+    install of the same profile reuses them without cloning anything; compiler output is
+    shared between builds and installs through a ccache directory. The toolchain, the
+    makedepends and the build user exist only for the build and are removed afterwards.
+    """
+
+    def __init__(self, installer, index: PackageIndex, log: LogFile,
+                 cache_dir: Path = AUR_CACHE_DIR, workers: int = AUR_BUILD_WORKERS) -> None:
+        self.installer = installer
+        self.mount_point = Path(installer.mount_point)
+        self.index = index
+        self.log = log
+        self.cache_dir = Path(cache_dir)
+        self.workers = workers
+        self.built = {}
+        self.reused = []
+        self.failed = {}
+        self._ccache_mounted = False
+        self._build_only = set()
+        self._created_user = False
+
+    def _chroot(self, command: str) -> ChrootResult:
+        return chroot_session_for(self.mount_point, self.log).run(command, echo=False)
+
+    def _run(self, command: str) -> None:
+        result = self._chroot(command)
+        if result.returncode != 0:
+            tail = '\n'.join(result.output.strip().splitlines()[-20:])
+            raise RuntimeError(f"`{command}` failed with exit code {result.returncode}:\n{tail}")
+
+    def _prepare_target(self, plan: AurPlan) -> None:
+        jobs = max(1, (os.cpu_count() or 2) // self.workers)
+        dropin = self.mount_point / MAKEPKG_DROPIN
+        dropin.parent.mkdir(parents=True, exist_ok=True)
+        dropin.write_text(
+            "# Written by the SENDUNE installer for its AUR build stage.\n"
+            f'MAKEFLAGS="-j{jobs}"\n'
+            "BUILDENV=(!distcc color ccache check !sign)\n",
+            encoding='utf-8'
+        )
+
+        ccache_host = self.cache_dir / 'ccache'
+        ccache_target = self.mount_point / TARGET_CCACHE_DIR.lstrip('/')
+        ccache_host.mkdir(parents=True, exist_ok=True)
+        ccache_target.mkdir(parents=True, exist_ok=True)
+        if run(['mount', '--bind', str(ccache_host), str(ccache_target)], self.log).returncode == 0:
+            self._ccache_mounted = True
+        else:
+            self.log.warn("Could not bind the host ccache into the target; using a target-local ccache.")
+
+        before = self._installed_packages()
+        dependencies = ' '.join(shell_quote(name) for name in BUILD_TOOLCHAIN + plan.repo_dependencies)
+        self._run(f"pacman -S --needed --noconfirm --asdeps {dependencies}")
+        self._build_only = self._installed_packages() - before
+        if self._chroot(f"id -u {AUR_BUILD_USER} >/dev/null 2>&1").returncode != 0:
+            self._run(f"useradd -m -s /bin/bash {AUR_BUILD_USER}")
+            self._created_user = True
+        self._run(
+            f"rm -rf {AUR_BUILD_DIR} && install -d -o {AUR_BUILD_USER} -g {AUR_BUILD_USER} {AUR_BUILD_DIR} && "
+            f"chown {AUR_BUILD_USER}:{AUR_BUILD_USER} {TARGET_CCACHE_DIR}"
+        )
+
+    def _installed_packages(self) -> set:
+        result = self._chroot("pacman -Qq")
+        if result.returncode != 0:
+            raise RuntimeError(f"Could not list the packages installed in the target:\n{result.output.strip()}")
+        return set(result.output.split())
+
+    def _remove_build_only(self) -> None:
+        """Remove what `_prepare_target` installed that nothing installed afterwards needs."""
+        if not self._build_only:
+            return
+        orphans = self._chroot("pacman -Qdtq")
+        removable = sorted(self._build_only & set(orphans.output.split())) if orphans.returncode == 0 else []
+        if removable:
+            self._run(f"pacman -Rns --noconfirm {' '.join(shell_quote(name) for name in removable)}")
+            self.log.info(f"AUR: removed {len(removable)} build-only packages from the target")
+        self._build_only = set()
+
+    def _fetch_source(self, base: str) -> Path:
+        """Clone the package base on the host."""
+        source = self.cache_dir / 'src' / base
+        shutil.rmtree(source, ignore_errors=True)
+        source.parent.mkdir(parents=True, exist_ok=True)
+        run(['git', 'clone', '--quiet', '--depth', '1', AUR_GIT_URL.format(base=base), str(source)], self.log, check=True)
+        if not (source / 'PKGBUILD').exists():
+            raise RuntimeError(f"{base} has no PKGBUILD")
+        return source
+
+    def _cache_key(self, plan: AurPlan, base: str) -> str:
+        """Changes whenever the AUR publishes a new commit of the package base, whichever file it touched."""
+        package = plan.packages[plan.bases[base][0]]
+        return hashlib.sha256(f"{base}\0{package.version}\0{package.last_modified}".encode()).hexdigest()
+
+    def _cached_files(self, base: str, digest: str) -> list:
+        directory = self.cache_dir / 'pkg' / base / digest
+        return sorted(directory.glob('*.pkg.tar.*')) if directory.is_dir() else []
+
+    def _build_base(self, base: str, digest: str) -> list:
+        cached = self._cached_files(base, digest)
+        if cached:
+            self.reused.append(base)
+            self.log.info(f"AUR: reusing cached build of {base} ({digest[:12]})")
+            return cached
+
+        source = self._fetch_source(base)
+
+        build_dir = f"{AUR_BUILD_DIR}/{base}"
+        host_build_dir = self.mount_point / build_dir.lstrip('/')
+        shutil.rmtree(host_build_dir, ignore_errors=True)
+        shutil.copytree(source, host_build_dir, ignore=shutil.ignore_patterns('.git'))
+        self._run(f"chown -R {AUR_BUILD_USER}:{AUR_BUILD_USER} {build_dir}")
+        self.log.info(f"AUR: building {base}")
+        with trace_span(base, BUILD):
+            self._run(
+                f"runuser -u {AUR_BUILD_USER} -- env CCACHE_DIR={TARGET_CCACHE_DIR} PKGDEST={build_dir}/out "
+                f"bash -c 'cd {build_dir} && makepkg --noconfirm --nocheck --clean'"
+            )
+
+        # Publish into the cache atomically so an interrupted copy is never mistaken for a build.
+        final = self.cache_dir / 'pkg' / base / digest
+        staging = final.with_name(f"{digest}.sendune-part")
+        shutil.rmtree(staging, ignore_errors=True)
+        staging.mkdir(parents=True)
+        for package_file in (host_build_dir / 'out').glob('*.pkg.tar.*'):
+            if not package_file.name.endswith('.sig'):
+                shutil.copy2(package_file, staging / package_file.name)
+        shutil.rmtree(final, ignore_errors=True)
+        os.replace(staging, final)
+        shutil.rmtree(host_build_dir, ignore_errors=True)
+        return self._cached_files(base, digest)
+
+    def _package_files(self, plan: AurPlan, base: str, files: list) -> list:
+        """Only the split packages the plan asked for; debug packages and siblings are left out."""
+        wanted = set(plan.bases[base])
+        return [path for path in files if package_file_name(path.name) in wanted]
+
+    def _install(self, files: list, as_deps: bool = False) -> None:
+        cache = self.mount_point / 'var' / 'cache' / 'pacman' / 'pkg'
+        cache.mkdir(parents=True, exist_ok=True)
+        for path in files:
+            shutil.copy2(path, cache / path.name)
+        targets = ' '.join(shell_quote(f"/var/cache/pacman/pkg/{path.name}") for path in files)
+        self._run(f"pacman -U --needed --noconfirm {'--asdeps ' if as_deps else ''}{targets}")
+
+    def build(self, plan: AurPlan) -> list:
+        """Build every level of `plan` and install the results; return installed package names."""
+        if not plan.levels:
+            return []
+        self._prepare_target(plan)
+        blocked = set()
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='aur-build') as executor:
+                for number, level in enumerate(plan.levels, 1):
+                    runnable = [base for base in level if base not in blocked]
+                    futures = {
+                        base: executor.submit(self._build_base, base, self._cache_key(plan, base)) for base in runnable
+                    }
+                    level_files = []
+                    for base, future in futures.items():
+                        try:
+                            self.built[base] = self._package_files(plan, base, future.result())
+                            level_files.extend(self.built[base])
+                        except Exception as e:
+                            self.failed[base] = str(e)
+                            self.log.error(f"AUR: building {base} failed: {e}")
+                    blocked.update(self._dependents(plan, set(self.failed)))
+                    if level_files and number < len(plan.levels):
+                        # Later levels need these at build time; the final transaction reinstalls nothing.
+                        self._install(level_files, as_deps=True)
+
+            files = [path for base in self.built for path in self.built[base]]
+            if not files:
+                return []
+            self._install(files)
+            installed = [package_file_name(path.name) for path in files]
+            explicit = ' '.join(shell_quote(name) for name in installed if name in plan.requested)
+            if explicit:
+                # Requested packages may have been pulled in --asdeps for a later level.
+                self._run(f"pacman -D --asexplicit {explicit}")
+            return installed
+        finally:
+            try:
+                self._remove_build_only()
+            finally:
+                self._cleanup()
+
+    def _dependents(self, plan: AurPlan, failed: set) -> set:
+        """Every base that needs one of `failed`, directly or through another base."""
+        dependents = set()
+        changed = True
+        while changed:
+            changed = False
+            for base, dependencies in plan.base_dependencies.items():
+                if base not in dependents and dependencies & (failed | dependents):
+                    dependents.add(base)
+                    changed = True
+        return dependents
+
+    def _cleanup(self) -> None:
+        if self._created_user:
+            if self._chroot(f"userdel -r {AUR_BUILD_USER}").returncode == 0:
+                self._created_user = False
+            else:
+                self.log.warn(f"AUR: could not remove the build user {AUR_BUILD_USER} from the target")
+        shutil.rmtree(self.mount_point / AUR_BUILD_DIR.lstrip('/'), ignore_errors=True)
+        (self.mount_point / MAKEPKG_DROPIN).unlink(missing_ok=True)
+        ccache_target = self.mount_point / TARGET_CCACHE_DIR.lstrip('/')
+        if self._ccache_mounted:
+            run(['umount', str(ccache_target)], self.log)
+            self._ccache_mounted = False
+            with contextlib.suppress(OSError):
+                ccache_target.rmdir()
+        else:
+            shutil.rmtree(ccache_target, ignore_errors=True)
+
+
+def build_aur_packages(installer, names, index: PackageIndex, log: LogFile,
+                       cache_dir: Path = AUR_CACHE_DIR) -> list:
+    """Plan, build and install the AUR packages among `names`; return what was installed."""
+    plan = plan_aur_build(names, index)
+    plan.log_to(log)
+    for line in plan.format_lines():
+        print(f"  {line}")
+    builder = AurBuilder(installer, index, log, cache_dir)
+    installed = builder.build(plan)
+    log.info(
+        f"AUR stage: {len(installed)} packages installed, {len(builder.reused)} builds reused from cache, "
+        f"{len(builder.failed)} failed"
+    )
+    return installed
@@ -0,0 +1,483 @@
+import argparse
+import copy
+import json
+import os
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from collections import Counter
+from pathlib import Path
+
+from .chroot_session import MARKER
+from .commands import RUNNER, run
+from .custom_classes import LogFile
+from .full_installation import full_installation, install_stages
+from .install_journal import InstallJournal
+from .installer_functions import BASE_PACKAGES, DESKTOP_PACKAGES, MOCK_MODE, MockInstaller, User
+from .narchs_logos import ANSWER_LISTENERS, ANSWER_SOURCES, RGB3DLogo
+from .package_index import PackageIndex, PackageMetadata, use_package_index
+from .tracing import CHROOT, STAGE, TRACER
+from .unattended import answer_feed_from_config
+
+BASELINE_PATH = Path(__file__).with_name('benchmark_baseline.json')
+BENCHMARK_RUNS = 3
+# A timing is a regression when it exceeds the baseline by this fraction plus ABSOLUTE_SLACK seconds.
+REGRESSION_TOLERANCE = 0.25
+ABSOLUTE_SLACK = 0.05
+WORKER_TIMEOUT = 600
+STAGES_SHOWN = 12
+
+# Every tool the install can start is one of these; nothing else is on the worker's PATH.
+SHIMMED_TOOLS = (
+    'pacman', 'pacstrap', 'arch-chroot', 'chroot', 'genfstab', 'systemctl', 'git', 'reflector',
+    'timedatectl', 'nmcli', 'lspci', 'chpasswd', 'mount', 'umount',
+)
+# Real shells, linked next to the shims so `sh -c` command lines still work.
+HOST_TOOLS = ('sh', 'bash')
+CALLS_ENV = 'SENDUNE_BENCH_CALLS'
+LATENCY_ENV = 'SENDUNE_BENCH_LATENCY'
+# The feature updater refuses to install unless the installer runs as root.
+ROOT_ONLY_STAGES = ('feature-updater',)
+# Creating accounts goes through archinstall, so the benchmark puts its users on the installer directly.
+BENCHMARK_USERS = ('bench',)
+
+BENCHMARK_CONFIG = {
+    'hostname': 'sendune-bench',
+    'profile': {'main': 'desktop', 'details': 'plasma', 'gfx_driver': 'Intel (open-source)', 'greeter_type': 'sddm'},
+    'audio_config': {'audio': 'pipewire'},
+    'sys-language': 'de_DE.UTF-8',
+    'keyboard-language': 'de',
+    'timezone': 'Europe/Berlin',
+    'services': ['sshd', 'docker'],
+    'packages': ['tmux', 'ripgrep'],
+    '!root-password': 'sendune-bench',
+    'custom_commands': ['systemctl enable fstrim.timer'],
+    'sendune': {
+        'rank_mirrors': False,
+        'security': ['ufw'],
+        'answers': {'interactive_add_users': ['n', '', '', 'n', 'n']},
+    },
+}
+
+SCENARIOS = {
+    # The live ISO after `pacman -Sy`: every package lookup is answered by the index.
+    'synced': {'index': 'synthetic', 'config': BENCHMARK_CONFIG},
+    # No readable sync databases: one `pacman -Si` per selected package.
+    'no-sync-db': {'index': 'empty', 'config': BENCHMARK_CONFIG},
+}
+
+# Installed as every tool in SHIMMED_TOOLS; argv[0] tells it which one it is.
+SHIM_SOURCE = r'''
+import json
+import os
+import sys
+import time
+
+TOOL = os.path.basename(sys.argv[0])
+LATENCIES = json.loads(os.environ.get('SENDUNE_BENCH_LATENCY') or '{}')
+CHROOT_PREFIX = "( eval '"
+CHROOT_SUFFIX = "' ) < /dev/null 2>&1\n"
+
+
+def record(tool, argv, started):
+    entry = {'tool': tool, 'argv': argv, 'cwd': os.getcwd(), 'start': started, 'duration': time.time() - started}
+    fd = os.open(os.environ['SENDUNE_BENCH_CALLS'], os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, (json.dumps(entry) + '\n').encode())
+    finally:
+        os.close(fd)
+
+
+def simulate_latency(key):
+    if LATENCIES.get(key):
+        time.sleep(LATENCIES[key])
+
+
+def pacstrap(args):
+    operands = [arg for previous, arg in zip([''] + args, args)
+                if not arg.startswith('-') and previous not in ('-C', '--cachedir')]
+    root = operands[0]
+    os.makedirs(os.path.join(root, 'etc'), exist_ok=True)
+    os.makedirs(os.path.join(root, 'boot'), exist_ok=True)
+    open(os.path.join(root, 'boot', 'vmlinuz-linux'), 'a').close()
+    print(f"installing {len(operands) - 1} packages")
+
+
+def pacman(args):
+    if '-Si' in args:
+        print(f"Name            : {args[-1]}")
+
+
+def git(args):
+    if 'clone' in args:
+        os.makedirs(args[-1], exist_ok=True)
+
+
+def genfstab(args):
+    print("UUID=00000000-0000-0000-0000-000000000000 / ext4 rw,relatime 0 1")
+
+
+def chpasswd(args):
+    sys.stdin.read()
+
+
+def unwrap(text):
+    if text.startswith(CHROOT_PREFIX) and text.endswith(CHROOT_SUFFIX):
+        return text[len(CHROOT_PREFIX):-len(CHROOT_SUFFIX)].replace("'\\''", "'")
+    return text
+
+
+def chroot_session(args):
+    """Answer the ChrootSession protocol without running anything: every command succeeds."""
+    pending = []
+    for line in sys.stdin:
+        if line.startswith('printf ') and MARKER in line:
+            token = line.split(MARKER + ':', 1)[1].split(':', 1)[0]
+            started = time.time()
+            simulate_latency('chroot')
+            record('chroot command', [unwrap(''.join(pending))], started)
+            pending = []
+            sys.stdout.write(f"\n{MARKER}:{token}:0\n")
+            sys.stdout.flush()
+        elif line == 'exit\n' and not pending:
+            break
+        else:
+            pending.append(line)
+
+
+HANDLERS = {'pacstrap': pacstrap, 'pacman': pacman, 'git': git, 'genfstab': genfstab, 'chpasswd': chpasswd}
+
+started = time.time()
+if TOOL in ('arch-chroot', 'chroot'):
+    chroot_session(sys.argv[1:])
+else:
+    simulate_latency(TOOL)
+    HANDLERS.get(TOOL, lambda args: None)(sys.argv[1:])
+record(TOOL, sys.argv[1:], started)
+'''
+
+
+class SyntheticIndex(PackageIndex):
+    """Every name is an installable `core` package without dependencies."""
+
+    def __init__(self, names, unavailable=()) -> None:
+        super().__init__()
+        self.unavailable = set(unavailable)
+        for name in names:
+            self.get(name)
+
+    def get(self, name: str) -> PackageMetadata:
+        if not self.is_available(name):
+            return None
+        return self.packages.setdefault(
+            name, PackageMetadata(name, 'core', '1.0-1', f'{name}-1.0-1-x86_64.pkg.tar.zst')
+        )
+
+    def is_available(self, name: str) -> bool:
+        return bool(name) and name not in self.unavailable
+
+
+def install_shims(bin_dir: Path) -> None:
+    """Fill `bin_dir` with the fake tools plus links to the real shells."""
+    bin_dir.mkdir(parents=True, exist_ok=True)
+    shim = bin_dir / 'sendune-shim'
+    shim.write_text(f"#!{sys.executable} -S\nMARKER = {MARKER!r}\n{SHIM_SOURCE}", encoding='utf-8')
+    shim.chmod(0o755)
+    for tool in SHIMMED_TOOLS:
+        (bin_dir / tool).symlink_to(shim.name)
+    for tool in HOST_TOOLS:
+        path = shutil.which(tool)
+        if path is None:
+            raise RuntimeError(f"The benchmark needs {tool} on the host")
+        (bin_dir / tool).symlink_to(path)
+
+
+def benchmark_installer(mount_point: Path, log: LogFile, users=BENCHMARK_USERS) -> MockInstaller:
+    installer = MockInstaller(mount_point=mount_point, base_packages=BASE_PACKAGES)
+    installer.disk_config = None
+    installer.desktop_packages = list(DESKTOP_PACKAGES)
+    installer.selected_locale = 'en_US.UTF-8'
+    installer.selected_timezone = 'America/New_York'
+    installer.selected_keymap = 'us'
+    installer.users = [User(name, '', True) for name in users]
+    return installer
+
+
+def benchmark_stages(skipped=()) -> list:
+    """`install_stages()` without `skipped` and, unless running as root, the root-only stages."""
+    skipped = set(skipped) if os.geteuid() == 0 else set(skipped) | set(ROOT_ONLY_STAGES)
+    return [stage for stage in install_stages() if stage.name not in skipped]
+
+
+def run_worker(spec: dict) -> dict:
+    """One install in this process, against the shims on PATH; returns its measurements."""
+    workdir = Path(spec['workdir'])
+    scenario = SCENARIOS[spec['scenario']]
+    config = copy.deepcopy(scenario['config'])
+    log = LogFile(workdir / 'install.log')
+    use_package_index(SyntheticIndex(BASE_PACKAGES + DESKTOP_PACKAGES) if scenario['index'] == 'synthetic' else PackageIndex())
+
+    installer = benchmark_installer(workdir / 'target', log)
+    installer.install_config = config
+    installer.journal = InstallJournal.open(log, workdir / 'journal')
+    answer_feed = answer_feed_from_config(config)
+    answer_feed.bind(installer)
+    ANSWER_SOURCES.append(answer_feed)
+    ANSWER_LISTENERS.append(installer.journal.record_answer)
+    stages = benchmark_stages()
+
+    error = ''
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    started = time.monotonic()
+    try:
+        full_installation(installer, log, RGB3DLogo(), stages)
+    except Exception as e:
+        error = str(e) or type(e).__name__
+    wall = time.monotonic() - started
+    finished = resource.getrusage(resource.RUSAGE_SELF)
+    log.close()
+
+    spans = list(TRACER.spans)
+    return {
+        'error': error,
+        'wall': wall,
+        'cpu': finished.ru_utime + finished.ru_stime - usage.ru_utime - usage.ru_stime,
+        'stages': {span.name: span.duration for span in spans if span.category == STAGE},
+        'chroot_time': sum(span.duration for span in spans if span.category == CHROOT),
+        'commands': {
+            tool: {'count': stats.count, 'failures': stats.failures, 'wall': stats.wall}
+            for tool, stats in RUNNER.stats.items()
+        },
+    }
+
+
+def read_calls(path: Path) -> list:
+    if not path.exists():
+        return []
+    return [json.loads(line) for line in path.read_text(encoding='utf-8').splitlines() if line]
+
+
+def run_scenario(name: str, latencies: dict, log: LogFile) -> dict:
+    """Install scenario `name` once in a fresh worker process and return its measurements."""
+    with tempfile.TemporaryDirectory(prefix=f'sendune-bench-{name}-') as tmp:
+        workdir = Path(tmp)
+        install_shims(workdir / 'bin')
+        calls_path = workdir / 'calls.jsonl'
+        spec_path = workdir / 'spec.json'
+        result_path = workdir / 'result.json'
+        spec_path.write_text(json.dumps({'scenario': name, 'workdir': str(workdir), 'result': str(result_path)}))
+        env = {
+            'PATH': str(workdir / 'bin'),
+            'HOME': str(workdir / 'home'),
+            'LANG': 'C.UTF-8',
+            'PYTHONPATH': str(Path(__file__).resolve().parent.parent),
+            CALLS_ENV: str(calls_path),
+            LATENCY_ENV: json.dumps(latencies),
+        }
+        worker = run(
+            [sys.executable, '-m', 'SENDUNE_installer.benchmark', '--worker', str(spec_path)],
+            cwd=workdir, env=env, timeout=WORKER_TIMEOUT, display=f'benchmark worker ({name})'
+        )
+        log.info(f"Benchmark worker {name} exited with {worker.returncode}")
+        if not result_path.exists():
+            raise RuntimeError(f"Benchmark worker {name} failed: {worker.stderr.strip() or worker.stdout[-2000:]}")
+        result = json.loads(result_path.read_text(encoding='utf-8'))
+        calls = read_calls(calls_path)
+
+    tools = Counter(call['tool'] for call in calls)
+    chroot_commands = tools.pop('chroot command', 0)
+    # Each runner command is one fork from the installer, and so is each chroot session shell.
+    result['processes'] = sum(stats['count'] for stats in result['commands'].values()) + tools['arch-chroot'] + tools['chroot']
+    result['chroot_commands'] = chroot_commands
+    result['tools'] = dict(sorted(tools.items()))
+    result['unshimmed'] = sorted(
+        tool for tool, stats in result['commands'].items() if stats['failures'] and tool not in SHIMMED_TOOLS
+    )
+    result['command_time'] = sum(stats['wall'] for stats in result['commands'].values()) + result['chroot_time']
+    return result
+
+
+def median_result(results: list) -> dict:
+    """Per-metric medians of several runs of one scenario."""
+    def median(values) -> float:
+        return round(statistics.median(values), 4)
+
+    stage_names = {name for result in results for name in result['stages']}
+    return {
+        'wall': median(result['wall'] for result in results),
+        'cpu': median(result['cpu'] for result in results),
+        'command_time': median(result['command_time'] for result in results),
+        'processes': median(result['processes'] for result in results),
+        'chroot_commands': median(result['chroot_commands'] for result in results),
+        'tools': results[-1]['tools'],
+        'stages': {name: median(result['stages'].get(name, 0.0) for result in results) for name in sorted(stage_names)},
+    }
+
+
+def run_benchmark(scenarios: list, runs: int, latencies: dict, log: LogFile) -> dict:
+    summary = {}
+    for name in scenarios:
+        results = []
+        for attempt in range(1, runs + 1):
+            print(f"Scenario {name}: run {attempt}/{runs}", flush=True)
+            result = run_scenario(name, latencies, log)
+            if result['error']:
+                raise RuntimeError(f"Scenario {name} failed: {result['error']}")
+            if result['unshimmed']:
+                log.warn(f"Scenario {name} ran tools without a shim: {', '.join(result['unshimmed'])}")
+            results.append(result)
+        summary[name] = median_result(results)
+    return summary
+
+
+def exceeds(current: float, base: float, tolerance: float, slack: float) -> bool:
+    return current > base * (1 + tolerance) + slack
+
+
+def find_regressions(summary: dict, baseline: dict, tolerance: float = REGRESSION_TOLERANCE) -> list:
+    """Lines describing every metric that got worse than the baseline allows."""
+    regressions = []
+    for name, result in summary.items():
+        base = baseline.get('scenarios', {}).get(name)
+        if base is None:
+            continue
+        # Counts are deterministic: any extra fork or chroot command is a regression.
+        for metric in ('processes', 'chroot_commands'):
+            if result[metric] > base[metric]:
+                regressions.append(f"{name}: {metric} {base[metric]:g} -> {result[metric]:g}")
+        checks = [('wall', result['wall'], base['wall']), ('installer CPU', result['cpu'], base['cpu'])]
+        checks += [
+            (f"stage {stage}", duration, base['stages'][stage])
+            for stage, duration in result['stages'].items() if stage in base['stages']
+        ]
+        for metric, current, previous in checks:
+            if exceeds(current, previous, tolerance, ABSOLUTE_SLACK):
+                regressions.append(f"{name}: {metric} {previous:.3f}s -> {current:.3f}s")
+    return regressions
+
+
+def format_change(current: float, base) -> str:
+    if base is None:
+        return ''
+    if not base:
+        return '  (new)' if current else ''
+    return f"  ({(current - base) / base:+.0%})"
+
+
+def format_report(summary: dict, baseline: dict | None = None) -> list:
+    lines = []
+    for name, result in summary.items():
+        base = (baseline or {}).get('scenarios', {}).get(name, {})
+        lines += [
+            f"Scenario {name}:",
+            f"  wall time        {result['wall']:8.3f}s{format_change(result['wall'], base.get('wall'))}",
+            f"  installer CPU    {result['cpu']:8.3f}s{format_change(result['cpu'], base.get('cpu'))}",
+            f"  in commands      {result['command_time']:8.3f}s (summed over concurrent commands)",
+            f"  processes        {result['processes']:8g}{format_change(result['processes'], base.get('processes'))}",
+            f"  chroot commands  {result['chroot_commands']:8g}{format_change(result['chroot_commands'], base.get('chroot_commands'))}",
+            "  tool calls: " + ", ".join(f"{tool} {count}" for tool, count in result['tools'].items()),
+            "  slowest stages:",
+        ]
+        ranked = sorted(result['stages'].items(), key=lambda item: item[1], reverse=True)
+        for stage, duration in ranked[:STAGES_SHOWN]:
+            lines.append(f"    {stage:<44} {duration:7.3f}s{format_change(duration, base.get('stages', {}).get(stage))}")
+    return lines
+
+
+def load_baseline(path: Path) -> dict:
+    try:
+        return json.loads(Path(path).read_text(encoding='utf-8'))
+    except FileNotFoundError:
+        return None
+
+
+def save_baseline(path: Path, summary: dict, runs: int, latencies: dict) -> None:
+    data = {
+        'python': sys.version.split()[0],
+        'runs': runs,
+        'latencies': latencies,
+        'scenarios': summary,
+    }
+    Path(path).write_text(json.dumps(data, indent=2, sort_keys=True) + '\n', encoding='utf-8')
+
+
+def parse_latency(text: str) -> tuple:
+    tool, _, seconds = text.partition('=')
+    if tool not in SHIMMED_TOOLS:
+        raise argparse.ArgumentTypeError(f"no shim for {tool!r}; choose from {', '.join(SHIMMED_TOOLS)}")
+    try:
+        return tool, float(seconds)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"latency for {tool} must be seconds, got {seconds!r}") from None
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python3 -m SENDUNE_installer.benchmark',
+        description='Run the whole install against fake system tools and compare with a stored baseline'
+    )
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS,
+                        help='scenario to run; repeat for several (default: all)')
+    parser.add_argument('--runs', type=int, default=BENCHMARK_RUNS, help='runs per scenario; medians are reported')
+    parser.add_argument('--latency', action='append', type=parse_latency, default=[], metavar='TOOL=SECONDS',
+                        help="simulated run time of a tool ('chroot' for each chroot command); default 0")
+    parser.add_argument('--baseline', type=Path, default=BASELINE_PATH, help='baseline JSON to compare with')
+    parser.add_argument('--update-baseline', action='store_true', help='store this run as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=REGRESSION_TOLERANCE,
+                        help='allowed slowdown before a timing counts as a regression (0.25 = 25%%)')
+    parser.add_argument('--worker', type=Path, help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_arguments(argv)
+    if args.worker:
+        spec = json.loads(args.worker.read_text(encoding='utf-8'))
+        result = run_worker(spec)
+        Path(spec['result']).write_text(json.dumps(result), encoding='utf-8')
+        return 0
+    if MOCK_MODE:
+        print("The installer benchmark runs the Linux code paths and needs a Linux host.")
+        return 1
+
+    latencies = dict(args.latency)
+    log = LogFile(Path(tempfile.gettempdir()) / 'SENDUNE_installer.benchmark.log')
+    try:
+        summary = run_benchmark(args.scenario or list(SCENARIOS), args.runs, latencies, log)
+    except RuntimeError as e:
+        log.error(str(e))
+        print(f"Benchmark failed: {e}")
+        return 1
+    finally:
+        log.close()
+
+    baseline = load_baseline(args.baseline)
+    if baseline is not None and baseline.get('latencies') != latencies:
+        print(f"Baseline {args.baseline} was recorded with other latencies; not comparing.")
+        baseline = None
+    print()
+    for line in format_report(summary, baseline):
+        print(line)
+
+    if args.update_baseline:
+        save_baseline(args.baseline, summary, args.runs, latencies)
+        print(f"\nBaseline written to {args.baseline}")
+        return 0
+    if baseline is None:
+        return 0
+    regressions = find_regressions(summary, baseline, args.tolerance)
+    print()
+    if regressions:
+        print(f"Regressions against {args.baseline}:")
+        for line in regressions:
+            print(f"  {line}")
+        return 1
+    print(f"No regressions against {args.baseline}.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
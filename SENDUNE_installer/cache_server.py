@@ -0,0 +1,329 @@
+import email.utils
+import os
+import re
+import threading
+import time
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from .custom_classes import LogFile
+from .downloader import CHUNK_SIZE
+from .package_prefetch import MIRRORLIST, PACMAN_CACHE_DIR, read_mirrorlist
+
+CACHE_SERVER_PORT = 7878
+# Sync databases change upstream; packages never do (a new version is a new file name).
+DB_TTL = 60
+UPSTREAM_TIMEOUT = 30
+# Same layout as a mirror, so clients use `Server = http://host:port/$repo/os/$arch`.
+# Repo and arch names never start with a dot, which also keeps `.` and `..` out of cache paths.
+REQUEST_PATH_RE = re.compile(r'^/(?P<repo>[\w+-][\w.+-]*)/os/(?P<arch>[\w+-][\w.+-]*)/(?P<filename>[^/]+)$')
+PACKAGE_SUFFIXES = ('.pkg.tar.zst', '.pkg.tar.xz', '.pkg.tar.gz', '.pkg.tar.zst.sig', '.pkg.tar.xz.sig')
+DB_SUFFIXES = ('.db', '.files', '.db.sig', '.files.sig')
+DB_SUBDIR = '.sendune-db'
+
+
+class UpstreamMissing(Exception):
+    pass
+
+
+class Transfer():
+    """An upstream download that clients read from its partial file while it is being written.
+
+    `written` only grows once an upstream has answered (`started`); a transfer that fails after
+    that cannot fail over to another mirror, because clients already have its first bytes.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.partial = path.with_name(f"{path.name}.sendune-part")
+        self.size = None
+        self.written = 0
+        self.started = False
+        self.done = False
+        self.failed = False
+        self._condition = threading.Condition()
+
+    def start(self, size) -> None:
+        with self._condition:
+            self.size = int(size) if size is not None else None
+            self.started = True
+            self._condition.notify_all()
+
+    def advance(self, count: int) -> None:
+        with self._condition:
+            self.written += count
+            self._condition.notify_all()
+
+    def complete(self) -> None:
+        with self._condition:
+            os.replace(self.partial, self.path)
+            self.done = True
+            self._condition.notify_all()
+
+    def finish(self) -> None:
+        """Mark a transfer that did not `complete` as failed."""
+        with self._condition:
+            if not self.done:
+                self.partial.unlink(missing_ok=True)
+                self.failed = self.done = True
+            self._condition.notify_all()
+
+    def wait_started(self) -> bool:
+        """Wait until an upstream answered or every upstream failed; True if there is data to stream."""
+        with self._condition:
+            self._condition.wait_for(lambda: self.started or self.done)
+            return self.started
+
+    def wait_done(self) -> bool:
+        with self._condition:
+            self._condition.wait_for(lambda: self.done)
+            return not self.failed
+
+    def wait_for_more(self, offset: int) -> tuple:
+        """Block until more than `offset` bytes are written or the transfer ended; (written, done, failed)."""
+        with self._condition:
+            self._condition.wait_for(lambda: self.written > offset or self.done)
+            return self.written, self.done, self.failed
+
+    def open(self):
+        # Under the condition, so the file cannot be renamed between choosing the name and opening it.
+        with self._condition:
+            return (self.path if self.done and not self.failed else self.partial).open('rb')
+
+
+class ReadThroughCache():
+    """Files fetched from upstream mirrors once and then served from disk.
+
+    Packages are stored flat in `cache_dir`, exactly like pacman's own cache, so the serving
+    node's cache and the fleet's cache are the same files. A file that is not cached yet is
+    downloaded once in the background; every request for it, the first included, is served
+    from the partial file as it grows instead of waiting for the whole download.
+    """
+
+    def __init__(self, cache_dir: Path, upstreams: list, log: LogFile, db_ttl: float = DB_TTL) -> None:
+        self.cache_dir = Path(cache_dir)
+        self.upstreams = upstreams
+        self.log = log
+        self.db_ttl = db_ttl
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self.hits = 0
+        self.fetches = 0
+        self.coalesced = 0
+
+    def local_path(self, repo: str, arch: str, filename: str) -> Path:
+        """Where the file is cached; raises ValueError for names that would leave `cache_dir`."""
+        if filename.endswith(DB_SUFFIXES):
+            path = self.cache_dir / DB_SUBDIR / repo / arch / filename
+        else:
+            path = self.cache_dir / filename
+        if not path.resolve().is_relative_to(self.cache_dir.resolve()):
+            raise ValueError(f"{repo}/{arch}/{filename} is outside the cache")
+        return path
+
+    def _fresh(self, path: Path, filename: str) -> bool:
+        if not path.exists():
+            return False
+        if filename.endswith(DB_SUFFIXES):
+            return time.time() - path.stat().st_mtime < self.db_ttl
+        return True
+
+    def get(self, repo: str, arch: str, filename: str) -> tuple:
+        """Return (local path, None) for a cached file, or (local path, Transfer) while it is downloaded."""
+        path = self.local_path(repo, arch, filename)
+        if self._fresh(path, filename):
+            with self._lock:
+                self.hits += 1
+            return path, None
+
+        with self._lock:
+            transfer = self._inflight.get(path)
+            if transfer is None:
+                transfer = self._inflight[path] = Transfer(path)
+                threading.Thread(
+                    target=self._run_transfer, args=(repo, arch, filename, transfer),
+                    name=f"cache-fetch-{filename}", daemon=True,
+                ).start()
+            else:
+                self.coalesced += 1
+        return path, transfer
+
+    def _run_transfer(self, repo: str, arch: str, filename: str, transfer: Transfer) -> None:
+        try:
+            self._fetch(repo, arch, filename, transfer)
+        except UpstreamMissing:
+            pass
+        except Exception as e:
+            self.log.error(f"Cache server: fetching {repo}/{filename} failed: {e}")
+        finally:
+            with self._lock:
+                del self._inflight[transfer.path]
+                if transfer.done:
+                    self.fetches += 1
+            transfer.finish()
+
+    def _fetch(self, repo: str, arch: str, filename: str, transfer: Transfer) -> None:
+        transfer.path.parent.mkdir(parents=True, exist_ok=True)
+        errors = []
+        for upstream in self.upstreams:
+            url = f"{upstream.replace('$repo', repo).replace('$arch', arch).rstrip('/')}/{filename}"
+            try:
+                response = urllib.request.urlopen(url, timeout=UPSTREAM_TIMEOUT)
+            except (OSError, urllib.error.URLError) as e:
+                errors.append(f"{url}: {e}")
+                continue
+            try:
+                with response, transfer.partial.open('wb') as f:
+                    transfer.start(response.headers.get('Content-Length'))
+                    while chunk := response.read(CHUNK_SIZE):
+                        f.write(chunk)
+                        f.flush()
+                        transfer.advance(len(chunk))
+            except OSError as e:
+                self.log.warn(f"Cache server: {url} failed after {transfer.written} bytes: {e}")
+                raise UpstreamMissing(filename) from e
+            transfer.complete()
+            self.log.info(f"Cache server: fetched {url}")
+            return
+        self.log.warn(f"Cache server: {filename} unavailable upstream: {'; '.join(errors) or 'no upstreams'}")
+        raise UpstreamMissing(filename)
+
+
+class CacheRequestHandler(BaseHTTPRequestHandler):
+    server_version = 'SENDUNE-cache/1'
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args) -> None:
+        self.server.log.info(f"Cache server: {self.client_address[0]} {format % args}")
+
+    def do_HEAD(self) -> None:
+        self._serve(send_body=False)
+
+    def do_GET(self) -> None:
+        self._serve(send_body=True)
+
+    def _serve(self, send_body: bool) -> None:
+        match = REQUEST_PATH_RE.match(self.path.split('?', 1)[0])
+        if not match or not match['filename'].endswith(PACKAGE_SUFFIXES + DB_SUFFIXES):
+            self.send_error(404)
+            return
+        try:
+            path, transfer = self.server.cache.get(match['repo'], match['arch'], match['filename'])
+        except ValueError:
+            self.send_error(404)
+            return
+        ranged = 'Range' in self.headers
+        if transfer is not None:
+            if not transfer.wait_started() or (ranged and not transfer.wait_done()):
+                if not path.exists():
+                    self.send_error(404)
+                    return
+                # A stale database beats none when every upstream is unreachable.
+                self.server.log.warn(f"Cache server: serving stale {match['repo']}/{match['filename']}")
+            elif not ranged:
+                self._stream(transfer, send_body)
+                return
+
+        with path.open('rb') as f:
+            stat = os.fstat(f.fileno())
+            start, end = 0, stat.st_size
+            requested = re.fullmatch(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+            if requested:
+                start = int(requested[1])
+                end = min(end, int(requested[2]) + 1) if requested[2] else end
+                if start >= stat.st_size:
+                    self.send_response(416)
+                    self.send_header('Content-Range', f'bytes */{stat.st_size}')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self.send_response(206)
+                self.send_header('Content-Range', f'bytes {start}-{end - 1}/{stat.st_size}')
+            else:
+                self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(end - start))
+            self.send_header('Last-Modified', email.utils.formatdate(stat.st_mtime, usegmt=True))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.end_headers()
+            if send_body:
+                self.wfile.flush()
+                self._sendfile(f, start, end)
+
+    def _sendfile(self, f, offset: int, end: int) -> int:
+        while offset < end:
+            sent = os.sendfile(self.connection.fileno(), f.fileno(), offset, end - offset)
+            if sent == 0:
+                break
+            offset += sent
+        return offset
+
+    def _stream(self, transfer: Transfer, send_body: bool) -> None:
+        """Send a file that is still being downloaded, following its partial file."""
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        if transfer.size is not None:
+            self.send_header('Content-Length', str(transfer.size))
+        else:
+            # Without a length the end of the body is the end of the connection.
+            self.close_connection = True
+        self.end_headers()
+        if not send_body:
+            return
+        self.wfile.flush()
+        with transfer.open() as f:
+            offset = 0
+            while True:
+                written, done, failed = transfer.wait_for_more(offset)
+                offset = self._sendfile(f, offset, written)
+                if failed:
+                    # The client gets a short body and retries against its next server.
+                    self.close_connection = True
+                    return
+                if done and offset >= written:
+                    return
+
+
+class CacheServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: tuple, cache: ReadThroughCache, log: LogFile) -> None:
+        self.cache = cache
+        self.log = log
+        super().__init__(address, CacheRequestHandler)
+
+
+def serve_cache(log: LogFile, port: int = CACHE_SERVER_PORT, bind: str = '0.0.0.0',
+                upstreams: list | None = None, cache_dir: Path = PACMAN_CACHE_DIR) -> None:
+    """Run the LAN package cache until interrupted."""
+    upstreams = upstreams or read_mirrorlist()
+    if not upstreams:
+        raise RuntimeError(f"No upstream mirrors: pass --upstream or configure {MIRRORLIST}")
+    cache = ReadThroughCache(cache_dir, upstreams, log)
+    server = CacheServer((bind, port), cache, log)
+    log.info(f"Cache server listening on {bind}:{port}, cache {cache_dir}, upstreams {', '.join(upstreams)}")
+    print(f"SENDUNE package cache serving {cache_dir} on port {port}.")
+    print(f"On the other machines run: sendune-installer --cache-server http://<this-machine>:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        log.info(
+            f"Cache server stopped: {cache.hits} hits, {cache.fetches} upstream fetches, "
+            f"{cache.coalesced} coalesced requests"
+        )
+
+
+def use_cache_server(url: str, log: LogFile, mirrorlist: Path = MIRRORLIST) -> None:
+    """Put a LAN cache server first in the live mirrorlist, keeping the mirrors as fallback."""
+    server_line = f"Server = {url.rstrip('/')}/$repo/os/$arch\n"
+    existing = mirrorlist.read_text(encoding='utf-8') if mirrorlist.exists() else ''
+    if server_line in existing:
+        return
+    mirrorlist.parent.mkdir(parents=True, exist_ok=True)
+    mirrorlist.write_text(f"# SENDUNE LAN package cache\n{server_line}{existing}", encoding='utf-8')
+    log.info(f"Using LAN package cache {url}")
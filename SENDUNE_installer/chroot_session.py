@@ -0,0 +1,288 @@
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Self
+
+from .custom_classes import LogFile
+from .tracing import CHROOT, trace_span
+
+MARKER = '__SENDUNE_CHROOT_DONE__'
+# A chroot command running longer than this is killed together with its session (AUR builds are the slowest).
+CHROOT_TIMEOUT = 4 * 3600
+# Exit status reported for a command killed at its timeout, as coreutils `timeout` does.
+TIMEOUT_RETURNCODE = 124
+# How long `close` waits for the session shell to exit before killing it.
+CLOSE_GRACE = 10
+# Shells per mount point: one arch-chroot owns the bind mounts, the rest chroot into the mounted root.
+# Enough for the concurrent stages or AUR build workers to each have one.
+CHROOT_SHELLS = 4
+# Each source(command) may return (returncode, output) to use instead of running the command (transcript replay).
+CHROOT_SOURCES = []
+# Called as listener(result) after every chroot command, e.g. to record an install transcript.
+CHROOT_LISTENERS = []
+
+
+@dataclass
+class ChrootResult:
+    command: str
+    returncode: int
+    output: str
+    duration: float
+    timed_out: bool = False
+
+
+def shell_quote(text: str) -> str:
+    return "'" + text.replace("'", "'\\''") + "'"
+
+
+class ChrootSession():
+    """One `arch-chroot` (one set of bind mounts) serving many commands through a resident shell.
+
+    Each command runs in its own subshell with stdin from /dev/null, so a command can neither
+    change the session's environment nor swallow the commands queued after it. A command
+    past its timeout is killed with the whole session; the next command opens a new one.
+    `argv` replaces the `arch-chroot` shell, e.g. with a plain `chroot` into a root another
+    session has already mounted.
+    """
+
+    def __init__(self, mount_point: Path, log: LogFile, echo: bool = True, timeout: float = CHROOT_TIMEOUT,
+                 argv: list | None = None) -> None:
+        self.mount_point = Path(mount_point)
+        self.log = log
+        self.echo = echo
+        self.timeout = timeout
+        self.argv = argv or ['arch-chroot', str(self.mount_point), '/bin/bash', '--login', '-s']
+        self.results = []
+        self._process = None
+        self._lock = threading.Lock()
+        self._opened_at = None
+
+    def open(self) -> Self:
+        if self._process is None:
+            self._process = subprocess.Popen(
+                self.argv,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                text=True,
+                bufsize=1,
+                # Its own process group, so a timeout kills the command along with the shell.
+                start_new_session=True,
+            )
+            self._opened_at = time.monotonic()
+            # Swallow anything the login profile prints so it is not attributed to the first command.
+            if self._exchange(':', echo=False, timeout=self.timeout)[2]:
+                raise RuntimeError(f"chroot session in {self.mount_point} did not start")
+            self.log.info(f"Opened chroot session in {self.mount_point} ({self.argv[0]})")
+        return self
+
+    def _exchange(self, command: str, echo: bool, timeout: float) -> tuple:
+        """Run `command` in the session shell; return (returncode, output, timed out)."""
+        token = uuid.uuid4().hex
+        # eval in a subshell: even a syntax error in `command` cannot kill the session shell.
+        self._process.stdin.write(
+            f"( eval {shell_quote(command)} ) < /dev/null 2>&1\n"
+            f"printf '\\n{MARKER}:{token}:%d\\n' $?\n"
+        )
+        self._process.stdin.flush()
+
+        expired = threading.Event()
+        watchdog = threading.Timer(timeout, self._kill, (self._process, expired)) if timeout else None
+        if watchdog is not None:
+            watchdog.daemon = True
+            watchdog.start()
+        lines = []
+        try:
+            for line in self._process.stdout:
+                if line.startswith(f"{MARKER}:{token}:"):
+                    if lines and lines[-1] == '\n':
+                        # Drop the newline printf adds in front of the marker.
+                        lines.pop()
+                    return int(line.rsplit(':', 1)[1]), ''.join(lines), False
+                lines.append(line)
+                if echo:
+                    sys.stdout.write(line)
+        finally:
+            if watchdog is not None:
+                watchdog.cancel()
+
+        self._process.wait()
+        self._process = None
+        if expired.is_set():
+            self.log.error(f"chroot command timed out after {timeout:.0f}s, session in {self.mount_point} killed: {command}")
+            return TIMEOUT_RETURNCODE, ''.join(lines), True
+        raise RuntimeError(f"chroot session in {self.mount_point} exited while running: {command}")
+
+    @staticmethod
+    def _kill(process: subprocess.Popen, expired: threading.Event) -> None:
+        expired.set()
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    def run(self, command: str, timeout: float | None = None, echo: bool | None = None) -> ChrootResult:
+        """Run `command`; without `timeout` or `echo`, the session's apply."""
+        with self._lock:
+            if not CHROOT_SOURCES:
+                self.open()
+            started = time.monotonic()
+            timed_out = False
+            with trace_span(command, CHROOT):
+                replayed = next((answer for answer in (source(command) for source in CHROOT_SOURCES)
+                                 if answer is not None), None)
+                if replayed is not None:
+                    returncode, output = replayed
+                else:
+                    returncode, output, timed_out = self.open()._exchange(
+                        command, self.echo if echo is None else echo, timeout if timeout is not None else self.timeout
+                    )
+            result = ChrootResult(command, returncode, output, time.monotonic() - started, timed_out)
+            self.results.append(result)
+            self.log.info(f"chroot [{result.returncode}] {result.duration:.2f}s: {command}")
+        for listener in CHROOT_LISTENERS:
+            listener(result)
+        return result
+
+    def run_queue(self, commands, stop_on_error: bool = True) -> list:
+        results = []
+        for command in commands:
+            result = self.run(command)
+            results.append(result)
+            if stop_on_error and result.returncode != 0:
+                break
+        return results
+
+    def close(self) -> None:
+        with self._lock:
+            if self._process is None:
+                return
+            try:
+                self._process.stdin.write('exit\n')
+                self._process.stdin.close()
+            except (BrokenPipeError, OSError):
+                pass
+            try:
+                self._process.wait(timeout=CLOSE_GRACE)
+            except subprocess.TimeoutExpired:
+                # A command is still running, e.g. after Ctrl+C stopped the installer mid-command.
+                self._kill(self._process, threading.Event())
+                self._process.wait()
+            self._process = None
+            failed = sum(1 for result in self.results if result.returncode != 0)
+            self.log.info(
+                f"Closed chroot session in {self.mount_point}: {len(self.results)} commands "
+                f"({failed} failed), {sum(result.duration for result in self.results):.1f}s in commands, "
+                f"{time.monotonic() - self._opened_at:.1f}s open"
+            )
+
+    def __enter__(self) -> Self:
+        return self.open()
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+class ChrootPool():
+    """Up to `size` session shells in one mounted target, handed out one command (or queue) at a time.
+
+    The first shell is an `arch-chroot`, so the target's bind mounts are set up and torn down
+    once; further shells are started only while every existing one is busy, and `chroot` into
+    the root the first one has mounted. Concurrent stages wait for a free shell beyond `size`.
+    """
+
+    def __init__(self, mount_point: Path, log: LogFile, size: int = CHROOT_SHELLS, echo: bool = True,
+                 timeout: float = CHROOT_TIMEOUT) -> None:
+        self.mount_point = Path(mount_point)
+        self.log = log
+        self.size = size
+        self.echo = echo
+        self.timeout = timeout
+        self._shells = []
+        self._idle = []
+        self._condition = threading.Condition()
+
+    def _acquire(self) -> ChrootSession:
+        with self._condition:
+            self._condition.wait_for(lambda: self._idle or len(self._shells) < self.size)
+            if self._idle:
+                return self._idle.pop()
+            if not self._shells:
+                shell = ChrootSession(self.mount_point, self.log, self.echo, self.timeout)
+                if not CHROOT_SOURCES:
+                    # Mounted before any `chroot` shell can be started next to it.
+                    shell.open()
+            else:
+                argv = ['chroot', str(self.mount_point), '/bin/bash', '--login', '-s']
+                shell = ChrootSession(self.mount_point, self.log, self.echo, self.timeout, argv)
+            self._shells.append(shell)
+            return shell
+
+    def _release(self, shell: ChrootSession) -> None:
+        with self._condition:
+            self._idle.append(shell)
+            self._condition.notify()
+
+    def run(self, command: str, timeout: float | None = None, echo: bool | None = None) -> ChrootResult:
+        shell = self._acquire()
+        try:
+            return shell.run(command, timeout, echo)
+        finally:
+            self._release(shell)
+
+    def run_queue(self, commands, stop_on_error: bool = True) -> list:
+        """Run `commands` in order, all in the same shell."""
+        shell = self._acquire()
+        try:
+            return shell.run_queue(commands, stop_on_error)
+        finally:
+            self._release(shell)
+
+    def close(self) -> None:
+        with self._condition:
+            shells, self._shells, self._idle = self._shells, [], []
+        # The `arch-chroot` shell goes last: its exit unmounts what the others run in.
+        for shell in reversed(shells):
+            shell.close()
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def chroot_session_for(mount_point, log: LogFile) -> ChrootPool:
+    """Return the shared chroot pool for `mount_point`; its first command mounts the target."""
+    key = str(Path(mount_point).resolve())
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            session = _sessions[key] = ChrootPool(Path(mount_point), log)
+        return session
+
+
+def close_chroot_sessions() -> None:
+    with _sessions_lock:
+        sessions = list(_sessions.values())
+        _sessions.clear()
+    for session in sessions:
+        session.close()
+
+
+def arch_chroot(installer, command: str, log: LogFile):
+    """Run `command` inside the installer's target through the shared chroot session."""
+    result = chroot_session_for(installer.mount_point, log).run(command)
+    if result.returncode != 0:
+        log.warn(f"arch-chroot command failed: {command}")
+    return result.returncode
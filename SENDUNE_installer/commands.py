@@ -0,0 +1,420 @@
+import asyncio
+import functools
+import os
+import re
+try:
+    import resource
+except ImportError:
+    resource = None
+import shlex
+import signal
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+
+from .custom_classes import LogFile
+from .tracing import COMMAND, trace_span
+
+# External commands running at once, across every stage and thread of the installer.
+COMMAND_CONCURRENCY = max(4, os.cpu_count() or 1)
+# A command past its timeout gets SIGTERM, and SIGKILL this many seconds later.
+KILL_GRACE = 5
+# Timeouts (seconds) for calls that pass none, by tool; generous, they only stop commands that hang.
+TOOL_TIMEOUTS = {
+    'pacstrap': 3 * 3600,
+    'pacman': 3600,
+    'git': 900,
+    'reflector': 600,
+    'zstd': 2 * 3600,
+    'e2fsck': 3600,
+    'systemctl': 300,
+    'genfstab': 120,
+    'mount': 120,
+    'umount': 120,
+    'losetup': 60,
+    'chpasswd': 60,
+    'nmcli': 180,
+    'timedatectl': 60,
+    'lspci': 30,
+}
+# For tools not in TOOL_TIMEOUTS.
+DEFAULT_TIMEOUT = 3600
+# Output is read this long after exit; a daemon the command started may hold the pipe open.
+OUTPUT_GRACE = 2
+READ_SIZE = 64 * 1024
+LINE_BREAK = re.compile(rb'\r\n|\r|\n')
+SHELLS = {'sh', 'bash'}
+SUMMARY_ROWS = 15
+# Each source(argv, display) may return a CommandResult to use instead of running the command (transcript replay).
+COMMAND_SOURCES = []
+# Called as listener(result, cwd) after every command, e.g. to record an install transcript.
+COMMAND_LISTENERS = []
+
+
+@dataclass
+class CommandResult:
+    argv: list
+    display: str
+    returncode: int
+    stdout: str = ''
+    stderr: str = ''
+    output: bytes = b''
+    wall: float = 0.0
+    user_time: float = 0.0
+    system_time: float = 0.0
+    max_rss: int = 0
+    timed_out: bool = False
+
+    @property
+    def tool(self) -> str:
+        return command_tool(self.argv)
+
+    @property
+    def cpu(self) -> float:
+        return self.user_time + self.system_time
+
+    @property
+    def ok(self) -> bool:
+        return self.returncode == 0 and not self.timed_out
+
+    def describe(self) -> str:
+        outcome = f"timed out after {self.wall:.1f}s" if self.timed_out else f"exit {self.returncode} in {self.wall:.2f}s"
+        rss = f", {self.max_rss / 1024 ** 2:.0f} MiB max RSS" if self.max_rss else ''
+        return f"{outcome} ({self.cpu:.2f}s CPU{rss})"
+
+    def check(self) -> 'CommandResult':
+        if not self.ok:
+            raise CommandError(self)
+        return self
+
+
+class CommandError(Exception):
+    def __init__(self, result: CommandResult) -> None:
+        reason = 'timed out' if result.timed_out else result.stderr.strip() or result.returncode
+        super().__init__(f"{result.tool} failed: {reason}")
+        self.result = result
+
+
+@dataclass
+class ToolStats:
+    count: int = 0
+    failures: int = 0
+    wall: float = 0.0
+    cpu: float = 0.0
+    max_rss: int = 0
+
+
+def command_tool(argv: list) -> str:
+    """The program a command line runs, looking through `sh -c '<tool> ...'`."""
+    tool = Path(argv[0]).name
+    if tool in SHELLS and '-c' in argv[1:-1]:
+        words = [word for word in argv[argv.index('-c') + 1].split() if '=' not in word]
+        if words:
+            return Path(words[0]).name
+    return tool
+
+
+def _peak_rss(rusage, baseline: int) -> int:
+    """The command's peak RSS in bytes, or 0 if it stayed below `baseline`.
+
+    The kernel counts the installer's own memory, shared with the child until exec, in the
+    child's ru_maxrss, so only a peak above the installer's own says anything about the tool.
+    """
+    # ru_maxrss is in KiB on Linux.
+    peak = rusage.ru_maxrss * 1024 if rusage else 0
+    return peak if peak > baseline else 0
+
+
+def _wait(process: subprocess.Popen) -> tuple:
+    """Reap `process`; return (returncode, rusage or None)."""
+    if not hasattr(os, 'wait4'):
+        return process.wait(), None
+    _, status, rusage = os.wait4(process.pid, 0)
+    # Reaped here, so Popen must not wait for it again.
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return process.returncode, rusage
+
+
+def _signal_group(process: subprocess.Popen, sig: int) -> None:
+    try:
+        if hasattr(os, 'killpg'):
+            os.killpg(process.pid, sig)
+        else:
+            process.kill()
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+class CommandRunner():
+    """Runs external commands on one asyncio loop in a background thread.
+
+    Any thread may call `run`; at most `limit` commands run at once. Output is read line by
+    line as it arrives and written to the log, each command is reaped with wait4 for its
+    wall time, CPU time and peak RSS (children included), and per-tool totals are kept for
+    the end-of-install summary. A call without a timeout gets its tool's entry in `timeouts`,
+    or `default_timeout`, so a hung command cannot stall the install.
+    """
+
+    def __init__(self, limit: int = COMMAND_CONCURRENCY, timeouts: dict | None = None,
+                 default_timeout: float = DEFAULT_TIMEOUT) -> None:
+        self.limit = limit
+        self.timeouts = dict(TOOL_TIMEOUTS if timeouts is None else timeouts)
+        self.default_timeout = default_timeout
+        self.stats = {}
+        self._lock = threading.Lock()
+        self._loop = None
+        self._semaphore = None
+        self._reaper = None
+
+    def _event_loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name='commands', daemon=True).start()
+                self._semaphore = asyncio.Semaphore(self.limit)
+                # Blocking wait4 calls, one per running command.
+                self._reaper = ThreadPoolExecutor(max_workers=self.limit, thread_name_prefix='command-reaper')
+                self._loop = loop
+            return self._loop
+
+    def timeout_for(self, argv: list) -> float:
+        return self.timeouts.get(command_tool(argv), self.default_timeout)
+
+    def run(self, argv: list, log: LogFile | None = None, *, timeout: float | None = None, input: str | None = None,
+            cwd: Path | None = None, env: dict | None = None, output: LogFile | None = None, echo: bool = False,
+            binary: bool = False, on_stdout=None, chunk_size: int = READ_SIZE,
+            display: str | None = None, check: bool = False) -> CommandResult:
+        """Run `argv` and return its CommandResult; raise CommandError with `check` if it failed.
+
+        stdout and stderr lines go to `output` (default: `log`) and, with `echo`, to the
+        terminal. With `binary`, stdout is kept as bytes in `result.output` instead; with
+        `on_stdout`, it is handed over in `chunk_size` pieces, called off the event loop.
+        `display` replaces the command line in the log and trace (e.g. to hide a password).
+        Without `timeout`, the tool's default from `timeout_for` applies.
+        """
+        argv = [str(arg) for arg in argv]
+        display = display or shlex.join(argv)
+        timeout = timeout if timeout is not None else self.timeout_for(argv)
+        with trace_span(display, COMMAND, tool=command_tool(argv)) as span:
+            result = next((result for result in (source(argv, display) for source in COMMAND_SOURCES)
+                           if result is not None), None)
+            if result is None:
+                future = asyncio.run_coroutine_threadsafe(
+                    self._run(argv, display, timeout, input, cwd, env, output or log, echo, binary, on_stdout, chunk_size),
+                    self._event_loop()
+                )
+                try:
+                    result = future.result()
+                except BaseException:
+                    # Ctrl+C in the calling thread: stop the command too.
+                    future.cancel()
+                    raise
+            span.args.update(
+                returncode=result.returncode, cpu_s=round(result.cpu, 3), max_rss_mb=round(result.max_rss / 1024 ** 2, 1)
+            )
+        self._record(result)
+        for listener in COMMAND_LISTENERS:
+            listener(result, cwd)
+        if log is not None:
+            if result.ok:
+                log.info(f"{display}: {result.describe()}")
+            else:
+                log.warn(f"{display}: {result.describe()}")
+        if check:
+            result.check()
+        return result
+
+    async def _run(self, argv, display, time_limit, input, cwd, env, output, echo, binary, on_stdout, chunk_size):
+        async with self._semaphore:
+            loop = asyncio.get_running_loop()
+            started = time.monotonic()
+            baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 if resource else 0
+            # fork/exec blocks, so it runs on a reaper thread instead of stalling every other command's I/O.
+            spawn = loop.run_in_executor(self._reaper, functools.partial(
+                subprocess.Popen,
+                argv,
+                stdin=subprocess.DEVNULL if input is None else subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                cwd=cwd,
+                env=env,
+                # Its own process group, so a timeout stops a whole pipeline.
+                start_new_session=True,
+            ))
+            try:
+                process = await asyncio.shield(spawn)
+            except OSError as e:
+                return CommandResult(argv, display, 127, stderr=str(e), wall=time.monotonic() - started)
+            except asyncio.CancelledError:
+                spawn.add_done_callback(self._stop_spawned)
+                raise
+
+            tool = command_tool(argv)
+            stdout_lines, stderr_lines, chunks = [], [], []
+            readers = [
+                loop.create_task(self._read_lines(process.stderr, stderr_lines, output, f"[{tool} stderr]", echo)),
+            ]
+            if on_stdout is not None:
+                readers.append(loop.create_task(self._read_chunks(process, on_stdout, chunk_size)))
+            elif binary:
+                readers.append(loop.create_task(self._read_chunks(process, chunks.append, chunk_size)))
+            else:
+                readers.append(loop.create_task(self._read_lines(process.stdout, stdout_lines, output, f"[{tool}]", echo)))
+            if input is not None:
+                readers.append(loop.run_in_executor(None, self._write_input, process, input))
+
+            waiter = loop.run_in_executor(self._reaper, _wait, process)
+            timed_out = False
+            try:
+                done, _ = await asyncio.wait({waiter}, timeout=time_limit)
+                if not done:
+                    timed_out = True
+                    _signal_group(process, signal.SIGTERM)
+                    done, _ = await asyncio.wait({waiter}, timeout=KILL_GRACE)
+                    if not done:
+                        _signal_group(process, signal.SIGKILL)
+                returncode, rusage = await waiter
+            except asyncio.CancelledError:
+                _signal_group(process, signal.SIGKILL)
+                await asyncio.shield(waiter)
+                raise
+            finally:
+                _, pending = await asyncio.wait(readers, timeout=OUTPUT_GRACE)
+                for reader in pending:
+                    reader.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
+                for pipe in (process.stdout, process.stderr):
+                    pipe.close()
+            for reader in readers:
+                if reader.done() and not reader.cancelled() and reader.exception() is not None:
+                    raise reader.exception()
+
+            return CommandResult(
+                argv,
+                display,
+                returncode,
+                stdout=''.join(stdout_lines),
+                stderr=''.join(stderr_lines),
+                output=b''.join(chunks),
+                wall=time.monotonic() - started,
+                user_time=rusage.ru_utime if rusage else 0.0,
+                system_time=rusage.ru_stime if rusage else 0.0,
+                max_rss=_peak_rss(rusage, baseline),
+                timed_out=timed_out,
+            )
+
+    def _stop_spawned(self, spawn: asyncio.Future) -> None:
+        """Kill and reap a command that started after its call was cancelled."""
+        if spawn.cancelled() or spawn.exception() is not None:
+            return
+        process = spawn.result()
+        _signal_group(process, signal.SIGKILL)
+        for pipe in (process.stdin, process.stdout, process.stderr):
+            if pipe is not None:
+                pipe.close()
+        self._reaper.submit(_wait, process)
+
+    @staticmethod
+    async def _open_reader(pipe) -> tuple:
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader()
+        transport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), pipe)
+        return reader, transport
+
+    async def _read_lines(self, pipe, lines: list, output: LogFile, prefix: str, echo: bool) -> None:
+        # Split on \r as well: progress bars redraw one line with \r and never end it.
+        reader, transport = await self._open_reader(pipe)
+        pending = b''
+        try:
+            while True:
+                data = await reader.read(READ_SIZE)
+                if data:
+                    parts = LINE_BREAK.split(pending + data)
+                    pending = parts.pop()
+                else:
+                    parts = [pending] if pending else []
+                for part in parts:
+                    line = part.decode(errors='replace')
+                    lines.append(line + '\n')
+                    if not line.strip():
+                        continue
+                    if output is not None:
+                        output.info(f"{prefix} {line}")
+                    if echo:
+                        print(line, flush=True)
+                if not data:
+                    return
+        finally:
+            transport.close()
+
+    async def _read_chunks(self, process: subprocess.Popen, on_chunk, chunk_size: int) -> None:
+        loop = asyncio.get_running_loop()
+        reader, transport = await self._open_reader(process.stdout)
+        try:
+            while True:
+                try:
+                    chunk = await reader.readexactly(chunk_size)
+                except asyncio.IncompleteReadError as e:
+                    chunk = e.partial
+                if chunk:
+                    await loop.run_in_executor(None, on_chunk, chunk)
+                if len(chunk) < chunk_size:
+                    return
+        except Exception:
+            # Nobody reads the rest of the output, so the command would block on a full pipe.
+            _signal_group(process, signal.SIGKILL)
+            raise
+        finally:
+            transport.close()
+
+    @staticmethod
+    def _write_input(process: subprocess.Popen, input: str) -> None:
+        try:
+            process.stdin.write(input.encode())
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+
+    def _record(self, result: CommandResult) -> None:
+        with self._lock:
+            stats = self.stats.setdefault(result.tool, ToolStats())
+            stats.count += 1
+            stats.failures += not result.ok
+            stats.wall += result.wall
+            stats.cpu += result.cpu
+            stats.max_rss = max(stats.max_rss, result.max_rss)
+
+    def summary_lines(self, rows: int = SUMMARY_ROWS) -> list:
+        """Per-tool totals, most wall time first."""
+        with self._lock:
+            ranked = sorted(self.stats.items(), key=lambda item: item[1].wall, reverse=True)
+        if not ranked:
+            return []
+        lines = [f"{'tool':<20} {'runs':>5} {'failed':>6} {'wall':>9} {'cpu':>9} {'max rss':>9}"]
+        for tool, stats in ranked[:rows]:
+            rss = f"{stats.max_rss / 1024 ** 2:.0f} MiB" if stats.max_rss else '-'
+            lines.append(
+                f"{tool[:20]:<20} {stats.count:>5} {stats.failures:>6} {stats.wall:>8.1f}s {stats.cpu:>8.1f}s {rss:>9}"
+            )
+        return lines
+
+
+RUNNER = CommandRunner()
+
+
+def run(argv: list, log: LogFile | None = None, **kwargs) -> CommandResult:
+    """`RUNNER.run`: run one external command through the shared runner."""
+    return RUNNER.run(argv, log, **kwargs)
+
+
+def run_shell(command: str, log: LogFile | None = None, **kwargs) -> CommandResult:
+    """Run a shell command line (pipes, redirections, `||`) with `sh -c` through the shared runner."""
+    kwargs.setdefault('display', command)
+    return RUNNER.run(['sh', '-c', command], log, **kwargs)
+
+
+def command_summary_lines() -> list:
+    return RUNNER.summary_lines()
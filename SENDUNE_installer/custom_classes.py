@@ -1,23 +1,185 @@
 from pathlib import Path
+import atexit
+import json
+import os
+import queue
+import shutil
+import sys
+import threading
 import time
 
+from .tracing import STAGE, TRACER
+
+TEXT = 'text'
+JSON_LINES = 'jsonl'
+LOG_FORMATS = (TEXT, JSON_LINES)
+LEVELS = {'info': 'INFO', 'warn': 'WARNING', 'error': 'ERROR'}
+# Bounded so a stalled disk slows the installer down instead of filling RAM with log lines.
+LOG_QUEUE_SIZE = 10000
+LOG_BATCH_SIZE = 512
+LOG_FLUSH_INTERVAL = 1.0
+LOG_MAX_BYTES = 32 * 1024 * 1024
+LOG_BACKUPS = 3
 
 
 class LogFile():
-    def __init__(self, path: Path) -> None:
-        self.path = path
+    """Append-only installer log written by a background thread.
+
+    `write` and friends only queue the line, so stages on several threads can log without
+    waiting on the disk. The writer thread writes lines in batches, flushes at least every
+    LOG_FLUSH_INTERVAL seconds and fsyncs right after an error, so the reason for a failed
+    install is on disk even if the machine is reset. Past `max_bytes` the file is rotated to
+    `<name>.1` ... `<name>.<backups>`. With `log_format='jsonl'` each line is a JSON object
+    with the seconds since the log was opened (monotonic), wall time, level and current stage.
+    """
+
+    def __init__(self, path: Path, log_format: str = TEXT, max_bytes: int = LOG_MAX_BYTES,
+                 backups: int = LOG_BACKUPS) -> None:
+        if log_format not in LOG_FORMATS:
+            raise ValueError(f"Unknown log format {log_format!r}; expected one of {', '.join(LOG_FORMATS)}")
+        self.path = Path(path)
+        self.log_format = log_format
+        self.max_bytes = max_bytes
+        self.backups = backups
         self.path.parent.mkdir(parents=True, exist_ok=True)
-        self.file = self.path.open('a')
-    def write(self, message: str) -> None:
-        timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
-        self.file.write(f"[{timestamp}] {message}\n")
-        self.file.flush()
+        self.file = self.path.open('a', encoding='utf-8')
+        self.started = time.monotonic()
+        self._queue = queue.Queue(LOG_QUEUE_SIZE)
+        self._closed = False
+        self._close_lock = threading.Lock()
+        self._second = None
+        self._timestamp = ''
+        self._write_failed = False
+        self._writer = threading.Thread(target=self._run_writer, name=f"log-{self.path.name}", daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+
+    def write(self, message: str, level: str | None = None) -> None:
+        if self._closed:
+            raise ValueError(f"Log {self.path} is closed")
+        self._queue.put((time.monotonic(), time.time(), level, message, TRACER.current(STAGE)))
     def warn(self, message: str) -> None:
-        self.write(f"WARNING: {message}")
+        self.write(message, 'warn')
     def error(self, message: str) -> None:
-        self.write(f"ERROR: {message}")
+        self.write(message, 'error')
     def info(self, message: str) -> None:
-        self.write(f"INFO: {message}")
+        self.write(message, 'info')
+
+    def flush(self, sync: bool = False) -> None:
+        """Block until every line logged so far is written (and fsynced with `sync`)."""
+        if self._closed:
+            return
+        done = threading.Event()
+        self._queue.put(('flush', done, sync))
+        done.wait()
+
+    def copy_to(self, directory: Path) -> list:
+        """Copy the log and its rotated files into `directory`, e.g. the target's /var/log."""
+        self.flush(sync=True)
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        copied = []
+        for source in [self.path] + [self._backup_path(index) for index in range(1, self.backups + 1)]:
+            if source.exists():
+                copied.append(Path(shutil.copy2(source, directory / source.name)))
+        return copied
 
     def close(self) -> None:
-        self.file.close()
\ No newline at end of file
+        with self._close_lock:
+            if self._closed:
+                return
+            self._closed = True
+        atexit.unregister(self.close)
+        self._queue.put(('stop', None, True))
+        self._writer.join()
+        self.file.close()
+
+    def _backup_path(self, index: int) -> Path:
+        return self.path.with_name(f"{self.path.name}.{index}")
+
+    def _format(self, record: tuple) -> str:
+        monotonic, wall, level, message, stage = record
+        second = int(wall)
+        if second != self._second:
+            # strftime once per second rather than once per line.
+            self._second = second
+            self._timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(second))
+        if self.log_format == JSON_LINES:
+            return json.dumps({
+                't': round(monotonic - self.started, 6),
+                'time': f"{self._timestamp.replace(' ', 'T')}.{int(wall % 1 * 1000):03d}",
+                'level': level,
+                'stage': stage,
+                'message': message,
+            }, ensure_ascii=False) + "\n"
+        if level is not None:
+            message = f"{LEVELS[level]}: {message}"
+        return f"[{self._timestamp}] {message}\n"
+
+    def _run_writer(self) -> None:
+        dirty = False
+        while True:
+            try:
+                batch = [self._queue.get(timeout=LOG_FLUSH_INTERVAL)]
+            except queue.Empty:
+                if dirty:
+                    self._sync(False)
+                    dirty = False
+                continue
+            while len(batch) < LOG_BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            lines, sync = [], False
+            for record in batch:
+                if record[0] in ('flush', 'stop'):
+                    self._write(lines)
+                    lines, dirty = [], False
+                    self._sync(record[2])
+                    if record[0] == 'stop':
+                        return
+                    record[1].set()
+                    continue
+                lines.append(self._format(record))
+                sync = sync or record[2] == 'error'
+            if lines:
+                self._write(lines)
+                dirty = True
+            if sync:
+                self._sync(True)
+                dirty = False
+
+    def _write(self, lines: list) -> None:
+        if not lines or self._write_failed:
+            return
+        try:
+            self.file.write(''.join(lines))
+            if self.max_bytes and self.file.tell() >= self.max_bytes:
+                self._rotate()
+        except OSError as e:
+            # Keep draining the queue so the installer never blocks on a broken log.
+            self._write_failed = True
+            print(f"Writing {self.path} failed, further log lines are dropped: {e}", file=sys.stderr)
+
+    def _sync(self, fsync: bool) -> None:
+        if self._write_failed:
+            return
+        try:
+            self.file.flush()
+            if fsync:
+                os.fsync(self.file.fileno())
+        except OSError as e:
+            self._write_failed = True
+            print(f"Writing {self.path} failed, further log lines are dropped: {e}", file=sys.stderr)
+
+    def _rotate(self) -> None:
+        self.file.close()
+        if self.backups:
+            for index in range(self.backups - 1, 0, -1):
+                if self._backup_path(index).exists():
+                    os.replace(self._backup_path(index), self._backup_path(index + 1))
+            os.replace(self.path, self._backup_path(1))
+            self.file = self.path.open('a', encoding='utf-8')
+        else:
+            self.file = self.path.open('w', encoding='utf-8')
@@ -0,0 +1,126 @@
+from collections import deque
+
+from .custom_classes import LogFile
+from .package_index import PackageIndex, strip_version
+from .package_resolver import resolve_package_name
+
+
+def format_size(size: int) -> str:
+    if size < 1024:
+        return f"{size} B"
+    value = size / 1024
+    for unit in ('KiB', 'MiB'):
+        if value < 1024:
+            return f"{value:.1f} {unit}"
+        value /= 1024
+    return f"{value:.1f} GiB"
+
+
+class DependencyClosure():
+    """Transitive dependency closure of the selected packages, grown as wizard steps add packages.
+
+    Every package in the closure is attributed to the step that first pulled it in, so the
+    summary can say which answers are responsible for how many packages and bytes.
+    """
+
+    def __init__(self, index: PackageIndex) -> None:
+        self.index = index
+        self.roots = {}
+        self.owner = {}
+        self.unresolved = {}
+        # Called with the full package list after every change, e.g. to drive the prefetcher.
+        self.listeners = []
+
+    def _notify(self) -> None:
+        for listener in self.listeners:
+            listener(self.packages)
+
+    def _resolve_dependency(self, spec: str) -> str:
+        name = strip_version(spec)
+        if self.index.is_available(name):
+            return name
+        providers = self.index.providers(name)
+        return providers[0] if providers else None
+
+    def _expand(self, step: str, packages: list) -> None:
+        queue = deque(package for package in packages if package not in self.owner)
+        while queue:
+            package = queue.popleft()
+            if package in self.owner:
+                continue
+            self.owner[package] = step
+            for spec in self.index.get(package).depends:
+                dependency = self._resolve_dependency(spec)
+                if dependency is None:
+                    self.unresolved.setdefault(step, set()).add(spec)
+                elif dependency not in self.owner:
+                    queue.append(dependency)
+
+    def add(self, step: str, names) -> None:
+        """Add packages requested by `step`; only packages new to the closure are walked."""
+        self._add(step, names)
+        self._notify()
+
+    def _add(self, step: str, names) -> None:
+        names = [names] if isinstance(names, str) else list(names)
+        self.roots.setdefault(step, [])
+        resolved = []
+        for name in names:
+            if name in self.roots[step]:
+                continue
+            self.roots[step].append(name)
+            resolution = resolve_package_name(name, self.index)
+            if resolution.packages:
+                resolved.extend(resolution.packages)
+            else:
+                self.unresolved.setdefault(step, set()).add(name)
+        self._expand(step, resolved)
+
+    def replace(self, step: str, names) -> None:
+        """Swap the packages of one step (e.g. a different desktop) and recompute the closure."""
+        roots = dict(self.roots)
+        roots[step] = []
+        self.roots, self.owner, self.unresolved = {}, {}, {}
+        for existing_step, existing_names in roots.items():
+            self._add(existing_step, names if existing_step == step else existing_names)
+        self._notify()
+
+    @property
+    def packages(self) -> list:
+        return list(self.owner)
+
+    def summary(self) -> dict:
+        steps = {step: {'packages': 0, 'download': 0, 'installed': 0} for step in self.roots}
+        for package, step in self.owner.items():
+            metadata = self.index.get(package)
+            steps[step]['packages'] += 1
+            steps[step]['download'] += metadata.csize
+            steps[step]['installed'] += metadata.isize
+        return {
+            'packages': len(self.owner),
+            'download': sum(entry['download'] for entry in steps.values()),
+            'installed': sum(entry['installed'] for entry in steps.values()),
+            'steps': steps,
+            'unresolved': {step: sorted(names) for step, names in self.unresolved.items()},
+        }
+
+    def format_summary(self) -> list:
+        summary = self.summary()
+        lines = [
+            f"{summary['packages']} packages, {format_size(summary['download'])} to download, {format_size(summary['installed'])} installed",
+        ]
+        width = max((len(step) for step in summary['steps']), default=0)
+        for step, entry in summary['steps'].items():
+            if not entry['packages']:
+                continue
+            lines.append(
+                f"  {step:<{width}}  {entry['packages']:>5} pkgs  "
+                f"{format_size(entry['download']):>11} download  {format_size(entry['installed']):>11} installed"
+            )
+        for step, names in summary['unresolved'].items():
+            lines.append(f"  {step}: unresolved {', '.join(names)}")
+        return lines
+
+    def log_to(self, log: LogFile) -> None:
+        for line in self.format_summary():
+            log.info(f"Install preview: {line.strip()}")
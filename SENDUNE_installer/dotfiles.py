@@ -1,7 +1,8 @@
 from pathlib import Path
+from .chroot_session import chroot_session_for
+from .commands import run
 from .custom_classes import LogFile
 import os
-import subprocess
 
 
 def write_bashrc(user_home: Path, log: LogFile, mount_point: Path = None):
@@ -82,8 +83,9 @@ fi
             path_in_chroot = f"/home/{username}/.bashrc"
             
             try:
-                cmd = ["arch-chroot", str(mount_point), "chown", f"{username}:{username}", path_in_chroot]
-                subprocess.run(cmd, check=True)
+                result = chroot_session_for(mount_point, log).run(f"chown {username}:{username} {path_in_chroot}")
+                if result.returncode != 0:
+                    raise RuntimeError(result.output.strip() or f"exit code {result.returncode}")
                 log.info(f"Set ownership of .bashrc for {username}")
             except Exception as e:
                  log.warn(f"Failed to chown .bashrc via chroot: {e}")
@@ -125,12 +127,7 @@ def install_external_dotfiles(user_home: Path, log: LogFile, mount_point: Path):
         
         # 2. Clone repository silently
         if not repo_dir.exists():
-            subprocess.run(
-                ["git", "clone", "--depth", "1", repo_url, str(repo_dir)], 
-                check=True,
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.DEVNULL
-            )
+            run(["git", "clone", "--depth", "1", repo_url, str(repo_dir)], log, check=True)
             log.info("Dotfiles repository cloned.")
         
         # 3. Ensure ownership of cloned files using arch-chroot
@@ -138,13 +135,10 @@ def install_external_dotfiles(user_home: Path, log: LogFile, mount_point: Path):
             # Path inside chroot for Projects is /home/username/Projects
             path_in_chroot = f"/home/{username}/Projects"
             try:
-                cmd = ["arch-chroot", str(mount_point), "chown", "-R", f"{username}:{username}", path_in_chroot]
-                subprocess.run(
-                    cmd, 
-                    check=True,
-                    stdout=subprocess.DEVNULL,
-                    stderr=subprocess.DEVNULL
-                )
+                session = chroot_session_for(mount_point, log)
+                result = session.run(f"chown -R {username}:{username} {path_in_chroot} > /dev/null")
+                if result.returncode != 0:
+                    raise RuntimeError(result.output.strip() or f"exit code {result.returncode}")
                 log.info(f"Set ownership of Projects for {username}")
             except Exception as e:
                 log.warn(f"Failed to chown Projects via chroot: {e}")
@@ -0,0 +1,213 @@
+import hashlib
+import os
+import random
+import threading
+import time
+import urllib.request
+from dataclasses import dataclass
+from pathlib import Path
+
+from .custom_classes import LogFile
+
+DOWNLOAD_RETRIES = 4
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 8.0
+DOWNLOAD_TIMEOUT = 30
+CHUNK_SIZE = 256 * 1024
+# A transfer running longer than the grace period below this speed is aborted and its mirror dropped;
+# so is a mirror whose average over completed downloads falls below it once it has served enough.
+MIN_THROUGHPUT = 64 * 1024
+THROUGHPUT_GRACE = 4.0
+THROUGHPUT_SAMPLE = 2 * 1024 * 1024
+MAX_CONSECUTIVE_FAILURES = 3
+
+
+class DownloadCancelled(Exception):
+    pass
+
+
+class SlowMirror(Exception):
+    pass
+
+
+class DownloadFailed(Exception):
+    pass
+
+
+@dataclass
+class MirrorStats:
+    bytes: int = 0
+    seconds: float = 0.0
+    failures: int = 0
+    consecutive_failures: int = 0
+    blacklisted: str = ''
+
+    @property
+    def throughput(self) -> float:
+        return self.bytes / self.seconds if self.seconds else 0.0
+
+
+class MirrorPool():
+    """Ranked mirrors plus what this install has observed about them.
+
+    Mirrors that keep failing or turn out slow are moved behind the healthy ones; they are
+    only tried again when every other mirror has failed for a file.
+    """
+
+    def __init__(self, servers: list, log: LogFile, min_throughput: float = MIN_THROUGHPUT,
+                 max_failures: int = MAX_CONSECUTIVE_FAILURES, sample: int = THROUGHPUT_SAMPLE) -> None:
+        self.log = log
+        self.min_throughput = min_throughput
+        self.sample = sample
+        self.max_failures = max_failures
+        self._lock = threading.Lock()
+        self._servers = list(servers)
+        self.stats = {server: MirrorStats() for server in self._servers}
+
+    @property
+    def servers(self) -> list:
+        with self._lock:
+            return list(self._servers)
+
+    @servers.setter
+    def servers(self, servers: list) -> None:
+        with self._lock:
+            self._servers = list(servers)
+            for server in self._servers:
+                self.stats.setdefault(server, MirrorStats())
+
+    def __bool__(self) -> bool:
+        return bool(self._servers)
+
+    def candidates(self) -> list:
+        with self._lock:
+            healthy = [server for server in self._servers if not self.stats[server].blacklisted]
+            return healthy + [server for server in self._servers if self.stats[server].blacklisted]
+
+    def record_success(self, server: str, size: int, seconds: float) -> None:
+        with self._lock:
+            stats = self.stats[server]
+            stats.bytes += size
+            stats.seconds += seconds
+            stats.consecutive_failures = 0
+            slow = stats.bytes >= self.sample and stats.throughput < self.min_throughput
+        if slow:
+            self.blacklist(server, f"averaging {stats.throughput / 1024:.0f} KiB/s")
+
+    def record_failure(self, server: str, error: str) -> None:
+        with self._lock:
+            stats = self.stats[server]
+            stats.failures += 1
+            stats.consecutive_failures += 1
+            drop = stats.consecutive_failures >= self.max_failures and not stats.blacklisted
+            if drop:
+                stats.blacklisted = f"{stats.consecutive_failures} failures in a row, last: {error}"
+        if drop:
+            self.log.warn(f"Mirror {server} dropped: {stats.blacklisted}")
+
+    def blacklist(self, server: str, reason: str) -> None:
+        with self._lock:
+            stats = self.stats[server]
+            if stats.blacklisted:
+                return
+            stats.blacklisted = reason
+        self.log.warn(f"Mirror {server} dropped: {reason}")
+
+    def summary_lines(self) -> list:
+        lines = []
+        with self._lock:
+            for server in self._servers:
+                stats = self.stats[server]
+                line = (
+                    f"{server}: {stats.bytes // (1024 * 1024)} MiB at "
+                    f"{stats.throughput / (1024 * 1024):.1f} MiB/s, {stats.failures} failures"
+                )
+                if stats.blacklisted:
+                    line += f", dropped ({stats.blacklisted})"
+                lines.append(line)
+        return lines
+
+
+class Downloader():
+    """Fetch single files with per-file mirror failover and exponential backoff between rounds."""
+
+    def __init__(self, pool: MirrorPool, log: LogFile, retries: int = DOWNLOAD_RETRIES,
+                 backoff_base: float = BACKOFF_BASE, backoff_max: float = BACKOFF_MAX,
+                 timeout: float = DOWNLOAD_TIMEOUT, grace: float = THROUGHPUT_GRACE) -> None:
+        self.pool = pool
+        self.log = log
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self.grace = grace
+
+    def fetch(self, url_for, target: Path, sha256sum: str = '', cancelled=None) -> int:
+        """Download to `target` via the first mirror that works; `url_for(server)` builds the URL.
+
+        Every round tries each mirror once; between rounds the wait doubles (with jitter).
+        Returns the size written; raises DownloadFailed or DownloadCancelled.
+        """
+        cancelled = cancelled or (lambda: False)
+        partial = target.with_name(f"{target.name}.sendune-part")
+        errors = []
+        for attempt in range(self.retries):
+            if attempt:
+                delay = min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+                self.log.info(f"Retrying {target.name} in {delay:.1f}s (round {attempt + 1}/{self.retries})")
+                self._sleep(delay, cancelled)
+            for server in self.pool.candidates():
+                url = url_for(server)
+                try:
+                    size = self._fetch_once(server, url, partial, sha256sum, cancelled)
+                except DownloadCancelled:
+                    partial.unlink(missing_ok=True)
+                    raise
+                except SlowMirror as e:
+                    partial.unlink(missing_ok=True)
+                    self.pool.blacklist(server, str(e))
+                    errors.append(f"{url}: {e}")
+                    continue
+                except Exception as e:
+                    partial.unlink(missing_ok=True)
+                    self.pool.record_failure(server, str(e))
+                    errors.append(f"{url}: {e}")
+                    continue
+                os.replace(partial, target)
+                return size
+        raise DownloadFailed(errors[-1] if errors else 'no mirrors')
+
+    def _sleep(self, delay: float, cancelled) -> None:
+        deadline = time.monotonic() + delay
+        while time.monotonic() < deadline:
+            if cancelled():
+                raise DownloadCancelled
+            time.sleep(min(0.1, max(0.0, deadline - time.monotonic())))
+
+    def _fetch_once(self, server: str, url: str, partial: Path, sha256sum: str, cancelled) -> int:
+        digest = hashlib.sha256()
+        size = 0
+        started = time.monotonic()
+        partial.parent.mkdir(parents=True, exist_ok=True)
+        with urllib.request.urlopen(url, timeout=self.timeout) as response, partial.open('wb') as f:
+            length = response.headers.get('Content-Length', '')
+            while True:
+                if cancelled():
+                    raise DownloadCancelled
+                # read1 returns what has arrived, so a trickling mirror is caught at the grace period.
+                chunk = response.read1(CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+                elapsed = time.monotonic() - started
+                if elapsed > self.grace and size / elapsed < self.pool.min_throughput:
+                    raise SlowMirror(f"{size / elapsed / 1024:.0f} KiB/s after {elapsed:.0f}s")
+        # http.client ends a body cut short by the server like a complete one.
+        if length.isdigit() and size != int(length):
+            raise ConnectionError(f"connection closed after {size} of {length} bytes")
+        if sha256sum and digest.hexdigest() != sha256sum:
+            raise ValueError("sha256 mismatch")
+        self.pool.record_success(server, size, time.monotonic() - started)
+        return size
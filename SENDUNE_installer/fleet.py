@@ -0,0 +1,330 @@
+import copy
+import multiprocessing
+import os
+import queue
+import sys
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from .cache_server import use_cache_server
+from .chroot_session import close_chroot_sessions
+from .commands import CommandError, run
+from .custom_classes import TEXT, LogFile
+from .full_installation import LOGDIR, full_installation, install_stages, new_installer
+from .install_journal import LIVE_JOURNAL_DIR, STAGE_LISTENERS, InstallJournal
+from .installer_functions import MOCK_MODE
+from .mirrors import rank_mirrors, write_mirrorlist
+from .narchs_logos import ANSWER_LISTENERS, ANSWER_SOURCES, RGB3DLogo
+from .unattended import SENDUNE_KEY, answer_feed_from_config
+
+FLEET_MOUNT_ROOT = Path('/mnt/fleet')
+FLEET_JOURNAL_DIR = LIVE_JOURNAL_DIR / 'fleet'
+FLEET_LOG_DIR = LOGDIR.with_name('SENDUNE_fleet')
+# Sparse backing files for --fleet-loop test targets.
+LOOP_IMAGE_DIR = Path('/var/tmp/SENDUNE_fleet')
+LOOP_IMAGE_SIZE = 16 * 1024 ** 3
+ESP_SIZE = '+512M'
+PROGRESS_INTERVAL = 0.5
+
+
+class FleetError(Exception):
+    pass
+
+
+@dataclass
+class FleetTarget:
+    name: str
+    device: str
+    mount_point: Path
+    image: Path | None = None
+
+
+@dataclass
+class TargetProgress:
+    """What the parent knows about one worker, from the events it sent."""
+    target: FleetTarget
+    total: int
+    finished: set = field(default_factory=set)
+    running: list = field(default_factory=list)
+    started: float = field(default_factory=time.monotonic)
+    ended: float | None = None
+    status: str = 'waiting'
+    error: str = ''
+    transferred: int = 0
+
+    def state(self) -> tuple:
+        return (len(self.finished), self.status, tuple(self.running), self.error)
+
+    def line(self) -> str:
+        elapsed = (self.ended or time.monotonic()) - self.started if self.status != 'waiting' else 0
+        current = ', '.join(self.running) or ('' if self.status == 'waiting' else '-')
+        line = (
+            f"{self.target.name:<10} {self.target.device:<14} {len(self.finished):>3}/{self.total:<3} "
+            f"{self.status:<8} {int(elapsed) // 60:>3}:{int(elapsed) % 60:02d}  {current}"
+        )
+        if self.error:
+            line += f"  ({self.error})"
+        return line
+
+
+def parse_targets(specs: list) -> list:
+    """`DEVICE[:MOUNT]` specs as FleetTargets; the mount point defaults to /mnt/fleet/<device name>."""
+    targets = []
+    for spec in specs:
+        device, _, mount_point = spec.partition(':')
+        name = Path(device).name
+        if any(target.name == name for target in targets):
+            raise FleetError(f"Device {device} given twice")
+        targets.append(FleetTarget(name, device, Path(mount_point) if mount_point else FLEET_MOUNT_ROOT / name))
+    return targets
+
+
+def partition_path(device: str, number: int) -> str:
+    # /dev/sda -> /dev/sda1, but /dev/nvme0n1 and /dev/loop0 -> ...p1
+    return f"{device}p{number}" if device[-1].isdigit() else f"{device}{number}"
+
+
+def run_tool(command: list, log: LogFile) -> str:
+    """Run a disk tool; raise FleetError with its stderr when it fails."""
+    try:
+        return run(command, log, check=True).stdout
+    except CommandError as e:
+        raise FleetError(str(e)) from e
+
+
+def create_loop_targets(count: int, log: LogFile, size: int = LOOP_IMAGE_SIZE,
+                        image_dir: Path = LOOP_IMAGE_DIR) -> list:
+    """Attach `count` loop devices backed by sparse files, for testing fleet installs on one box."""
+    image_dir.mkdir(parents=True, exist_ok=True)
+    targets = []
+    for number in range(count):
+        image = image_dir / f"target{number}.img"
+        with image.open('wb') as f:
+            f.truncate(size)
+        device = run_tool(['losetup', '--find', '--show', '--partscan', str(image)], log).strip()
+        name = Path(device).name
+        targets.append(FleetTarget(name, device, FLEET_MOUNT_ROOT / name, image))
+        log.info(f"Loop target {device} backed by {image} ({size // 1024 ** 3} GiB sparse)")
+    return targets
+
+
+def detach_loop_targets(targets: list, log: LogFile) -> None:
+    for target in targets:
+        if target.image is None:
+            continue
+        run(['umount', '-R', str(target.mount_point)])
+        run(['losetup', '-d', target.device])
+        log.info(f"Detached {target.device}")
+
+
+def mount_existing(target: FleetTarget, log: LogFile) -> bool:
+    """Mount the partitions a previous fleet run created; False if there are none."""
+    if os.path.ismount(target.mount_point):
+        return True
+    target.mount_point.mkdir(parents=True, exist_ok=True)
+    if run(['mount', partition_path(target.device, 2), str(target.mount_point)]).returncode != 0:
+        return False
+    (target.mount_point / 'boot').mkdir(exist_ok=True)
+    run(['mount', partition_path(target.device, 1), str(target.mount_point / 'boot')], log)
+    log.info(f"Mounted the existing partitions of {target.device} at {target.mount_point}")
+    return True
+
+
+def partition_target(target: FleetTarget, log: LogFile, esp_size: str = ESP_SIZE) -> None:
+    """Wipe `target.device` and create an ESP (partition 1) and a root partition (2) on it."""
+    run(['umount', '-R', str(target.mount_point)])
+    mounted = run_tool(['lsblk', '-nro', 'MOUNTPOINT', target.device], log).split()
+    if mounted:
+        raise FleetError(f"{target.device} is in use (mounted at {', '.join(mounted)}); refusing to wipe it")
+    run_tool(['wipefs', '--all', target.device], log)
+    run_tool(['sgdisk', '--zap-all', target.device], log)
+    run_tool(['sgdisk', '-n', f'1:0:{esp_size}', '-t', '1:ef00', '-n', '2:0:0', '-t', '2:8300', target.device], log)
+    run_tool(['partprobe', target.device], log)
+    run_tool(['udevadm', 'settle'], log)
+
+
+def prepare_target(target: FleetTarget, log: LogFile) -> None:
+    """Partition `target.device`, format and mount it."""
+    partition_target(target, log)
+    run_tool(['mkfs.fat', '-F', '32', partition_path(target.device, 1)], log)
+    run_tool(['mkfs.ext4', '-F', '-q', partition_path(target.device, 2)], log)
+    target.mount_point.mkdir(parents=True, exist_ok=True)
+    run_tool(['mount', partition_path(target.device, 2), str(target.mount_point)], log)
+    (target.mount_point / 'boot').mkdir(exist_ok=True)
+    run_tool(['mount', partition_path(target.device, 1), str(target.mount_point / 'boot')], log)
+    log.info(f"Partitioned {target.device} and mounted it at {target.mount_point}")
+
+
+def open_target_journal(target: FleetTarget, config: dict, log: LogFile) -> InstallJournal:
+    """Resume the target's previous run if the config allows it, else start it from a blank disk."""
+    resume = config.get(SENDUNE_KEY, {}).get('resume', True)
+    if not MOCK_MODE and resume:
+        mount_existing(target, log)
+    journal = InstallJournal.open(log, FLEET_JOURNAL_DIR / target.name)
+    if journal.resumable and resume:
+        log.info(f"Resuming {target.name} after {len(journal.completed())} completed stages")
+        return journal
+    journal.discard()
+    if MOCK_MODE:
+        log.info(f"[MOCK] Would partition {target.device} and mount it at {target.mount_point}")
+    else:
+        prepare_target(target, log)
+    return journal
+
+
+def run_fleet_worker(target: FleetTarget, config: dict, events, log_format: str = TEXT) -> None:
+    """Install one target; runs in its own process and reports to the parent through `events`."""
+    FLEET_LOG_DIR.mkdir(parents=True, exist_ok=True)
+    # The stage output would garble the progress view; each worker gets its own console file.
+    sys.stdout = sys.stderr = (FLEET_LOG_DIR / f"{target.name}.console").open('a', buffering=1, encoding='utf-8')
+    log = LogFile(FLEET_LOG_DIR / f"{target.name}.log", log_format)
+    log.info(f"Fleet worker {os.getpid()} installing {target.device} at {target.mount_point}")
+    STAGE_LISTENERS.append(lambda name, status: events.put((target.name, 'stage', name, status)))
+    installer = None
+    try:
+        journal = open_target_journal(target, config, log)
+        installer = new_installer(target.mount_point, log)
+        installer.journal = journal
+        installer.install_config = config
+        answer_feed = answer_feed_from_config(config)
+        answer_feed.bind(installer)
+        for warning in answer_feed.warnings:
+            log.warn(f"Unattended config: {warning}")
+        ANSWER_SOURCES.append(answer_feed)
+        ANSWER_LISTENERS.append(journal.record_answer)
+        full_installation(installer, log, RGB3DLogo())
+        events.put((target.name, 'done', '', downloaded_bytes(installer)))
+    except BaseException as e:
+        log.error(f"Fleet install of {target.device} failed: {e}")
+        events.put((target.name, 'failed', str(e) or type(e).__name__, downloaded_bytes(installer)))
+    finally:
+        close_chroot_sessions()
+        log.close()
+
+
+def downloaded_bytes(installer) -> int:
+    mirror_pool = getattr(installer, 'mirror_pool', None)
+    return sum(stats.bytes for stats in mirror_pool.stats.values()) if mirror_pool is not None else 0
+
+
+class FleetProgress():
+    """One line per target, redrawn in place on a terminal and printed on change otherwise."""
+
+    def __init__(self, targets: list, total: int, stream=None) -> None:
+        self.stream = stream or sys.stdout
+        self.targets = {target.name: TargetProgress(target, total) for target in targets}
+        self._drawn = 0
+        self._states = {}
+
+    def update(self, event: tuple) -> None:
+        name, kind, *payload = event
+        progress = self.targets[name]
+        if kind == 'stage':
+            stage, status = payload
+            progress.status = 'running'
+            if status == 'running':
+                progress.running.append(stage)
+            else:
+                if stage in progress.running:
+                    progress.running.remove(stage)
+                if status in ('done', 'skipped'):
+                    progress.finished.add(stage)
+        else:
+            progress.error, progress.transferred = payload
+            progress.status = kind
+            progress.running = []
+            progress.ended = time.monotonic()
+
+    def started(self, name: str) -> None:
+        progress = self.targets[name]
+        progress.status, progress.started = 'starting', time.monotonic()
+
+    def render(self) -> None:
+        if self.stream.isatty():
+            lines = [progress.line() for progress in self.targets.values()]
+            self.stream.write("\033[1A\033[2K" * self._drawn + '\n'.join(lines) + '\n')
+            self._drawn = len(lines)
+        else:
+            for name, progress in self.targets.items():
+                if self._states.get(name) != progress.state():
+                    self._states[name] = progress.state()
+                    self.stream.write(progress.line() + '\n')
+        self.stream.flush()
+
+    def summary_lines(self) -> list:
+        downloaded = sum(progress.transferred for progress in self.targets.values())
+        failed = [progress for progress in self.targets.values() if progress.status != 'done']
+        lines = [
+            f"{len(self.targets) - len(failed)}/{len(self.targets)} targets installed, {downloaded / 1024 ** 2:.0f} MiB downloaded from mirrors for all of them"
+        ]
+        lines += [f"{progress.target.name}: {progress.error or progress.status}" for progress in failed]
+        return lines
+
+
+def worker_config(config: dict) -> dict:
+    """The config as workers get it: mirrors are ranked once by the parent, not once per target."""
+    config = copy.deepcopy(config)
+    config.setdefault(SENDUNE_KEY, {})['rank_mirrors'] = False
+    return config
+
+
+def run_fleet(targets: list, config: dict, log: LogFile, max_parallel: int | None = None,
+              cache_server_url: str | None = None) -> bool:
+    """Install every target in its own worker process; return True if all of them succeeded.
+
+    The workers share the live host's package cache, where a per-file lock makes each
+    package download once however many targets need it.
+    """
+    if config.get(SENDUNE_KEY, {}).get('rank_mirrors', True) and not MOCK_MODE:
+        print("Ranking mirrors once for all targets...")
+        ranking = rank_mirrors(log)
+        if not write_mirrorlist(ranking):
+            log.warn("Mirror ranking found no reachable mirror; keeping the current mirrorlist.")
+    if cache_server_url and not MOCK_MODE:
+        use_cache_server(cache_server_url, log)
+
+    # spawn, not fork: the parent may hold threads (mirror probes) and the workers must not inherit locks.
+    context = multiprocessing.get_context('spawn')
+    events = context.Queue()
+    progress = FleetProgress(targets, len(install_stages()))
+    pending = list(targets)
+    running = {}
+    max_parallel = max_parallel or len(targets)
+    shared_config = worker_config(config)
+    log.info(f"Fleet install of {len(targets)} targets, {max_parallel} at a time")
+
+    while pending or running:
+        while pending and len(running) < max_parallel:
+            target = pending.pop(0)
+            process = context.Process(
+                target=run_fleet_worker,
+                args=(target, shared_config, events, log.log_format),
+                name=f"fleet-{target.name}"
+            )
+            process.start()
+            running[target.name] = process
+            progress.started(target.name)
+            log.info(f"Started worker {process.pid} for {target.device}")
+        # Collected before draining, so the last events of an exited worker are already queued.
+        exited = [name for name, process in running.items() if not process.is_alive()]
+        try:
+            progress.update(events.get(timeout=PROGRESS_INTERVAL))
+            while True:
+                progress.update(events.get_nowait())
+        except queue.Empty:
+            pass
+        for name in exited:
+            process = running[name]
+            process.join()
+            running.pop(name)
+            if progress.targets[name].status not in ('done', 'failed'):
+                progress.update((name, 'failed', f"worker exited with code {process.exitcode}", 0))
+            log.info(f"Worker for {name} finished: {progress.targets[name].status}")
+        progress.render()
+
+    for line in progress.summary_lines():
+        log.info(line)
+        print(line)
+    print(f"Per-target logs: {FLEET_LOG_DIR}")
+    return all(target.status == 'done' for target in progress.targets.values())
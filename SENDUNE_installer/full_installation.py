@@ -1,11 +1,18 @@
 #!/usr/bin/env python3
 import os
 import shutil
-import subprocess
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
-from .custom_classes import LogFile
+from .aur_builder import AUR_CACHE_DIR, build_aur_packages
+from .cache_server import use_cache_server
+from .chroot_session import arch_chroot, close_chroot_sessions
+from .commands import command_summary_lines, run, run_shell
+from .custom_classes import TEXT, LogFile
+from .dependency_closure import DependencyClosure
+from .downloader import Downloader, MirrorPool
 from .dotfiles import install_external_dotfiles, write_bashrc
 from .installer_functions import (
     CUSTOM_COMMANDS,
@@ -43,7 +50,24 @@ from .installer_functions import (
     run_command,
     sync_live_system_time,
 )
-from .narchs_logos import RGB3DLogo
+from .install_journal import LIVE_JOURNAL_DIR, InstallJournal, Stage
+from .mirrors import write_mirrorlist
+from .narchs_logos import ANSWER_LISTENERS, ANSWER_SOURCES, RGB3DLogo
+from .package_index import (
+    OFFLINE_REPO_DB,
+    OFFLINE_REPO_DIR,
+    OFFLINE_REPO_NAME,
+    PACMAN_CONF,
+    get_package_index,
+    read_sync_db,
+)
+from .package_cache import open_package_cache
+from .package_prefetch import PACMAN_CACHE_DIR, PackagePrefetcher, download_packages, read_mirrorlist
+from .package_resolver import resolve_package_names
+from .stage_scheduler import run_stage_graph
+from .systemd_units import enable_units
+from .tracing import DOWNLOAD, PACSTRAP, STEP, TRACER, trace_path, trace_span
+from .unattended import ConfigError, answer_feed_from_config, config_packages_and_services, load_install_config
 
 try:
     from archinstall.lib.args import arch_config_handler
@@ -78,6 +102,21 @@ BASE_PACKAGES = [
     'stow'
 ]
 
+PREFETCH_FINISH_TIMEOUT = 120
+# A failed pacstrap re-downloads whatever is missing (skipping dropped mirrors) and runs again.
+PACSTRAP_ATTEMPTS = 2
+PACSTRAP_RETRY_DELAY = 5
+# Start pacstrap of BASE_PACKAGES as soon as the disks are mounted, and install the
+# packages chosen later as a second transaction.
+TWO_PHASE_INSTALL = True
+# Local repo of AUR packages built by build_arch_iso.sh, installed with pacman -U.
+PREBUILT_AUR_REPO = Path('/opt/sendune/repo')
+PREBUILT_AUR_DB = 'sendune-aur'
+# pacman.conf files generated for pacstrap when the ISO carries an offline repo.
+PACSTRAP_CONFIG_DIR = Path('/run/SENDUNE_installer')
+MOCK_JOURNAL_DIR = Path('MOCK_RUN')
+DEFAULT_HOSTNAME = 'sendune'
+
 DESKTOP_PACKAGES = [
     'hyprland',
     'wayland',
@@ -147,40 +186,110 @@ def unique_items(items):
     return ordered
 
 
-def package_is_available(package: str) -> bool:
-    result = subprocess.run(
-        ['pacman', '-Si', package],
-        stdout=subprocess.DEVNULL,
-        stderr=subprocess.DEVNULL,
-        check=False
-    )
-    return result.returncode == 0
+def package_is_available(package: str, log: LogFile | None = None) -> bool:
+    index = get_package_index(log)
+    if len(index):
+        return index.is_available(package)
+
+    # No readable sync databases (e.g. before the first `pacman -Sy`): ask pacman directly.
+    return run(['pacman', '-Si', package]).returncode == 0
 
 
-def filter_installable_packages(packages, log: LogFile):
+def filter_installable_packages(packages, log: LogFile, skipped: list | None = None):
+    """Return the repo-installable packages; names no repo has are appended to `skipped`."""
+    skipped = [] if skipped is None else skipped
+    index = get_package_index(log)
+    if len(index):
+        report = resolve_package_names(packages, index, log)
+        report.log_to(log)
+        skipped.extend(report.unresolved)
+        lines = report.format_lines()
+        if lines:
+            print("Package name resolution:")
+            for line in lines:
+                print(f"  {line}")
+        return report.packages
+
     installable = []
-    skipped = []
-    for package in unique_items(packages):
-        if package_is_available(package):
+    unavailable = []
+    for package in unique_items(package.strip() for package in packages):
+        if package_is_available(package, log):
             installable.append(package)
         else:
-            skipped.append(package)
+            unavailable.append(package)
 
-    if skipped:
-        log.warn(f"Skipping unavailable packages: {', '.join(skipped)}")
-        print("Skipping unavailable packages: " + ", ".join(skipped))
+    if unavailable:
+        skipped.extend(unavailable)
+        log.warn(f"Skipping unavailable packages: {', '.join(unavailable)}")
+        print("Skipping unavailable packages: " + ", ".join(unavailable))
 
     return installable
 
 
-def arch_chroot(installer, command: str, log: LogFile):
-    result = subprocess.run(
-        ['arch-chroot', str(installer.mount_point), '/bin/bash', '-lc', command],
-        check=False
-    )
-    if result.returncode != 0:
-        log.warn(f"arch-chroot command failed: {command}")
-    return result.returncode
+def attach_package_closure(installer, log: LogFile):
+    """Start the dependency closure with the base and default desktop sets."""
+    installer.package_closure = DependencyClosure(get_package_index(log))
+    installer.package_closure.add('base', BASE_PACKAGES)
+    installer.package_closure.add('desktop', installer.desktop_packages)
+
+
+def attach_package_cache(installer, log: LogFile):
+    """Use the persistent cache on the install stick, if it has one, for every package download."""
+    installer.package_cache = None if MOCK_MODE else open_package_cache(log)
+    if installer.package_cache is not None:
+        print(f"Using the package cache on the install media ({installer.package_cache.root}).")
+
+
+def cachedir_args(installer) -> list:
+    package_cache = getattr(installer, 'package_cache', None)
+    return package_cache.cachedir_args() if package_cache is not None else []
+
+
+def release_package_cache(installer, packages, log: LogFile):
+    """Mark the installed packages as recently used, evict past the size limit and sync the stick."""
+    package_cache = getattr(installer, 'package_cache', None)
+    if package_cache is None:
+        return
+    index = get_package_index(log)
+    closure = getattr(installer, 'package_closure', None)
+    names = closure.packages if closure is not None and len(closure.index) else packages
+    package_cache.touch(index.get(name).filename for name in names if index.get(name))
+    package_cache.flush()
+
+
+def refresh_mirrors(installer, log: LogFile):
+    """Re-apply the LAN cache server and hand the (possibly re-ranked) mirrorlist to the prefetcher."""
+    cache_server_url = getattr(installer, 'cache_server_url', None)
+    if cache_server_url and not MOCK_MODE:
+        use_cache_server(cache_server_url, log)
+    mirror_pool = getattr(installer, 'mirror_pool', None)
+    if mirror_pool is not None:
+        mirror_pool.servers = read_mirrorlist() or mirror_pool.servers
+
+
+def package_cache_dir(installer) -> Path:
+    package_cache = getattr(installer, 'package_cache', None)
+    return package_cache.package_dir if package_cache is not None else PACMAN_CACHE_DIR
+
+
+def attach_downloader(installer, log: LogFile):
+    """One mirror pool for the whole install, so a mirror dropped by the prefetcher stays dropped."""
+    installer.mirror_pool = MirrorPool(read_mirrorlist(), log)
+    installer.downloader = Downloader(installer.mirror_pool, log)
+
+
+def attach_prefetcher(installer, log: LogFile):
+    """Download the selection into the host pacman cache while the wizard keeps asking questions."""
+    closure = installer.package_closure
+    if MOCK_MODE or not len(closure.index):
+        return
+    prefetcher = PackagePrefetcher(closure.index, log, package_cache_dir(installer), installer.downloader)
+    if not prefetcher.mirrors:
+        log.warn("No mirrors configured; package prefetch disabled.")
+        return
+    installer.prefetcher = prefetcher
+    closure.listeners.append(prefetcher.sync)
+    prefetcher.sync(closure.packages)
 
 
 def define_installer(mount_point, log: LogFile):
@@ -199,6 +308,10 @@ def define_installer(mount_point, log: LogFile):
     installer.selected_locale = 'en_US.UTF-8'
     installer.selected_timezone = 'America/New_York'
     installer.selected_keymap = 'us'
+    attach_package_closure(installer, log)
+    attach_package_cache(installer, log)
+    attach_downloader(installer, log)
+    attach_prefetcher(installer, log)
 
     original_add_packages = installer.add_additional_packages
     original_enable_service = installer.enable_service
@@ -209,6 +322,7 @@ def define_installer(mount_point, log: LogFile):
         for package in normalized:
             if package not in installer.additional_packages:
                 installer.additional_packages.append(package)
+        installer.package_closure.add(getattr(installer, 'current_step', None) or 'additional', normalized)
         return original_add_packages(packages)
 
     def tracked_enable_service(services):
@@ -231,26 +345,220 @@ def define_installer(mount_point, log: LogFile):
     return installer
 
 
+def new_installer(mount_point, log: LogFile):
+    if not MOCK_MODE:
+        return define_installer(mount_point, log)
+    log.info("[MOCK] Initializing Mock Installer")
+    installer = MockInstaller(mount_point=mount_point, base_packages=BASE_PACKAGES)
+    installer.desktop_packages = list(DESKTOP_PACKAGES)
+    installer.selected_locale = 'en_US.UTF-8'
+    installer.selected_timezone = 'America/New_York'
+    installer.selected_keymap = 'us'
+    return installer
+
+
+def offline_repo_section() -> str:
+    # The offline repo db is unsigned; the packages are checked against its sha256 sums.
+    return (
+        f"[{OFFLINE_REPO_NAME}]\n"
+        "SigLevel = Optional TrustAll\n"
+        f"Server = {OFFLINE_REPO_DIR.as_uri()}\n\n"
+    )
+
+
+def pacstrap_config_args(packages, log: LogFile, phase: str) -> list:
+    """Return `-C <conf>` putting the ISO's offline repo first, or [] when there is none.
+
+    If the offline repo holds the whole dependency closure of `packages`, the generated
+    config lists only that repo, so the install needs no network at all.
+    """
+    if MOCK_MODE or not OFFLINE_REPO_DB.exists():
+        return []
+    try:
+        offline = {package.name for package in read_sync_db(OFFLINE_REPO_DB, repo=OFFLINE_REPO_NAME)}
+        closure = DependencyClosure(get_package_index(log))
+        closure.add(phase, packages)
+        offline_only = not closure.unresolved and set(closure.packages) <= offline
+        host_config = PACMAN_CONF.read_text(encoding='utf-8')
+    except Exception as e:
+        log.warn(f"Offline repo present but unusable, installing from mirrors: {e}")
+        return []
+
+    # Everything up to the first repo section ([options] and comments) is kept as is.
+    lines = host_config.splitlines(keepends=True)
+    first_repo = next(
+        (number for number, line in enumerate(lines)
+         if line.strip().startswith('[') and line.strip() != '[options]'),
+        len(lines)
+    )
+    options, repos = ''.join(lines[:first_repo]), ''.join(lines[first_repo:])
+    config = options.rstrip('\n') + '\n\n' + offline_repo_section() + ('' if offline_only else repos)
+
+    PACSTRAP_CONFIG_DIR.mkdir(parents=True, exist_ok=True)
+    # Per process: fleet workers install different selections side by side.
+    config_path = PACSTRAP_CONFIG_DIR / f'pacman.{phase}.{os.getpid()}.conf'
+    config_path.write_text(config, encoding='utf-8')
+    if offline_only:
+        log.info(f"Offline repo covers all {len(closure.packages)} {phase} packages; installing without mirrors.")
+    else:
+        missing = sorted(set(closure.packages) - offline)
+        log.info(
+            f"Offline repo preferred for {phase}; {len(missing)} packages come from mirrors: {', '.join(missing[:20])}"
+        )
+    return ['-C', str(config_path)]
+
+
+def predownload_packages(installer, packages, log: LogFile, phase: str) -> dict:
+    """Put the dependency closure of `packages` in the cache before pacstrap asks for it.
+
+    Each file is retried with backoff and fails over to the next-ranked mirror, so one flaky
+    mirror costs seconds here instead of a failed pacstrap. Returns {package: error}.
+    """
+    downloader = getattr(installer, 'downloader', None)
+    if MOCK_MODE or downloader is None or not downloader.pool:
+        return {}
+    index = get_package_index(log)
+    if not len(index):
+        return {}
+    closure = DependencyClosure(index)
+    closure.add(phase, packages)
+    return download_packages(index, closure.packages, downloader, log, package_cache_dir(installer))
+
+
+def run_pacstrap(installer, command: list, packages, log: LogFile, phase: str,
+                 output: LogFile | None = None, echo: bool = True) -> int:
+    """Pre-download, then pacstrap; a failure is retried after another download round.
+
+    pacstrap's output goes to `output` (default: `log`) and, with `echo`, the terminal.
+    """
+    for attempt in range(1, PACSTRAP_ATTEMPTS + 1):
+        with trace_span(f'predownload {phase}', DOWNLOAD, attempt=attempt):
+            failed = predownload_packages(installer, packages, log, phase)
+        if failed:
+            log.warn(f"{len(failed)} {phase} packages could not be pre-downloaded; pacstrap will try its mirrors")
+        with trace_span(f'pacstrap {phase}', PACSTRAP, attempt=attempt, packages=len(packages)):
+            returncode = run(command, log, output=output, echo=echo).returncode
+        if returncode == 0 or attempt == PACSTRAP_ATTEMPTS:
+            break
+        log.warn(f"pacstrap ({phase}) exited with {returncode}; retrying in {PACSTRAP_RETRY_DELAY}s")
+        time.sleep(PACSTRAP_RETRY_DELAY)
+    mirror_pool = getattr(installer, 'mirror_pool', None)
+    if mirror_pool is not None:
+        for line in mirror_pool.summary_lines():
+            log.info(f"Mirror stats: {line}")
+    return returncode
+
+
+def start_base_install(installer, log: LogFile):
+    """Phase one of a two-phase install: pacstrap BASE_PACKAGES in the background.
+
+    Nothing asked after disk setup changes the base set, so it can install while the
+    operator is still answering the remaining wizard steps.
+    """
+    mount_point = Path(installer.mount_point)
+    packages = filter_installable_packages(BASE_PACKAGES, log)
+    if not packages:
+        return
+
+    closure = getattr(installer, 'package_closure', None)
+    prefetcher = getattr(installer, 'prefetcher', None)
+    if closure is not None and prefetcher is not None:
+        # pacstrap downloads these itself now; only prefetch what the later steps add.
+        prefetcher.exclude(package for package, step in closure.owner.items() if step == 'base')
+
+    output_path = log.path.with_name(f'{log.path.stem}.base-pacstrap.log')
+    config_args = pacstrap_config_args(packages, log, 'base')
+
+    def run_base_pacstrap():
+        # Keep pacstrap's progress output off the terminal the wizard is drawing on.
+        output = LogFile(output_path, log.log_format)
+        try:
+            return run_pacstrap(
+                installer,
+                ['pacstrap', *config_args, '-c', '-K', str(mount_point), *cachedir_args(installer), *packages],
+                packages,
+                log,
+                'base',
+                output=output,
+                echo=False
+            )
+        finally:
+            output.close()
+
+    installer.base_install_packages = packages
+    installer.base_install = ThreadPoolExecutor(max_workers=1, thread_name_prefix='base-pacstrap').submit(run_base_pacstrap)
+    log.info(f"Base install started in the background ({len(packages)} packages, output in {output_path})")
+
+
 def install_target_system(installer, log: LogFile):
+    print("\n Installing Arch base system and SENDUNE packages to target disk...")
     mount_point = Path(installer.mount_point)
+    # Names no sync repo knows are candidates for the AUR build stage.
+    installer.aur_candidates = []
     packages = filter_installable_packages(
         BASE_PACKAGES + getattr(installer, 'desktop_packages', []) + getattr(installer, 'additional_packages', []),
-        log
+        log,
+        installer.aur_candidates
     )
     if not packages:
         raise RuntimeError("No installable packages were selected for the target system.")
 
-    result = subprocess.run(['pacstrap', '-K', str(mount_point), *packages], check=False)
-    if result.returncode != 0:
-        raise RuntimeError("pacstrap failed while installing the target system")
-
-    subprocess.run(
-        ['bash', '-lc', f'genfstab -U {mount_point} >> {mount_point}/etc/fstab'],
-        check=True
-    )
+    closure = getattr(installer, 'package_closure', None)
+    if closure is not None and len(closure.index):
+        closure.log_to(log)
+        print("\nInstall preview:")
+        for line in closure.format_summary():
+            print(f"  {line}")
+
+    prefetcher = getattr(installer, 'prefetcher', None)
+    if prefetcher is not None:
+        print("Waiting for in-flight package prefetches...")
+        prefetcher.finish(timeout=PREFETCH_FINISH_TIMEOUT)
+
+    base_install = getattr(installer, 'base_install', None)
+    if base_install is not None:
+        print("Waiting for the background base install to finish...")
+        returncode = base_install.result()
+        # A retry of this stage must not wait on the same finished job again.
+        installer.base_install = None
+        if returncode != 0:
+            raise RuntimeError("pacstrap failed while installing the base system")
+        log.info("Background base install finished.")
+        installer.base_installed = True
+    if getattr(installer, 'base_installed', False):
+        # Phase two: one incremental transaction on top of the finished base.
+        phase = 'selection'
+        phase_packages = [package for package in packages if package not in installer.base_install_packages]
+        config_args = pacstrap_config_args(phase_packages, log, phase)
+        command = [
+            'pacstrap', *config_args, '-c', str(mount_point), '--needed', *cachedir_args(installer), *phase_packages
+        ] if phase_packages else None
+    else:
+        # -c: use the host cache the prefetcher filled instead of the target's empty one.
+        phase = 'full'
+        phase_packages = packages
+        config_args = pacstrap_config_args(packages, log, phase)
+        command = ['pacstrap', *config_args, '-c', '-K', str(mount_point), *cachedir_args(installer), *packages]
+
+    if command:
+        if run_pacstrap(installer, command, phase_packages, log, phase) != 0:
+            raise RuntimeError("pacstrap failed while installing the target system")
+    release_package_cache(installer, packages, log)
+
+    run_shell(f'genfstab -U {mount_point} >> {mount_point}/etc/fstab', log, check=True)
     log.info("Base Arch system installed successfully.")
 
 
+def write_target_mirrorlist(installer, log: LogFile):
+    """Give the installed system the ranked mirrors rather than the live one's (LAN cache, offline repo)."""
+    ranking = getattr(installer, 'mirror_ranking', None)
+    if not ranking or MOCK_MODE:
+        return
+    target = Path(installer.mount_point) / 'etc' / 'pacman.d' / 'mirrorlist'
+    if write_mirrorlist(ranking, target):
+        log.info(f"Ranked mirrorlist written to {target}")
+
+
 def configure_target_locale_and_timezone(installer, log: LogFile):
     mount_point = Path(installer.mount_point)
     locale = getattr(installer, 'selected_locale', 'en_US.UTF-8')
@@ -274,6 +582,14 @@ def configure_target_locale_and_timezone(installer, log: LogFile):
     arch_chroot(installer, 'hwclock --systohc', log)
 
 
+def write_hostname(root: Path, hostname: str):
+    (root / 'etc' / 'hostname').write_text(f'{hostname}\n', encoding='utf-8')
+    (root / 'etc' / 'hosts').write_text(
+        f'127.0.0.1 localhost\n::1 localhost\n127.0.1.1 {hostname}.localdomain {hostname}\n',
+        encoding='utf-8'
+    )
+
+
 def apply_sendune_branding(installer, log: LogFile):
     mount_point = Path(installer.mount_point)
     asset_dir = Path(__file__).parent / 'assets'
@@ -299,11 +615,7 @@ def apply_sendune_branding(installer, log: LogFile):
         encoding='utf-8'
     )
     (mount_point / 'etc' / 'issue').write_text('SENDUNE Linux \\r (\\l)\n\n', encoding='utf-8')
-    (mount_point / 'etc' / 'hostname').write_text('sendune\n', encoding='utf-8')
-    (mount_point / 'etc' / 'hosts').write_text(
-        '127.0.0.1 localhost\n::1 localhost\n127.0.1.1 sendune.localdomain sendune\n',
-        encoding='utf-8'
-    )
+    write_hostname(mount_point, getattr(installer, 'hostname', DEFAULT_HOSTNAME))
 
     grub_file = mount_point / 'etc' / 'default' / 'grub'
     if grub_file.exists():
@@ -323,8 +635,50 @@ def apply_sendune_branding(installer, log: LogFile):
 
 
 def enable_target_services(installer, log: LogFile):
-    for service in unique_items(getattr(installer, 'services', [])):
-        arch_chroot(installer, f'systemctl enable {service}', log)
+    services = unique_items(getattr(installer, 'services', []))
+    if MOCK_MODE:
+        log.info(f"[MOCK] Would enable services in the target system: {', '.join(services)}")
+        return
+
+    report = enable_units(installer.mount_point, services, log)
+    if report.missing:
+        print(f" Skipped services not installed in the target: {', '.join(report.missing)}")
+
+
+def prebuilt_aur_packages(repo_dir: Path = PREBUILT_AUR_REPO) -> dict:
+    """Map package name -> metadata for the prebuilt AUR packages shipped on the ISO."""
+    db_path = repo_dir / f'{PREBUILT_AUR_DB}.db'
+    if not db_path.exists():
+        return {}
+    return {
+        package.name: package
+        for package in read_sync_db(db_path, repo=PREBUILT_AUR_DB)
+        if package.filename and (repo_dir / package.filename).exists()
+    }
+
+
+def install_prebuilt_aur_packages(installer, log: LogFile) -> list:
+    """Install every package of the ISO's AUR repo into the target; return the installed names."""
+    try:
+        prebuilt = prebuilt_aur_packages()
+    except Exception as e:
+        log.warn(f"Could not read the prebuilt AUR repo: {e}")
+        return []
+    if not prebuilt:
+        log.info(f"No prebuilt AUR packages found in {PREBUILT_AUR_REPO}.")
+        return []
+
+    cache_dir = Path(installer.mount_point) / 'var' / 'cache' / 'pacman' / 'pkg'
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    for package in prebuilt.values():
+        shutil.copy2(PREBUILT_AUR_REPO / package.filename, cache_dir / package.filename)
+
+    files = ' '.join(f'/var/cache/pacman/pkg/{package.filename}' for package in prebuilt.values())
+    if arch_chroot(installer, f'pacman -U --noconfirm --needed {files}', log) != 0:
+        log.warn("Installing the prebuilt AUR packages failed.")
+        return []
+    log.info(f"Installed prebuilt AUR packages: {', '.join(prebuilt)}")
+    return list(prebuilt)
 
 
 def install_yay_in_target(installer, log: LogFile):
@@ -332,7 +686,11 @@ def install_yay_in_target(installer, log: LogFile):
         log.info("[MOCK] Would build and install yay in the target system.")
         return
 
-    log.info("Building yay inside the target system.")
+    if 'yay' in install_prebuilt_aur_packages(installer, log):
+        log.info("yay installed in the target system from the prebuilt package.")
+        return
+
+    log.info("No prebuilt yay package; building yay inside the target system.")
     commands = [
         "useradd -m -s /bin/bash aurbuilder || true",
         "echo 'aurbuilder ALL=(ALL) NOPASSWD: ALL' > /etc/sudoers.d/aurbuilder",
@@ -348,77 +706,165 @@ def install_yay_in_target(installer, log: LogFile):
     log.info("yay installed in the target system.")
 
 
-def full_installation(installer, log: LogFile, logo_animation: RGB3DLogo):
-    logo_animation.clear_content_area()
-    interactive_find_mirrors(installer, log, logo_animation)
-    logo_animation.clear_content_area()
-    interactive_disk_format(installer, log, logo_animation)
-    logo_animation.clear_content_area()
-    interactive_format_partition(installer, log, logo_animation)
-    logo_animation.clear_content_area()
-    interactive_wifi(installer, log, logo_animation)
-    sync_live_system_time(log)
+def install_aur_packages(installer, log: LogFile):
+    candidates = unique_items(getattr(installer, 'aur_candidates', []))
+    if not candidates:
+        return
+    if MOCK_MODE:
+        log.info(f"[MOCK] Would build AUR packages in the target system: {', '.join(candidates)}")
+        return
 
-    logo_animation.clear_content_area()
-    interactive_desktop_environment(installer, log, logo_animation)
-    logo_animation.clear_content_area()
-    interactive_graphics_drivers(installer, log, logo_animation)
-    logo_animation.clear_content_area()
-    interactive_development_tools(installer, log, logo_animation)
-    logo_animation.clear_content_area()
-    interactive_security_hardening(installer, log, logo_animation)
-    logo_animation.clear_content_area()
-    interactive_locale_setup(installer, log, logo_animation)
-    logo_animation.clear_content_area()
-    interactive_login_manager(installer, log, logo_animation)
-    logo_animation.clear_content_area()
-    interactive_system_themes(installer, log, logo_animation)
-    logo_animation.clear_content_area()
-    interactive_system_utilities(installer, log, logo_animation)
-    logo_animation.clear_content_area()
-    interactive_network_services(installer, log, logo_animation)
-    logo_animation.clear_content_area()
-    interactive_system_automation(installer, log, logo_animation)
-    logo_animation.clear_content_area()
-    interactive_audio_setup(installer, log, logo_animation)
-    logo_animation.clear_content_area()
-    interactive_multimedia_tools(installer, log, logo_animation)
-    logo_animation.clear_content_area()
-    interactive_performance_tuning(installer, log, logo_animation)
-    logo_animation.clear_content_area()
-    interactive_cloud_integration(installer, log, logo_animation)
-    logo_animation.clear_content_area()
-    interactive_specialized_environments(installer, log, logo_animation)
-    logo_animation.clear_content_area()
-    interactive_system_health_monitoring(installer, log, logo_animation)
-    logo_animation.clear_content_area()
-    interactive_system_scoring(installer, log, logo_animation)
-    logo_animation.clear_content_area()
-    interactive_services(installer, log, logo_animation)
-    logo_animation.clear_content_area()
-    interactive_timezone(installer, log, logo_animation)
+    print("\n Building AUR packages: " + ", ".join(candidates))
+    try:
+        package_cache = getattr(installer, 'package_cache', None)
+        cache_dir = package_cache.subdir('aur') if package_cache is not None else AUR_CACHE_DIR
+        installed = build_aur_packages(installer, candidates, get_package_index(log), log, cache_dir)
+    except Exception as e:
+        log.error(f"AUR build stage failed: {e}")
+        print(f" AUR build stage failed, continuing without AUR packages: {e}")
+        return
+    if installed:
+        print(" Installed from the AUR: " + ", ".join(installed))
 
-    installer.mount_partitions()
-    log.info(f"Mounted partitions at {installer.mount_point}")
 
-    print("\n Installing Arch base system and SENDUNE packages to target disk...")
-    install_target_system(installer, log)
-    configure_target_locale_and_timezone(installer, log)
-    apply_sendune_branding(installer, log)
-    install_yay_in_target(installer, log)
+DISK_STEPS = [
+    interactive_find_mirrors,
+    interactive_disk_format,
+    interactive_format_partition,
+    interactive_wifi,
+]
 
+SELECTION_STEPS = [
+    interactive_desktop_environment,
+    interactive_graphics_drivers,
+    interactive_development_tools,
+    interactive_security_hardening,
+    interactive_locale_setup,
+    interactive_login_manager,
+    interactive_system_themes,
+    interactive_system_utilities,
+    interactive_network_services,
+    interactive_system_automation,
+    interactive_audio_setup,
+    interactive_multimedia_tools,
+    interactive_performance_tuning,
+    interactive_cloud_integration,
+    interactive_specialized_environments,
+    interactive_system_health_monitoring,
+    interactive_system_scoring,
+    interactive_services,
+    interactive_timezone,
+]
+
+
+def run_wizard_step(step, installer, log: LogFile, logo_animation: RGB3DLogo):
     logo_animation.clear_content_area()
-    interactive_add_users(installer, log, logo_animation)
+    # Packages added while the step runs are attributed to it in the install preview.
+    installer.current_step = step.__name__
+    try:
+        with trace_span(step.__name__, STEP):
+            step(installer, log, logo_animation)
+    finally:
+        installer.current_step = None
+
+
+# Installer attributes the wizard steps set; journaled so a resumed install keeps the answers.
+WIZARD_STATE = (
+    'desktop_packages',
+    'additional_packages',
+    'services',
+    'selected_locale',
+    'selected_timezone',
+    'selected_keymap',
+)
+
+
+def wizard_stage(step) -> Stage:
+    return Stage(
+        f"wizard:{step.__name__}",
+        lambda installer, log, logo_animation: run_wizard_step(step, installer, log, logo_animation),
+        WIZARD_STATE
+    )
+
+
+def mount_target(installer, log: LogFile, logo_animation: RGB3DLogo):
+    """Mount the target (unless a previous attempt left it mounted) and move the journal onto it."""
+    mount_point = Path(installer.mount_point)
+    if not MOCK_MODE and os.path.ismount(mount_point):
+        log.info(f"{mount_point} is still mounted from the previous attempt")
+    else:
+        installer.mount_partitions()
+        log.info(f"Mounted partitions at {installer.mount_point}")
+    installer.journal.move_to_target(mount_point)
+
+
+def start_background_install(installer, log: LogFile, logo_animation: RGB3DLogo):
+    if TWO_PHASE_INSTALL and not MOCK_MODE:
+        start_base_install(installer, log)
+
+
+def restore_package_selection(installer, log: LogFile, logo_animation: RGB3DLogo):
+    """Feed wizard answers restored from the journal back into the dependency closure."""
+    installer.current_step = None
+    closure = getattr(installer, 'package_closure', None)
+    if closure is not None:
+        closure.add('desktop', getattr(installer, 'desktop_packages', []))
+        closure.add('additional', getattr(installer, 'additional_packages', []))
+
+
+def add_target_users(installer, log: LogFile, logo_animation: RGB3DLogo):
+    run_wizard_step(interactive_add_users, installer, log, logo_animation)
+    # Only the names are journaled; passwords never leave memory.
+    installer.user_names = [user.username for user in getattr(installer, 'users', [])]
+
+
+def enable_default_services(installer, log: LogFile, logo_animation: RGB3DLogo):
     for svc in ['NetworkManager', 'sshd', 'bluetooth', 'pipewire']:
         if svc not in installer.services:
             installer.services.append(svc)
     enable_target_services(installer, log)
 
-    logo_animation.clear_content_area()
-    interactive_bootloader(installer, log, logo_animation)
-    logo_animation.clear_content_area()
-    interactive_custom_commands(installer, log, logo_animation)
 
+def apply_config_selection(installer, log: LogFile, logo_animation: RGB3DLogo):
+    """Add what an unattended config selects beyond the answers to the wizard steps."""
+    config = getattr(installer, 'install_config', None)
+    if config is None:
+        return
+    packages, services = config_packages_and_services(config)
+    packages = [package for package in unique_items(packages) if package not in installer.additional_packages]
+    services = [service for service in unique_items(services) if service not in installer.services]
+    if packages:
+        installer.add_additional_packages(packages)
+    if services:
+        installer.enable_service(services)
+    installer.hostname = config.get('hostname') or getattr(installer, 'hostname', DEFAULT_HOSTNAME)
+    log.info(
+        f"Unattended config: hostname {installer.hostname}, {len(packages)} extra packages, "
+        f"services {', '.join(services) or 'none'}"
+    )
+
+
+def set_root_password(installer, log: LogFile, logo_animation: RGB3DLogo):
+    password = (getattr(installer, 'install_config', None) or {}).get('!root-password')
+    if not password:
+        return
+    if MOCK_MODE:
+        log.info("[MOCK] Would set the root password")
+        return
+    # Through stdin, so the password never shows up in a process list or the log.
+    run(['chpasswd', '--root', str(installer.mount_point)], log, input=f"root:{password}\n", check=True)
+    log.info("Root password set from the unattended config")
+
+
+def run_config_commands(installer, log: LogFile, logo_animation: RGB3DLogo):
+    for command in (getattr(installer, 'install_config', None) or {}).get('custom_commands', []):
+        log.info(f"Running config command in the target: {command}")
+        if MOCK_MODE:
+            continue
+        arch_chroot(installer, command, log)
+
+
+def check_target_kernel(installer, log: LogFile, logo_animation: RGB3DLogo):
     kernel_path = installer.mount_point / 'boot' / 'vmlinuz-linux'
     if kernel_path.exists():
         log.info("Linux kernel successfully installed.")
@@ -426,23 +872,133 @@ def full_installation(installer, log: LogFile, logo_animation: RGB3DLogo):
         log.error("Linux kernel missing! Installation may have failed. Re-install on disk/format and try again.")
         print("Linux kernel missing! Installation may have failed. Re-install on disk/format and try again.")
 
-    for user in getattr(installer, 'users', []):
-        if user.username == 'root':
+
+def install_user_dotfiles(installer, log: LogFile, logo_animation: RGB3DLogo):
+    for username in getattr(installer, 'user_names', []):
+        if username == 'root':
             continue
-        home = installer.mount_point / 'home' / user.username
+        home = installer.mount_point / 'home' / username
         if MOCK_MODE:
-            home = Path(f"MOCK_HOME_{user.username}")
-        log.info(f"Installing dotfiles for {user.username} at {home}")
+            home = Path(f"MOCK_HOME_{username}")
+        log.info(f"Installing dotfiles for {username} at {home}")
         write_bashrc(home, log, installer.mount_point)
         install_external_dotfiles(home, log, installer.mount_point)
 
-    arch_chroot(installer, 'grub-mkconfig -o /boot/grub/grub.cfg', log)
-    install_feature_updater(
-        installer,
-        log,
-        repo_url="https://github.com/Sage563/updater-theme-sendune-installer",
-        branch="main"
-    )
+
+def install_stages() -> list:
+    """The whole install as named stages, in order; see stage_scheduler.stage_dependencies.
+
+    The questions asked after pacstrap come first, so the configuration stages behind them
+    (which declare what they read and write) can run concurrently.
+    """
+    return [
+        *[wizard_stage(step) for step in DISK_STEPS],
+        Stage('refresh-mirrors', lambda installer, log, _: refresh_mirrors(installer, log), journaled=False),
+        Stage('sync-time', lambda installer, log, _: sync_live_system_time(log), journaled=False),
+        Stage('mount', mount_target, journaled=False),
+        Stage('base-install', start_background_install),
+        *[wizard_stage(step) for step in SELECTION_STEPS],
+        Stage('config-selection', apply_config_selection, journaled=False),
+        Stage('package-selection', restore_package_selection, journaled=False),
+        Stage('install-target', lambda installer, log, _: install_target_system(installer, log), ('aur_candidates',)),
+        Stage('users', add_target_users, ('user_names',)),
+        Stage('root-password', set_root_password),
+        Stage('bootloader', lambda *args: run_wizard_step(interactive_bootloader, *args)),
+        Stage('custom-commands', lambda *args: run_wizard_step(interactive_custom_commands, *args)),
+        Stage(
+            'target-mirrorlist', lambda installer, log, _: write_target_mirrorlist(installer, log),
+            writes=('mirrorlist',)
+        ),
+        Stage(
+            'locale-timezone', lambda installer, log, _: configure_target_locale_and_timezone(installer, log),
+            writes=('locale',)
+        ),
+        Stage(
+            'branding', lambda installer, log, _: apply_sendune_branding(installer, log),
+            writes=('identity', 'grub-defaults')
+        ),
+        Stage(
+            'yay', lambda installer, log, _: install_yay_in_target(installer, log),
+            reads=('mirrorlist',), writes=('pacman',)
+        ),
+        Stage(
+            'aur-packages', lambda installer, log, _: install_aur_packages(installer, log),
+            reads=('mirrorlist',), writes=('pacman',)
+        ),
+        Stage('services', enable_default_services, reads=('pacman',), writes=('units',)),
+        Stage('dotfiles', install_user_dotfiles, writes=('homes',)),
+        Stage(
+            'grub-config',
+            lambda installer, log, _: arch_chroot(installer, 'grub-mkconfig -o /boot/grub/grub.cfg', log),
+            reads=('grub-defaults', 'identity', 'pacman'), writes=('grub-cfg',)
+        ),
+        Stage(
+            'feature-updater',
+            lambda installer, log, _: install_feature_updater(
+                installer,
+                log,
+                repo_url="https://github.com/Sage563/updater-theme-sendune-installer",
+                branch="main"
+            ),
+            writes=('units',)
+        ),
+        Stage('kernel-check', check_target_kernel, journaled=False, reads=('pacman',)),
+        # Last and alone: config commands may touch anything the stages above set up.
+        Stage('config-commands', run_config_commands),
+    ]
+
+
+def write_trace(log: LogFile) -> None:
+    """Write the trace as Chrome trace JSON next to the log; log the span and command summaries."""
+    try:
+        path = TRACER.export(trace_path(log.path))
+    except OSError as e:
+        log.warn(f"Could not write the install trace: {e}")
+        return
+    for line in TRACER.summary_lines():
+        log.info(f"Trace: {line}")
+    for line in command_summary_lines():
+        log.info(f"Commands: {line}")
+    log.info(f"Install trace written to {path} (open in chrome://tracing or ui.perfetto.dev)")
+
+
+def copy_logs_to_target(installer, log: LogFile) -> None:
+    """Keep the install log, its trace and pacstrap output in the installed system's /var/log."""
+    target_log_dir = Path(installer.mount_point) / 'var' / 'log'
+    try:
+        copied = log.copy_to(target_log_dir)
+        for extra in (trace_path(log.path), log.path.with_name(f'{log.path.stem}.base-pacstrap.log')):
+            if extra.exists():
+                copied.append(Path(shutil.copy2(extra, target_log_dir / extra.name)))
+    except OSError as e:
+        log.warn(f"Could not copy the install logs to {target_log_dir}: {e}")
+        return
+    log.info(f"Copied {', '.join(path.name for path in copied)} to {target_log_dir}")
+
+
+def full_installation(installer, log: LogFile, logo_animation: RGB3DLogo, stages: list | None = None):
+    """Run every stage (default: `install_stages()`) not yet done according to `installer.journal`."""
+    journal = installer.journal
+    journal.start_attempt()
+    if journal.completed():
+        print(f"\n Resuming installation; {len(journal.completed())} completed stages will be skipped.")
+    try:
+        scheduler = run_stage_graph(install_stages() if stages is None else stages, journal, installer, log, logo_animation)
+    finally:
+        # Also after a failure: the trace shows where the failed attempt spent its time.
+        write_trace(log)
+    close_chroot_sessions()
+    journal.finish()
+    copy_logs_to_target(installer, log)
+    print()
+    for line in scheduler.format_report():
+        print(f" {line}")
+    print()
+    for line in TRACER.summary_lines():
+        print(f" {line}")
+    print()
+    for line in command_summary_lines():
+        print(f" {line}")
 
     print("\n" + "=" * 50)
     print(" SENDUNE Installation Complete!")
@@ -460,7 +1016,7 @@ def full_installation(installer, log: LogFile, logo_animation: RGB3DLogo):
     print("=" * 50)
 
 
-def show_welcome_screen():
+def show_welcome_screen(wait: bool = True):
     os.system('clear' if os.name != 'nt' else 'cls')
     print("\033[0m")
     print("\n\033[1;33mSystem Information:\033[0m")
@@ -485,11 +1041,137 @@ def show_welcome_screen():
         except Exception:
             print("  System info unavailable")
 
-    print("\n\033[1;32mPress Enter to begin installation...\033[0m")
-    input()
+    if wait:
+        print("\n\033[1;32mPress Enter to begin installation...\033[0m")
+        input()
+
+
+def open_install_journal(log: LogFile, logo_animation: RGB3DLogo) -> InstallJournal:
+    """The previous run's journal if the operator wants to resume it, else a fresh one."""
+    journal = InstallJournal.open(log, MOCK_JOURNAL_DIR if MOCK_MODE else LIVE_JOURNAL_DIR)
+    if journal.resumable:
+        print(
+            f"\nA previous installation stopped at stage '{journal.last_failure or 'unknown'}' "
+            f"after {len(journal.completed())} completed stages."
+        )
+        if input_with_pause("Resume it? (y/n): ", logo_animation).strip().lower() != 'y':
+            journal.discard()
+    return journal
+
+
+def install_attempt(cache_server_url: str, config: dict, config_path: Path, log_format: str,
+                    transcript_path: Path) -> bool:
+    """Run the installer once; True when the operator chose to start over."""
+    answer_feed = None
+    if config is not None:
+        answer_feed = answer_feed_from_config(config)
+        ANSWER_SOURCES.append(answer_feed)
+
+    show_welcome_screen(wait=config is None)
+    print("Starting SENDUNE Installer...")
+    logo_animation = logo_start()
+    logo_animation.set_scroll_region(top=8)
+    mount_point = get_mount_point(logo_animation)
+    print(f"Installer will use: {mount_point} as mount point.")
+
+    log = LogFile(LOGDIR, log_format)
+    log.info("SENDUNE Installer started.")
+    log.info(f"Mount point: {mount_point}")
+    log.info(f"Mock mode: {MOCK_MODE}")
+    if config is not None:
+        log.info(f"Unattended install from {config_path}")
+        for warning in answer_feed.warnings:
+            log.warn(f"Unattended config: {warning}")
+            print(f" Warning: {warning}")
+    if cache_server_url and not MOCK_MODE:
+        use_cache_server(cache_server_url, log)
+    journal = open_install_journal(log, logo_animation)
+    recorder = None
+    restart = False
 
+    try:
+        if Installer is None and not MOCK_MODE:
+            raise RuntimeError(
+                "archinstall package not available.\n"
+                "Install with: pacman -Sy archinstall\n"
+                "Or run the installer from the SENDUNE ISO."
+            )
+
+        installer = new_installer(mount_point, log)
+        installer.cache_server_url = cache_server_url
+        installer.journal = journal
+        installer.install_config = config
+        if answer_feed is not None:
+            answer_feed.bind(installer)
+        ANSWER_LISTENERS.append(journal.record_answer)
+        if transcript_path:
+            from .transcript import TranscriptRecorder
+            recorder = TranscriptRecorder(transcript_path, installer, log).attach()
+
+        while True:
+            try:
+                full_installation(installer, log, logo_animation)
+                break
+            except Exception as e:
+                log.error(f"Installation failed at stage {journal.last_failure}: {e}")
+                print(f"\n\033[1;31m Installation failed: {e}\033[0m")
+                print("\nOptions:")
+                print(f"  1. Resume from the failed stage ({journal.last_failure})")
+                print("  2. Start over")
+                print("  3. Exit to shell")
+                choice = input_with_pause("Choice (1/2/3): ", logo_animation).strip()
+                if choice == "1":
+                    continue
+                if choice == "2":
+                    journal.discard()
+                    restart = True
+                break
+    except KeyboardInterrupt:
+        print("\n\nInstallation cancelled by user.")
+        log.warn("Installation cancelled by user (Ctrl+C)")
+    except Exception as e:
+        log.error(f"Installation failed: {e}")
+        print(f"\n\033[1;31m Installation failed: {e}\033[0m")
+        print("\nOptions:")
+        print("  1. Try again")
+        print("  2. Exit to shell")
+        restart = input_with_pause("Choice (1/2): ", logo_animation).strip() == "1"
+    finally:
+        if journal.record_answer in ANSWER_LISTENERS:
+            ANSWER_LISTENERS.remove(journal.record_answer)
+        if answer_feed in ANSWER_SOURCES:
+            ANSWER_SOURCES.remove(answer_feed)
+        close_chroot_sessions()
+        if recorder is not None:
+            # A new attempt starts the transcript over.
+            recorder.close()
+            if not restart:
+                print(f"Install transcript saved to: {transcript_path}")
+        log.info("Starting over." if restart else "Installer finished.")
+        log.close()
+        logo_animation.stop()
+        if not restart:
+            print(f"\nLog file saved to: {LOGDIR}")
+            print("\n" + "!" * 50)
+            print("  INSTALLATION COMPLETE - REBOOT REQUIRED")
+            print("!" * 50)
+            if config is not None:
+                reboot = 'y' if config.get('sendune', {}).get('reboot', False) else 'n'
+            else:
+                reboot = input("\nWould you like to reboot now? (y/n): ").strip().lower()
+            if reboot == 'y':
+                print("Rebooting system...")
+                if not MOCK_MODE:
+                    run(['reboot'])
+                else:
+                    print("[MOCK] System would reboot now.")
+            else:
+                print("Please remember to reboot manually to enter your new system.")
+    return restart
 
-def starting_Sendune() -> None:
+
+def starting_Sendune(cache_server_url: str | None = None, config_path: Path | None = None, log_format: str = TEXT,
+                     transcript_path: Path | None = None) -> None:
     if sys.platform == "win32" and hasattr(sys.stdout, 'reconfigure'):
         try:
             import io
@@ -503,68 +1185,19 @@ def starting_Sendune() -> None:
         print("Please ensure the ISO was built correctly.")
         sys.exit(1)
 
-    try:
-        show_welcome_screen()
-        print("Starting SENDUNE Installer...")
-        logo_animation = logo_start()
-        logo_animation.set_scroll_region(top=8)
-        mount_point = get_mount_point(logo_animation)
-        print(f"Installer will use: {mount_point} as mount point.")
-
-        log = LogFile(LOGDIR)
-        log.info("SENDUNE Installer started.")
-        log.info(f"Mount point: {mount_point}")
-        log.info(f"Mock mode: {MOCK_MODE}")
-
+    config = None
+    if config_path:
         try:
-            if Installer is None and not MOCK_MODE:
-                raise RuntimeError(
-                    "archinstall package not available.\n"
-                    "Install with: pacman -Sy archinstall\n"
-                    "Or run the installer from the SENDUNE ISO."
-                )
-
-            if MOCK_MODE:
-                log.info("[MOCK] Initializing Mock Installer")
-                installer = MockInstaller(mount_point=mount_point, base_packages=BASE_PACKAGES)
-                installer.desktop_packages = list(DESKTOP_PACKAGES)
-                installer.selected_locale = 'en_US.UTF-8'
-                installer.selected_timezone = 'America/New_York'
-                installer.selected_keymap = 'us'
-            else:
-                installer = define_installer(mount_point, log)
-
-            full_installation(installer, log, logo_animation)
-        except KeyboardInterrupt:
-            print("\n\nInstallation cancelled by user.")
-            log.warn("Installation cancelled by user (Ctrl+C)")
-        except Exception as e:
-            log.error(f"Installation failed: {e}")
-            print(f"\n\033[1;31m Installation failed: {e}\033[0m")
-            print("\nOptions:")
-            print("  1. Try again")
-            print("  2. Exit to shell")
-            choice = input_with_pause("Choice (1/2): ", logo_animation).strip()
-            if choice == "1":
-                starting_Sendune()
-                return
-        finally:
-            log.info("Installer finished.")
-            log.close()
-            logo_animation.stop()
-            print(f"\nLog file saved to: {LOGDIR}")
-            print("\n" + "!" * 50)
-            print("  INSTALLATION COMPLETE - REBOOT REQUIRED")
-            print("!" * 50)
-            reboot = input("\nWould you like to reboot now? (y/n): ").strip().lower()
-            if reboot == 'y':
-                print("Rebooting system...")
-                if not MOCK_MODE:
-                    os.system('reboot')
-                else:
-                    print("[MOCK] System would reboot now.")
-            else:
-                print("Please remember to reboot manually to enter your new system.")
+            config = load_install_config(config_path)
+        except (ConfigError, FileNotFoundError) as e:
+            print(f"\n\033[1;31m Invalid install config {config_path}:\033[0m")
+            for error in getattr(e, 'errors', [str(e)]):
+                print(f"  {error}")
+            sys.exit(2)
+
+    try:
+        while install_attempt(cache_server_url, config, config_path, log_format, transcript_path):
+            pass
     except Exception as e:
         print(f"\033[1;31mFatal error: {e}\033[0m")
         import traceback
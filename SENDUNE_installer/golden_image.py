@@ -0,0 +1,386 @@
+import json
+import os
+import re
+import shlex
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait
+from pathlib import Path
+
+from .chroot_session import ChrootSession
+from .commands import CommandError, run
+from .custom_classes import LogFile
+from .fleet import (
+    PROGRESS_INTERVAL,
+    FleetError,
+    FleetProgress,
+    FleetTarget,
+    partition_path,
+    partition_target,
+    run_tool,
+)
+from .full_installation import write_hostname
+from .installer_functions import MOCK_MODE
+
+MANIFEST_NAME = 'manifest.json'
+ROOT_IMAGE_NAME = 'root.img.zst'
+ESP_ARCHIVE_NAME = 'esp.tar.zst'
+IMAGE_VERSION = 1
+ESP_PARTTYPE = 'c12a7328-f81f-11d2-ba4b-00a0c93ec93b'
+EXT_FILESYSTEMS = ('ext2', 'ext3', 'ext4')
+# Blocks of zeros are skipped when writing the root image; the partition is zeroed first.
+WRITE_CHUNK = 4 * 1024 * 1024
+ZSTD_LEVEL = 3
+# Per-machine state that must not be cloned; removed from every deployed root.
+MACHINE_STATE = [
+    'etc/ssh/ssh_host_*',
+    'var/lib/systemd/random-seed',
+    'var/lib/systemd/credential.secret',
+    'var/lib/dbus/machine-id',
+]
+# Files that name the root and ESP filesystems by UUID.
+UUID_FILES = ['etc/fstab', 'etc/kernel/cmdline', 'etc/crypttab']
+DEPLOY_STEPS = ['partition', 'root-image', 'filesystem', 'esp', 'identity', 'bootloader']
+
+
+def list_partitions(device: str, log: LogFile) -> list:
+    output = run_tool(['lsblk', '-J', '-b', '-o', 'PATH,TYPE,FSTYPE,PARTTYPE,UUID,SIZE', device], log)
+    devices = json.loads(output).get('blockdevices', [])
+    partitions = []
+    while devices:
+        entry = devices.pop(0)
+        devices.extend(entry.pop('children', []) or [])
+        if entry.get('type') == 'part':
+            partitions.append(entry)
+    return partitions
+
+
+def find_layout(device: str, log: LogFile) -> tuple:
+    """The (ESP, root) partitions of an installed disk, as lsblk entries."""
+    partitions = list_partitions(device, log)
+    esp = next((part for part in partitions if (part.get('parttype') or '').lower() == ESP_PARTTYPE), None)
+    roots = [part for part in partitions if part.get('fstype') in EXT_FILESYSTEMS]
+    if esp is None or not roots:
+        raise FleetError(f"{device} needs an EFI system partition and an ext2/3/4 root to be captured")
+    return esp, max(roots, key=lambda part: int(part['size']))
+
+
+def filesystem_size(partition: str, log: LogFile) -> int:
+    header = run_tool(['dumpe2fs', '-h', partition], log)
+    fields = dict(line.split(':', 1) for line in header.splitlines() if ':' in line)
+    return int(fields['Block count']) * int(fields['Block size'])
+
+
+def esp_mount_point(root: Path, esp_uuid: str) -> str:
+    """Where the target's fstab mounts the ESP, relative to its root (boot, efi or boot/efi)."""
+    fstab = root / 'etc' / 'fstab'
+    if fstab.exists():
+        for line in fstab.read_text(encoding='utf-8').splitlines():
+            fields = line.split()
+            if len(fields) > 1 and fields[0] == f'UUID={esp_uuid}':
+                return fields[1].strip('/')
+    return 'boot'
+
+
+def read_identity(root: Path, esp: Path) -> dict:
+    """What a captured root holds that is specific to the machine it was installed on."""
+    def text(path: Path) -> str:
+        return path.read_text(encoding='utf-8').strip() if path.exists() else ''
+
+    users = []
+    for line in text(root / 'etc' / 'passwd').splitlines():
+        name, _, uid, *_ = line.split(':')
+        if 1000 <= int(uid) < 60000:
+            users.append(name)
+    fstab = text(root / 'etc' / 'fstab')
+    if (esp / 'loader' / 'loader.conf').exists():
+        bootloader = 'systemd-boot'
+    elif (root / 'boot' / 'grub' / 'grub.cfg').exists() or (esp / 'grub' / 'grub.cfg').exists():
+        bootloader = 'grub'
+    else:
+        bootloader = None
+    return {
+        'hostname': text(root / 'etc' / 'hostname'),
+        'users': users,
+        'machine_id': text(root / 'etc' / 'machine-id'),
+        'fstab_uuids': re.findall(r'^UUID=(\S+)', fstab, re.MULTILINE),
+        'bootloader': bootloader,
+        'kernels': sorted(path.name for path in esp.glob('vmlinuz-*')) or sorted(
+            path.name for path in (root / 'boot').glob('vmlinuz-*')
+        ),
+    }
+
+
+def pipe(producer: list, consumer: list, log: LogFile) -> None:
+    """Run `producer | consumer`, raising FleetError if either side fails."""
+    command = f"{shlex.join(producer)} | {shlex.join(consumer)}"
+    try:
+        # pipefail: a failing producer fails the pipeline, not only a failing consumer.
+        run(['bash', '-o', 'pipefail', '-c', command], log, display=command, check=True)
+    except CommandError as e:
+        raise FleetError(str(e)) from e
+
+
+def capture_image(device: str, image_dir: Path, log: LogFile) -> dict:
+    """Capture an installed disk as a zstd-compressed root image, an ESP archive and a manifest.
+
+    The root filesystem is read with `e2image -ra`, which copies only the blocks in use,
+    and compressed on all cores. The disk must not be mounted.
+    """
+    mounted = run_tool(['lsblk', '-nro', 'MOUNTPOINT', device], log).split()
+    if mounted:
+        raise FleetError(f"Unmount {device} before capturing it (mounted at {', '.join(mounted)})")
+    esp, root = find_layout(device, log)
+    image_dir.mkdir(parents=True, exist_ok=True)
+    # e2fsck exits 1 when it fixed something; the image is taken from the repaired filesystem.
+    if run(['e2fsck', '-fp', root['path']], log).returncode > 1:
+        raise FleetError(f"{root['path']}: filesystem check failed; repair it before capturing")
+
+    mount_dir = Path(tempfile.mkdtemp(prefix='sendune-capture-'))
+    try:
+        run_tool(['mount', '-o', 'ro', root['path'], str(mount_dir)], log)
+        esp_dir = mount_dir / esp_mount_point(mount_dir, esp['uuid'])
+        run_tool(['mount', '-o', 'ro', esp['path'], str(esp_dir)], log)
+        identity = read_identity(mount_dir, esp_dir)
+        pipe(
+            ['tar', '-C', str(esp_dir), '-cf', '-', '.'],
+            ['zstd', '-T0', f'-{ZSTD_LEVEL}', '-q', '-f', '-o', str(image_dir / ESP_ARCHIVE_NAME)],
+            log
+        )
+        esp_mount = str(esp_dir.relative_to(mount_dir))
+    finally:
+        run(['umount', '-R', str(mount_dir)])
+        mount_dir.rmdir()
+
+    started = time.monotonic()
+    pipe(
+        ['e2image', '-ra', root['path'], '-'],
+        ['zstd', '-T0', f'-{ZSTD_LEVEL}', '-q', '-f', '-o', str(image_dir / ROOT_IMAGE_NAME)],
+        log
+    )
+    manifest = {
+        'version': IMAGE_VERSION,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'source': device,
+        'root': {
+            'file': ROOT_IMAGE_NAME,
+            'fstype': root['fstype'],
+            'uuid': root['uuid'],
+            'size': filesystem_size(root['path'], log),
+        },
+        'esp': {
+            'file': ESP_ARCHIVE_NAME,
+            'uuid': esp['uuid'],
+            'size': int(esp['size']),
+            'mount': esp_mount,
+        },
+        **identity,
+    }
+    (image_dir / MANIFEST_NAME).write_text(json.dumps(manifest, indent=2), encoding='utf-8')
+    log.info(
+        f"Captured {device} into {image_dir} in {time.monotonic() - started:.0f}s: "
+        f"{(image_dir / ROOT_IMAGE_NAME).stat().st_size // 1024 ** 2} MiB root image"
+    )
+    return manifest
+
+
+def load_manifest(image_dir: Path) -> dict:
+    try:
+        manifest = json.loads((image_dir / MANIFEST_NAME).read_text(encoding='utf-8'))
+    except (OSError, ValueError) as e:
+        raise FleetError(f"No usable golden image in {image_dir}: {e}") from e
+    if manifest.get('version') != IMAGE_VERSION:
+        raise FleetError(f"Golden image {image_dir} has unknown version {manifest.get('version')}")
+    return manifest
+
+
+def write_root_image(image: Path, partition: str, log: LogFile) -> int:
+    """Decompress `image` onto `partition`, skipping zero blocks; return the bytes written."""
+    try:
+        run_tool(['blkdiscard', '-z', partition], log)
+        zeroed = True
+    except FleetError as e:
+        # Without a zeroed partition every block has to be written, zeros included.
+        log.warn(f"Could not zero {partition} ({e}); writing the full image")
+        zeroed = False
+    zero_chunk = bytes(WRITE_CHUNK)
+    written = offset = 0
+    fd = os.open(partition, os.O_WRONLY)
+
+    def write_chunk(chunk):
+        nonlocal written, offset
+        if not zeroed or chunk != zero_chunk[:len(chunk)]:
+            os.pwrite(fd, chunk, offset)
+            written += len(chunk)
+        offset += len(chunk)
+
+    try:
+        result = run(['zstd', '-d', '-c', '-q', str(image)], log, on_stdout=write_chunk, chunk_size=WRITE_CHUNK)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    if not result.ok:
+        raise FleetError(f"zstd could not decompress {image}: {result.stderr.strip() or result.returncode}")
+    return written
+
+
+def replace_uuids(root: Path, esp: Path, uuids: dict) -> None:
+    paths = [root / name for name in UUID_FILES] + list((esp / 'loader' / 'entries').glob('*.conf'))
+    for path in paths:
+        if not path.is_file():
+            continue
+        content = original = path.read_text(encoding='utf-8')
+        for old, new in uuids.items():
+            content = content.replace(old, new)
+        if content != original:
+            path.write_text(content, encoding='utf-8')
+
+
+def reset_machine_identity(root: Path, hostname: str) -> None:
+    """Give a deployed root its own machine-id and hostname and drop cloned host secrets."""
+    (root / 'etc' / 'machine-id').write_text(f"{uuid.uuid4().hex}\n", encoding='utf-8')
+    for pattern in MACHINE_STATE:
+        for path in root.glob(pattern):
+            if path.is_file() and not path.is_symlink():
+                path.unlink()
+    write_hostname(root, hostname)
+
+
+def install_bootloader(root: Path, manifest: dict, log: LogFile) -> None:
+    """Reinstall the bootloader on the deployed ESP.
+
+    Installed to the removable-media path, since the firmware entries of the machine the
+    disk ends up in cannot be written from here.
+    """
+    esp = f"/{manifest['esp']['mount']}"
+    if manifest.get('bootloader') == 'grub':
+        commands = [
+            f'grub-install --target=x86_64-efi --efi-directory={esp} --bootloader-id=SENDUNE --removable',
+            'grub-mkconfig -o /boot/grub/grub.cfg',
+        ]
+    elif manifest.get('bootloader') == 'systemd-boot':
+        commands = [f'bootctl install --esp-path={esp} --no-variables']
+    else:
+        log.warn("The golden image has no known bootloader; the deployed disks may not boot")
+        return
+    with ChrootSession(root, log, echo=False) as session:
+        for result in session.run_queue(commands):
+            if result.returncode != 0:
+                raise FleetError(f"Bootloader reinstall failed: {result.command}")
+
+
+def deploy_target(image_dir: Path, manifest: dict, target: FleetTarget, hostname: str, log: LogFile, report) -> int:
+    """Write the golden image onto one disk and make it a machine of its own; return bytes written."""
+    def step(name):
+        report((target.name, 'stage', name, 'running'))
+        return name
+
+    step('partition')
+    esp_size = f"+{max(1, manifest['esp']['size'] // 1024 ** 2)}M"
+    partition_target(target, log, esp_size)
+    esp_part, root_part = partition_path(target.device, 1), partition_path(target.device, 2)
+    root_size = int(run_tool(['blockdev', '--getsize64', root_part], log))
+    if root_size < manifest['root']['size']:
+        raise FleetError(
+            f"{target.device}: root partition {root_size // 1024 ** 3} GiB is smaller than the "
+            f"image's {manifest['root']['size'] // 1024 ** 3} GiB filesystem"
+        )
+    report((target.name, 'stage', 'partition', 'done'))
+
+    step('root-image')
+    written = write_root_image(image_dir / manifest['root']['file'], root_part, log)
+    report((target.name, 'stage', 'root-image', 'done'))
+
+    step('filesystem')
+    if run(['e2fsck', '-fy', root_part], log).returncode > 1:
+        raise FleetError(f"{root_part}: filesystem check failed after writing the image")
+    run_tool(['tune2fs', '-U', 'random', root_part], log)
+    run_tool(['resize2fs', root_part], log)
+    run_tool(['mkfs.fat', '-F', '32', esp_part], log)
+    report((target.name, 'stage', 'filesystem', 'done'))
+
+    step('esp')
+    root = target.mount_point
+    root.mkdir(parents=True, exist_ok=True)
+    run_tool(['mount', root_part, str(root)], log)
+    try:
+        esp = root / manifest['esp']['mount']
+        esp.mkdir(parents=True, exist_ok=True)
+        run_tool(['mount', esp_part, str(esp)], log)
+        pipe(
+            ['zstd', '-d', '-c', '-q', str(image_dir / manifest['esp']['file'])],
+            ['tar', '-C', str(esp), '--no-same-owner', '-xf', '-'],
+            log
+        )
+        report((target.name, 'stage', 'esp', 'done'))
+
+        step('identity')
+        new_uuids = {
+            manifest['root']['uuid']: run_tool(['blkid', '-s', 'UUID', '-o', 'value', root_part], log).strip(),
+            manifest['esp']['uuid']: run_tool(['blkid', '-s', 'UUID', '-o', 'value', esp_part], log).strip(),
+        }
+        replace_uuids(root, esp, new_uuids)
+        reset_machine_identity(root, hostname)
+        report((target.name, 'stage', 'identity', 'done'))
+
+        step('bootloader')
+        install_bootloader(root, manifest, log)
+        report((target.name, 'stage', 'bootloader', 'done'))
+    finally:
+        run(['umount', '-R', str(root)])
+    log.info(f"Deployed {target.device} as {hostname} ({written // 1024 ** 2} MiB written)")
+    return written
+
+
+def deploy_image(image_dir: Path, targets: list, log: LogFile, hostname_template: str | None = None,
+                 max_parallel: int | None = None) -> bool:
+    """Deploy the golden image in `image_dir` to every target at once; True if all succeeded.
+
+    `hostname_template` may use {hostname} (the captured one), {index} and {name} (the device).
+    """
+    if MOCK_MODE:
+        raise FleetError("Golden images can only be captured and deployed on a Linux live host")
+    manifest = load_manifest(image_dir)
+    hostname_template = hostname_template or '{hostname}-{index}'
+    progress = FleetProgress(targets, len(DEPLOY_STEPS))
+    lock = threading.Lock()
+
+    def report(event):
+        with lock:
+            progress.update(event)
+
+    def deploy(index, target):
+        hostname = hostname_template.format(hostname=manifest['hostname'] or 'sendune', index=index, name=target.name)
+        try:
+            written = deploy_target(image_dir, manifest, target, hostname, log, report)
+        except Exception as e:
+            log.error(f"Deploying {target.device} failed: {e}")
+            report((target.name, 'failed', str(e), 0))
+            return
+        report((target.name, 'done', '', written))
+
+    started = time.monotonic()
+    log.info(f"Deploying {image_dir} to {len(targets)} disks")
+    with ThreadPoolExecutor(max_workers=max_parallel or len(targets), thread_name_prefix='deploy') as executor:
+        for target in targets:
+            progress.started(target.name)
+        futures = [executor.submit(deploy, index, target) for index, target in enumerate(targets, 1)]
+        while wait(futures, timeout=PROGRESS_INTERVAL).not_done:
+            with lock:
+                progress.render()
+    progress.render()
+
+    deployed = [item for item in progress.targets.values() if item.status == 'done']
+    written = sum(item.transferred for item in deployed)
+    summary = (
+        f"{len(deployed)}/{len(targets)} disks deployed in {time.monotonic() - started:.0f}s, "
+        f"{written / 1024 ** 3:.1f} GiB written"
+    )
+    log.info(summary)
+    print(summary)
+    for item in progress.targets.values():
+        if item.status != 'done':
+            print(f"{item.target.name}: {item.error or item.status}")
+    return len(deployed) == len(targets)
@@ -0,0 +1,229 @@
+import json
+import os
+import re
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+from .custom_classes import LogFile
+from .tracing import STAGE, trace_span
+
+JOURNAL_NAME = 'install-journal.json'
+# Where the journal lives until the target is mounted; afterwards this path is a symlink to it.
+LIVE_JOURNAL_DIR = Path('/run/SENDUNE_installer')
+# Relative to the target root, so the installed system keeps a record of how it was installed.
+TARGET_JOURNAL_DIR = Path('var/lib/sendune-installer')
+JOURNAL_VERSION = 1
+# Answers to prompts matching this are never written to disk.
+SECRET_PROMPT_RE = re.compile(r'password|passphrase|secret|token', re.IGNORECASE)
+# Shown or recorded instead of such an answer.
+SECRET_PLACEHOLDER = '********'
+# Called as listener(stage name, status) with status running/done/failed/skipped; fleet workers report progress with it.
+STAGE_LISTENERS = []
+
+
+def _now() -> str:
+    return time.strftime('%Y-%m-%dT%H:%M:%S')
+
+
+def _notify(name: str, status: str) -> None:
+    for listener in STAGE_LISTENERS:
+        listener(name, status)
+
+
+def _json_value(value):
+    """`value` if it can be stored in the journal, else None."""
+    try:
+        json.dumps(value)
+    except (TypeError, ValueError):
+        return None
+    return value
+
+
+@dataclass
+class Stage:
+    """One named step of the install pipeline.
+
+    `outputs` are installer attributes the stage sets for later stages; they are journaled
+    when the stage completes and restored when a resumed install skips it. Stages with
+    `journaled=False` are cheap or idempotent and run on every attempt. `reads`/`writes`
+    name the resources the stage uses, for the stage scheduler; a stage declaring none
+    runs alone, after everything before it.
+    """
+    name: str
+    run: object
+    outputs: tuple = ()
+    journaled: bool = True
+    reads: tuple = ()
+    writes: tuple = ()
+
+
+class InstallJournal():
+    """Answers, completed stages and their outputs, written atomically after every change."""
+
+    def __init__(self, path: Path, log: LogFile, data: dict | None = None, live_path: Path | None = None) -> None:
+        self.path = Path(path)
+        self.live_path = Path(live_path or path)
+        self.log = log
+        self.data = data or {
+            'version': JOURNAL_VERSION,
+            'created': _now(),
+            'attempts': 0,
+            'finished': False,
+            'answers': {},
+            'stages': {},
+        }
+        self.current_stage = None
+        # Stages run on several threads; every change and save happens under this lock.
+        self._lock = threading.RLock()
+
+    @classmethod
+    def open(cls, log: LogFile, live_dir: Path = LIVE_JOURNAL_DIR) -> 'InstallJournal':
+        """The journal of the previous (unfinished) run, or a new one."""
+        path = Path(live_dir) / JOURNAL_NAME
+        try:
+            data = json.loads(path.read_text(encoding='utf-8'))
+        except FileNotFoundError:
+            # Also a dangling symlink: the target of the previous run is not mounted.
+            return cls(path, log)
+        except (OSError, ValueError) as e:
+            log.warn(f"Ignoring unreadable install journal {path}: {e}")
+            return cls(path, log)
+        if data.get('version') != JOURNAL_VERSION:
+            log.warn(f"Ignoring install journal {path} with unknown version {data.get('version')}")
+            return cls(path, log)
+        return cls(path.resolve(), log, data, path)
+
+    @property
+    def resumable(self) -> bool:
+        return not self.data['finished'] and any(
+            stage['status'] == 'done' for stage in self.data['stages'].values()
+        )
+
+    @property
+    def last_failure(self) -> str:
+        failed = [name for name, stage in self.data['stages'].items() if stage['status'] != 'done']
+        return failed[-1] if failed else None
+
+    def completed(self) -> list:
+        return [name for name, stage in self.data['stages'].items() if stage['status'] == 'done']
+
+    def is_done(self, name: str) -> bool:
+        return self.data['stages'].get(name, {}).get('status') == 'done'
+
+    def outputs(self, name: str) -> dict:
+        return self.data['stages'].get(name, {}).get('outputs', {})
+
+    def save(self) -> None:
+        with self._lock:
+            self.data['updated'] = _now()
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.path.with_name(f"{self.path.name}.tmp")
+            with tmp_path.open('w', encoding='utf-8') as f:
+                json.dump(self.data, f, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+
+    def record_answer(self, prompt: str, response: str) -> None:
+        with self._lock:
+            step = self.current_stage or 'other'
+            answer = None if SECRET_PROMPT_RE.search(prompt) else response
+            self.data['answers'].setdefault(step, []).append({'prompt': prompt.strip(), 'answer': answer})
+            self.save()
+
+    def start_attempt(self) -> None:
+        with self._lock:
+            self.data['attempts'] += 1
+            self.save()
+
+    def start(self, name: str) -> None:
+        with self._lock:
+            self.current_stage = name
+            self.data['stages'][name] = {'status': 'running', 'started': _now()}
+            self.save()
+
+    def complete(self, name: str, outputs: dict, duration: float) -> None:
+        with self._lock:
+            stage = self.data['stages'][name]
+            stage.update(status='done', finished=_now(), duration=round(duration, 3), outputs=outputs)
+            if self.current_stage == name:
+                self.current_stage = None
+            self.save()
+
+    def fail(self, name: str, error: str, duration: float) -> None:
+        with self._lock:
+            stage = self.data['stages'][name]
+            stage.update(status='failed', finished=_now(), duration=round(duration, 3), error=error)
+            if self.current_stage == name:
+                self.current_stage = None
+            self.save()
+
+    def finish(self) -> None:
+        with self._lock:
+            self.data['finished'] = True
+            self.save()
+
+    def discard(self) -> None:
+        """Forget the previous run, e.g. when the operator chooses to start over."""
+        for path in {self.path, self.live_path}:
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                self.log.warn(f"Could not remove install journal {path}: {e}")
+        self.path = self.live_path
+        self.data = InstallJournal(self.path, self.log).data
+        self.current_stage = None
+
+    def move_to_target(self, root: Path) -> None:
+        """Keep the journal on the target from now on, leaving a symlink at the live path."""
+        target = (Path(root) / TARGET_JOURNAL_DIR / JOURNAL_NAME).absolute()
+        if self.path == target:
+            return
+        old_path, self.path = self.path, target
+        self.save()
+        try:
+            old_path.unlink(missing_ok=True)
+            self.live_path.unlink(missing_ok=True)
+            self.live_path.symlink_to(target)
+        except OSError as e:
+            self.log.warn(f"Could not link {self.live_path} to the install journal: {e}")
+        self.log.info(f"Install journal moved to {target}")
+
+
+def restore_stage(stage: Stage, journal: InstallJournal, installer, log: LogFile) -> None:
+    """Put back what a stage the journal has as done left on the installer."""
+    for attribute, value in journal.outputs(stage.name).items():
+        setattr(installer, attribute, value)
+    log.info(f"Stage {stage.name}: already done, skipped")
+    _notify(stage.name, 'skipped')
+
+
+def run_stage(stage: Stage, journal: InstallJournal, installer, log: LogFile, *args) -> float:
+    """Run one stage, journaling its start, outcome and outputs; return its duration."""
+    started = time.monotonic()
+    if stage.journaled:
+        journal.start(stage.name)
+    _notify(stage.name, 'running')
+    try:
+        with trace_span(stage.name, STAGE):
+            stage.run(installer, log, *args)
+    except BaseException as e:
+        if stage.journaled:
+            journal.fail(stage.name, str(e) or type(e).__name__, time.monotonic() - started)
+        _notify(stage.name, 'failed')
+        raise
+    duration = time.monotonic() - started
+    if stage.journaled:
+        outputs = {}
+        for attribute in stage.outputs:
+            value = _json_value(getattr(installer, attribute, None))
+            if value is not None:
+                outputs[attribute] = value
+        journal.complete(stage.name, outputs, duration)
+    log.info(f"Stage {stage.name}: finished in {duration:.1f}s")
+    _notify(stage.name, 'done')
+    return duration
@@ -1,9 +1,11 @@
 import os
 import sys
 import platform
-import subprocess
 from pathlib import Path
+from .systemd_units import enable_units
+from .commands import run, run_shell
 from .custom_classes import LogFile
+from .mirrors import candidate_servers, rank_mirrors, write_mirrorlist
 from .narchs_logos import input_with_pause
 
 # ===============================
@@ -11,28 +13,22 @@ from .narchs_logos import input_with_pause
 # ===============================
 MOCK_MODE = platform.system() == "Windows"
 
-def run_command(command, log=None):
+def run_command(command, log=None, display=None):
     """
-    Executes a shell command.
+    Executes a shell command and returns its exit code.
     If MOCK_MODE is True (Windows), prints the command instead of running it.
+    Output is shown on the terminal and streamed into `log`; `display` replaces the
+    command in the log (e.g. to keep a password out of it).
     """
     if MOCK_MODE:
-        msg = f"[MOCK] would run: {command}"
+        msg = f"[MOCK] would run: {display or command}"
         print(msg)
         if log:
             log.info(msg)
         return 0
     else:
-        # Use subprocess for safety and better handling
-        try:
-            # shell=True is needed for commands like "echo ... | command" or simple strings
-            # For more complex/safe usage, we should split args, but for this migration we keep it simple.
-            result = subprocess.run(command, shell=True, check=False)
-            return result.returncode
-        except Exception as e:
-            if log:
-                log.error(f"Command failed: {command} - {e}")
-            return 1
+        # Through a shell, for commands like "echo ... | command" or "a || b".
+        return run_shell(command, log, echo=True, display=display).returncode
 
 # Try to import archinstall...
 ARCHINSTALL_AVAILABLE = True
@@ -284,6 +280,8 @@ def interactive_desktop_environment(installer: 'Installer', log: LogFile, logo_a
             global DESKTOP_PACKAGES
             DESKTOP_PACKAGES = packages
             installer.desktop_packages = list(packages)
+            if hasattr(installer, 'package_closure'):
+                installer.package_closure.replace('desktop', packages)
             installer.add_additional_packages(packages)
             log.info(f"Desktop environment installed: {name} - {packages}")
             
@@ -749,7 +747,7 @@ def detect_hardware():
         
         # GPU detection (simplified)
         try:
-            result = run_command("lspci | grep VGA")
+            result = '\n'.join(line for line in run(['lspci']).stdout.splitlines() if 'VGA' in line)
             if 'NVIDIA' in result:
                 hardware['gpu'] = 'nvidia'
             elif 'AMD' in result or 'ATI' in result:
@@ -1808,7 +1806,7 @@ def interactive_wifi(installer: 'Installer', log: LogFile, logo_animation):
     if MOCK_MODE:
         networks = ["Mock-WiFi-1", "Mock-WiFi-2"]
     else:
-        networks = [n for n in os.popen("nmcli -t -f SSID dev wifi list").read().splitlines() if n]
+        networks = [n for n in run(['nmcli', '-t', '-f', 'SSID', 'dev', 'wifi', 'list'], log).stdout.splitlines() if n]
         
     if networks:
         print("\nAvailable Wi-Fi networks:")
@@ -1820,8 +1818,12 @@ def interactive_wifi(installer: 'Installer', log: LogFile, logo_animation):
             if 1 <= choice <= len(networks):
                 ssid = networks[choice-1]
                 password = input_with_pause(f"Enter password for {ssid}: ", logo_animation)
-                cmd = f"nmcli device wifi connect '{ssid}' password '{password}'"
-                result = run_command(cmd, log)
+                result = run(
+                    ['nmcli', 'device', 'wifi', 'connect', ssid, 'password', password],
+                    log,
+                    echo=True,
+                    display=f"nmcli device wifi connect {ssid}"
+                ).returncode
                 if result == 0:
                     log.info(f"Connected to Wi-Fi network: {ssid}")
                     sync_live_system_time(log)
@@ -1939,9 +1941,26 @@ def interactive_find_mirrors(installer: 'Installer', log: LogFile, logo_animatio
         log.info("Mirror check skipped by user.")
         return
 
+    if MOCK_MODE:
+        log.info("[MOCK] Would rank mirrors and rewrite /etc/pacman.d/mirrorlist")
+        return
+
     try:
         print("Ranking mirrors by speed...")
-        run_command("reflector --latest 10 --sort rate --save /etc/pacman.d/mirrorlist", log)
+        # The LAN cache server is not a mirror; it is put back in front after ranking.
+        cache_server_url = (getattr(installer, 'cache_server_url', None) or '').rstrip('/')
+        servers = [
+            server for server in candidate_servers()
+            if not cache_server_url or not server.startswith(cache_server_url)
+        ]
+        ranking = rank_mirrors(log, servers)
+        if not write_mirrorlist(ranking):
+            print("No mirror answered; keeping the current mirrorlist.")
+            log.warn("Mirror ranking found no reachable mirror.")
+            return
+        installer.mirror_ranking = ranking
+        for probe in [probe for probe in ranking if probe.ok][:5]:
+            print(f"  {probe.describe()}")
         print("Mirrorlist updated with fastest mirrors.")
         log.info("Fastest mirrors configured.")
     except Exception as e:
@@ -2066,9 +2085,9 @@ WantedBy=timers.target
         timer_path.write_text(timer_unit, encoding='utf-8')
         log.info(f"Systemd timer written to {timer_path}")
 
-        run_command(f'arch-chroot {installer.mount_point} systemctl daemon-reload', log)
-        run_command(f'arch-chroot {installer.mount_point} systemctl enable narchs-feature-updater.service', log)
-        run_command(f'arch-chroot {installer.mount_point} systemctl enable narchs-feature-updater.timer', log)
+        report = enable_units(target_root, ['narchs-feature-updater.service', 'narchs-feature-updater.timer'], log)
+        if report.missing:
+            raise RuntimeError(f"Feature updater units not found: {', '.join(report.missing)}")
         log.info('Feature updater service and timer enabled.')
     except Exception as e:
         log.error(f"Failed to install feature updater: {e}")
@@ -0,0 +1,231 @@
+import asyncio
+import hashlib
+import json
+import os
+import platform
+import ssl
+import time
+import urllib.parse
+from dataclasses import asdict, dataclass
+from pathlib import Path
+
+from .custom_classes import LogFile
+from .package_prefetch import MIRRORLIST
+
+MIRROR_RANKING_CACHE = Path('/var/cache/SENDUNE_installer/mirror-ranking.json')
+RANKING_TTL = 6 * 3600
+# Small, always present and the same on every mirror.
+PROBE_REPO = 'core'
+PROBE_FILE = 'core.db'
+PROBE_BYTES = 512 * 1024
+PROBE_TIMEOUT = 5
+PROBE_CONCURRENCY = 16
+# Hard limit for the whole ranking; mirrors still probing then are left unranked.
+RANKING_BUDGET = 12
+MIRROR_COUNT = 10
+# Mirrors are ordered by the estimated time to fetch a package of this size.
+REFERENCE_DOWNLOAD = 4 * 1024 * 1024
+
+
+@dataclass
+class MirrorProbe:
+    server: str
+    ttfb: float | None = None
+    throughput: float = 0.0
+    error: str = ''
+
+    @property
+    def ok(self) -> bool:
+        return not self.error and self.ttfb is not None
+
+    @property
+    def score(self) -> float:
+        """Estimated seconds to download REFERENCE_DOWNLOAD from this mirror."""
+        if not self.ok:
+            return float('inf')
+        return self.ttfb + REFERENCE_DOWNLOAD / max(self.throughput, 1.0)
+
+    def describe(self) -> str:
+        if not self.ok:
+            return f"{self.server}  ({self.error})"
+        return f"{self.server}  ({self.ttfb * 1000:.0f} ms, {self.throughput / (1024 * 1024):.1f} MiB/s)"
+
+
+def candidate_servers(mirrorlist: Path = MIRRORLIST) -> list:
+    """Every `Server =` URL in the mirrorlist, including commented-out ones, in file order."""
+    servers = []
+    try:
+        lines = mirrorlist.read_text(encoding='utf-8').splitlines()
+    except OSError:
+        return servers
+    for line in lines:
+        key, _, value = line.strip().lstrip('#').strip().partition('=')
+        value = value.strip()
+        if key.strip() == 'Server' and value.startswith(('http://', 'https://')) and value not in servers:
+            servers.append(value)
+    return servers
+
+
+def probe_url(server: str) -> str:
+    base = server.replace('$repo', PROBE_REPO).replace('$arch', platform.machine() or 'x86_64')
+    return f"{base.rstrip('/')}/{PROBE_FILE}"
+
+
+async def _http_get(url: str, limit: int, ssl_context: ssl.SSLContext) -> tuple:
+    """Minimal HTTP/1.1 GET; returns (seconds to first response byte, bytes read, body seconds)."""
+    parts = urllib.parse.urlsplit(url)
+    https = parts.scheme == 'https'
+    started = time.monotonic()
+    reader, writer = await asyncio.open_connection(
+        parts.hostname, parts.port or (443 if https else 80), ssl=ssl_context if https else None
+    )
+    try:
+        path = parts.path or '/'
+        if parts.query:
+            path += f"?{parts.query}"
+        writer.write(
+            f"GET {path} HTTP/1.1\r\nHost: {parts.netloc}\r\nUser-Agent: SENDUNE-installer\r\n"
+            "Accept-Encoding: identity\r\nConnection: close\r\n\r\n".encode('ascii')
+        )
+        await writer.drain()
+        status_line = await reader.readline()
+        ttfb = time.monotonic() - started
+        fields = status_line.split()
+        if len(fields) < 2 or not fields[1].isdigit():
+            raise ConnectionError('malformed HTTP response')
+        if int(fields[1]) != 200:
+            raise ConnectionError(f"HTTP {int(fields[1])}")
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass
+
+        body_started = time.monotonic()
+        received = 0
+        while received < limit:
+            chunk = await reader.read(min(64 * 1024, limit - received))
+            if not chunk:
+                break
+            received += len(chunk)
+        return ttfb, received, max(time.monotonic() - body_started, 1e-3)
+    finally:
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except (OSError, ssl.SSLError):
+            pass
+
+
+async def _probe(server: str, semaphore: asyncio.Semaphore, ssl_context: ssl.SSLContext,
+                 probe_timeout: float, limit: int) -> MirrorProbe:
+    async with semaphore:
+        try:
+            async with asyncio.timeout(probe_timeout):
+                ttfb, received, elapsed = await _http_get(probe_url(server), limit, ssl_context)
+        except TimeoutError:
+            return MirrorProbe(server, error='timed out')
+        except (OSError, ssl.SSLError, ConnectionError, ValueError) as e:
+            return MirrorProbe(server, error=str(e) or type(e).__name__)
+        if not received:
+            return MirrorProbe(server, error='empty response')
+        return MirrorProbe(server, ttfb, received / elapsed)
+
+
+async def _probe_all(servers: list, budget: float, concurrency: int, probe_timeout: float, limit: int) -> list:
+    semaphore = asyncio.Semaphore(concurrency)
+    ssl_context = ssl.create_default_context()
+    tasks = {asyncio.ensure_future(_probe(server, semaphore, ssl_context, probe_timeout, limit)): server
+             for server in servers}
+    done, pending = await asyncio.wait(tasks, timeout=budget)
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+    return [task.result() if task in done else MirrorProbe(tasks[task], error='not probed within the time budget')
+            for task in tasks]
+
+
+def probe_mirrors(servers: list, budget: float = RANKING_BUDGET, concurrency: int = PROBE_CONCURRENCY,
+                  timeout: float = PROBE_TIMEOUT, limit: int = PROBE_BYTES) -> list:
+    """Probe all `servers` concurrently and return them best first (failures last)."""
+    probes = asyncio.run(_probe_all(list(servers), budget, concurrency, timeout, limit))
+    return sorted(probes, key=lambda probe: probe.score)
+
+
+def _candidates_key(servers: list) -> str:
+    return hashlib.sha256('\n'.join(sorted(servers)).encode('utf-8')).hexdigest()
+
+
+def load_cached_ranking(servers: list, cache_file: Path = MIRROR_RANKING_CACHE, ttl: float = RANKING_TTL) -> list | None:
+    """The stored ranking if it is younger than `ttl` and was made for the same candidates."""
+    try:
+        cached = json.loads(cache_file.read_text(encoding='utf-8'))
+    except (OSError, ValueError):
+        return None
+    if cached.get('candidates') != _candidates_key(servers) or time.time() - cached.get('created', 0) > ttl:
+        return None
+    return [MirrorProbe(**probe) for probe in cached.get('probes', [])]
+
+
+def save_ranking(servers: list, probes: list, cache_file: Path = MIRROR_RANKING_CACHE) -> None:
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = cache_file.with_name(f"{cache_file.name}.tmp")
+    tmp_file.write_text(json.dumps({
+        'created': time.time(),
+        'candidates': _candidates_key(servers),
+        'probes': [asdict(probe) for probe in probes],
+    }), encoding='utf-8')
+    os.replace(tmp_file, cache_file)
+
+
+def rank_mirrors(log: LogFile, servers: list | None = None, cache_file: Path = MIRROR_RANKING_CACHE,
+                 ttl: float = RANKING_TTL, budget: float = RANKING_BUDGET) -> list:
+    servers = candidate_servers() if servers is None else servers
+    if not servers:
+        log.warn("No candidate mirrors to rank.")
+        return []
+    ranking = load_cached_ranking(servers, cache_file, ttl)
+    if ranking is not None:
+        log.info(f"Mirror ranking loaded from {cache_file}")
+        return ranking
+
+    started = time.monotonic()
+    ranking = probe_mirrors(servers, budget)
+    reachable = [probe for probe in ranking if probe.ok]
+    log.info(
+        f"Ranked {len(servers)} mirrors in {time.monotonic() - started:.1f}s, {len(reachable)} reachable"
+    )
+    for probe in ranking[:MIRROR_COUNT]:
+        log.info(f"Mirror: {probe.describe()}")
+    if reachable:
+        try:
+            save_ranking(servers, ranking, cache_file)
+        except OSError as e:
+            log.warn(f"Could not cache the mirror ranking: {e}")
+    return ranking
+
+
+def format_mirrorlist(ranking: list, count: int = MIRROR_COUNT) -> str:
+    """Best `count` reachable mirrors as servers; every other candidate kept commented out."""
+    reachable = [probe for probe in ranking if probe.ok]
+    lines = [
+        '##',
+        '## Arch Linux repository mirrorlist',
+        f"## Ranked by the SENDUNE installer on {time.strftime('%Y-%m-%d %H:%M:%S')}",
+        '##',
+        '',
+    ]
+    for probe in reachable[:count]:
+        lines.append(f"# {probe.ttfb * 1000:.0f} ms, {probe.throughput / (1024 * 1024):.1f} MiB/s")
+        lines.append(f"Server = {probe.server}")
+    lines.append('')
+    for probe in reachable[count:] + [probe for probe in ranking if not probe.ok]:
+        lines.append(f"#Server = {probe.server}")
+    return '\n'.join(lines) + '\n'
+
+
+def write_mirrorlist(ranking: list, path: Path = MIRRORLIST, count: int = MIRROR_COUNT) -> bool:
+    if not any(probe.ok for probe in ranking):
+        return False
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f"{path.name}.sendune-tmp")
+    tmp_path.write_text(format_mirrorlist(ranking, count), encoding='utf-8')
+    os.replace(tmp_path, path)
+    return True
@@ -6,6 +6,9 @@ import threading
 import shutil
 import os
 
+from .install_journal import SECRET_PLACEHOLDER, SECRET_PROMPT_RE
+from .tracing import USER, trace_span
+
 
 class RGB3DLogo:
     """Animated ASCII logo with RGB gradient.
@@ -170,6 +173,12 @@ class RGB3DLogo:
             sys.stdout.flush()
 
 
+# Called as listener(prompt, response) after every answer; the install journal records them.
+ANSWER_LISTENERS = []
+# Callables (prompt) -> answer or None; the first answer given is used instead of reading stdin.
+ANSWER_SOURCES = []
+
+
 def input_with_pause(prompt, logo_animation):
     """Pauses the logo animation, takes input, then resumes animation."""
     logo_animation.pause()
@@ -177,10 +186,20 @@ def input_with_pause(prompt, logo_animation):
         # Just use standard input() but ensure color is reset
         sys.stdout.write("\033[0m")
         sys.stdout.flush()
-        response = input(prompt)
+        # Think time: how long the operator takes to answer, kept apart from machine time.
+        with trace_span(prompt.strip(), USER):
+            response = next((answer for answer in (source(prompt) for source in ANSWER_SOURCES) if answer is not None), None)
+            if response is None:
+                response = shown = input(prompt)
+            else:
+                # Config answers are echoed; passwords would end up in fleet console logs.
+                shown = SECRET_PLACEHOLDER if SECRET_PROMPT_RE.search(prompt) else response
+                print(f"{prompt}{shown}")
+        for listener in ANSWER_LISTENERS:
+            listener(prompt, response)
 
         cols = max(1, shutil.get_terminal_size((80, 24)).columns)
-        prompt_width = len(prompt) + len(response)
+        prompt_width = len(prompt) + len(shown)
         lines_to_clear = max(1, math.ceil(prompt_width / cols))
 
         for _ in range(lines_to_clear):
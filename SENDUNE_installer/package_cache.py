@@ -0,0 +1,152 @@
+import os
+from pathlib import Path
+
+from .commands import run
+from .custom_classes import LogFile
+from .package_prefetch import PACMAN_CACHE_DIR
+
+# Created on the install stick by `build_arch_iso.sh --add-cache-partition`.
+CACHE_PARTITION_LABEL = 'SENDUNE_CACHE'
+CACHE_BY_LABEL = Path('/dev/disk/by-label') / CACHE_PARTITION_LABEL
+CACHE_MOUNT_POINT = Path('/run/sendune-cache')
+# Any writable directory (e.g. on a second partition mounted by hand) can stand in for the partition.
+CACHE_DIR_ENV = 'SENDUNE_CACHE_DIR'
+# Upper bound for the cache, e.g. `20G`; by default 90% of the cache filesystem.
+CACHE_LIMIT_ENV = 'SENDUNE_CACHE_LIMIT'
+CACHE_FILL_RATIO = 0.9
+PACKAGE_SUBDIR = 'pacman-pkg'
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+
+def parse_size(text: str) -> int:
+    """`20G` -> bytes; accepts K/M/G/T with an optional `iB`/`B` suffix."""
+    text = text.strip().upper().removesuffix('IB').removesuffix('B')
+    unit = text[-1] if text and text[-1] in SIZE_UNITS else ''
+    return int(float(text[:-1] if unit else text) * SIZE_UNITS[unit])
+
+
+class PackageCache():
+    """pacman package cache on persistent boot media, shared by every install from the stick.
+
+    Least recently used packages are evicted once the cache grows past `limit`; packages an
+    install used are touched so they count as recent even when pacman did not re-download them.
+    """
+
+    def __init__(self, root: Path, log: LogFile, limit: int | None = None, device: Path | None = None) -> None:
+        self.root = Path(root)
+        self.log = log
+        self.device = device
+        self.package_dir = self.root / PACKAGE_SUBDIR
+        self.package_dir.mkdir(parents=True, exist_ok=True)
+        if limit is None:
+            stat = os.statvfs(self.root)
+            limit = int(stat.f_blocks * stat.f_frsize * CACHE_FILL_RATIO)
+        self.limit = limit
+
+    def subdir(self, name: str) -> Path:
+        """Another persistent cache (e.g. AUR builds) living next to the packages."""
+        path = self.root / name
+        path.mkdir(parents=True, exist_ok=True)
+        return path
+
+    def cachedir_args(self) -> list:
+        """pacman/pacstrap arguments: download into the stick, still read the live cache."""
+        return ['--cachedir', str(self.package_dir), '--cachedir', str(PACMAN_CACHE_DIR)]
+
+    def touch(self, filenames) -> int:
+        touched = 0
+        for filename in filenames:
+            for path in (self.package_dir / filename, self.package_dir / f"{filename}.sig"):
+                try:
+                    os.utime(path)
+                    touched += 1
+                except OSError:
+                    pass
+        return touched
+
+    def _entries(self) -> list:
+        """(mtime, size, [paths]) per package, its detached signature counted with it."""
+        entries = {}
+        with os.scandir(self.package_dir) as scan:
+            for entry in scan:
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                key = entry.name.removesuffix('.sig')
+                stat = entry.stat(follow_symlinks=False)
+                mtime, size, paths = entries.get(key, (0, 0, []))
+                entries[key] = (max(mtime, stat.st_mtime), size + stat.st_size, paths + [Path(entry.path)])
+        return sorted(entries.values(), key=lambda item: item[0])
+
+    def usage(self) -> int:
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self) -> tuple:
+        """Delete least recently used packages until the cache fits `limit`; return (count, bytes)."""
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        removed = freed = 0
+        for _, size, paths in entries:
+            if total <= self.limit:
+                break
+            for path in paths:
+                path.unlink(missing_ok=True)
+            total -= size
+            removed += 1
+            freed += size
+        if removed:
+            self.log.info(f"Package cache: evicted {removed} packages ({freed // (1024 * 1024)} MiB)")
+        return removed, freed
+
+    def flush(self) -> None:
+        """Evict and push everything to the stick, which may be pulled right after the install."""
+        try:
+            self.evict()
+        except OSError as e:
+            self.log.warn(f"Package cache eviction failed: {e}")
+        os.sync()
+        self.log.info(
+            f"Package cache at {self.package_dir}: {self.usage() // (1024 * 1024)} MiB "
+            f"of {self.limit // (1024 * 1024)} MiB"
+        )
+
+
+def _cache_limit(log: LogFile) -> int:
+    value = os.environ.get(CACHE_LIMIT_ENV)
+    if not value:
+        return None
+    try:
+        return parse_size(value)
+    except ValueError:
+        log.warn(f"Ignoring invalid {CACHE_LIMIT_ENV}={value!r}")
+        return None
+
+
+def open_package_cache(log: LogFile) -> PackageCache:
+    """Find and mount the persistent cache on the boot media; None when there is none."""
+    limit = _cache_limit(log)
+    directory = os.environ.get(CACHE_DIR_ENV)
+    if directory:
+        try:
+            cache = PackageCache(Path(directory), log, limit)
+        except OSError as e:
+            log.warn(f"{CACHE_DIR_ENV}={directory} is not usable as a package cache: {e}")
+            return None
+        log.info(f"Using package cache directory {cache.root}")
+        return cache
+
+    if not CACHE_BY_LABEL.exists():
+        return None
+    device = CACHE_BY_LABEL.resolve()
+    CACHE_MOUNT_POINT.mkdir(parents=True, exist_ok=True)
+    if not os.path.ismount(CACHE_MOUNT_POINT):
+        result = run(['mount', '-o', 'rw,noatime', str(device), str(CACHE_MOUNT_POINT)], log)
+        if result.returncode != 0:
+            log.warn(f"Found cache partition {device} but could not mount it")
+            return None
+    try:
+        cache = PackageCache(CACHE_MOUNT_POINT, log, limit, device)
+    except OSError as e:
+        log.warn(f"Cache partition {device} is not writable: {e}")
+        return None
+    log.info(f"Using package cache partition {device} at {CACHE_MOUNT_POINT}")
+    return cache
@@ -0,0 +1,359 @@
+import hashlib
+import io
+import json
+import os
+import shutil
+import sqlite3
+import tarfile
+import tempfile
+import time
+from contextlib import closing
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from .commands import run
+from .custom_classes import LogFile
+
+SYNC_DB_DIR = Path('/var/lib/pacman/sync')
+PACMAN_CONF = Path('/etc/pacman.conf')
+INDEX_CACHE_FILE = Path('/var/cache/SENDUNE_installer/package_index.sqlite')
+INDEX_CACHE_VERSION = 1
+# Local repo baked into the ISO by `build_arch_iso.sh --offline-repo`.
+OFFLINE_REPO_NAME = 'sendune-offline'
+OFFLINE_REPO_DIR = Path('/opt/sendune/offline-repo')
+OFFLINE_REPO_DB = OFFLINE_REPO_DIR / f'{OFFLINE_REPO_NAME}.db'
+LIST_FIELDS = ('depends', 'provides', 'replaces', 'groups')
+
+
+@dataclass
+class PackageMetadata:
+    """One package entry from a pacman sync database."""
+    name: str
+    repo: str
+    version: str = ''
+    filename: str = ''
+    csize: int = 0
+    isize: int = 0
+    sha256sum: str = ''
+    depends: list = field(default_factory=list)
+    provides: list = field(default_factory=list)
+    replaces: list = field(default_factory=list)
+    groups: list = field(default_factory=list)
+
+
+def parse_desc(text: str) -> dict:
+    """Parse the %FIELD% blocks of a sync db `desc` file into a dict of lists."""
+    fields = {}
+    key = None
+    for line in text.splitlines():
+        if len(line) > 2 and line.startswith('%') and line.endswith('%'):
+            key = line[1:-1]
+            fields[key] = []
+        elif line and key:
+            fields[key].append(line)
+        else:
+            key = None
+    return fields
+
+
+def strip_version(spec: str) -> str:
+    """Turn a dependency/provides spec such as `sh=5.2` or `glibc>=2.38` into its bare name."""
+    for index, char in enumerate(spec):
+        if char in '<>=':
+            return spec[:index]
+    return spec
+
+
+def _first(fields: dict, key: str, default: str = '') -> str:
+    values = fields.get(key)
+    return values[0] if values else default
+
+
+def _to_int(value: str) -> int:
+    try:
+        return int(value)
+    except ValueError:
+        return 0
+
+
+def metadata_from_desc(fields: dict, repo: str) -> PackageMetadata:
+    return PackageMetadata(
+        name=_first(fields, 'NAME'),
+        repo=repo,
+        version=_first(fields, 'VERSION'),
+        filename=_first(fields, 'FILENAME'),
+        csize=_to_int(_first(fields, 'CSIZE', '0')),
+        isize=_to_int(_first(fields, 'ISIZE', '0')),
+        sha256sum=_first(fields, 'SHA256SUM'),
+        depends=list(fields.get('DEPENDS', [])),
+        provides=list(fields.get('PROVIDES', [])),
+        replaces=list(fields.get('REPLACES', [])),
+        groups=list(fields.get('GROUPS', [])),
+    )
+
+
+def _open_db(db_path: Path) -> tarfile.TarFile:
+    try:
+        return tarfile.open(db_path, mode='r:*')
+    except tarfile.ReadError:
+        # Python's tarfile cannot read zstd; repos built with `repo-add --zstd` need the CLI.
+        if not shutil.which('zstd'):
+            raise
+        data = run(['zstd', '-dc', str(db_path)], binary=True, check=True).output
+        return tarfile.open(fileobj=io.BytesIO(data), mode='r:')
+
+
+def read_sync_db(db_path: Path, repo: str | None = None) -> list:
+    """Read every package entry of one sync database without forking pacman."""
+    repo = repo or db_path.name.split('.')[0]
+    entries = {}
+    with _open_db(db_path) as archive:
+        for member in archive:
+            if not member.isfile():
+                continue
+            entry_dir, _, entry_file = member.name.rpartition('/')
+            # Old-style dbs split dependency fields into a separate `depends` file.
+            if entry_file not in ('desc', 'depends'):
+                continue
+            handle = archive.extractfile(member)
+            if handle is None:
+                continue
+            fields = parse_desc(handle.read().decode('utf-8', errors='replace'))
+            entries.setdefault(entry_dir, {}).update(fields)
+    return [metadata_from_desc(fields, repo) for fields in entries.values() if fields.get('NAME')]
+
+
+def configured_repos(pacman_conf: Path = PACMAN_CONF) -> list:
+    """Return repo names in pacman.conf order, which decides who wins on duplicates."""
+    repos = []
+    try:
+        for line in pacman_conf.read_text(encoding='utf-8').splitlines():
+            line = line.strip()
+            if line.startswith('[') and line.endswith(']') and line != '[options]':
+                repos.append(line[1:-1])
+    except OSError:
+        pass
+    return repos
+
+
+def sync_db_paths(sync_dir: Path = SYNC_DB_DIR, pacman_conf: Path = PACMAN_CONF,
+                  offline_db: Path = OFFLINE_REPO_DB) -> list:
+    available = {path.name[:-len('.db')]: path for path in sorted(sync_dir.glob('*.db'))}
+    ordered = [available.pop(repo) for repo in configured_repos(pacman_conf) if repo in available]
+    # The offline repo goes first, as in the pacman.conf the installer generates for pacstrap.
+    offline = [offline_db] if offline_db.exists() else []
+    return offline + ordered + list(available.values())
+
+
+class PackageIndex():
+    """In-memory name -> metadata map built from the pacman sync databases."""
+
+    def __init__(self, packages: dict | None = None) -> None:
+        self.packages = packages or {}
+        self._providers = None
+        self._replacements = None
+        self._groups = None
+
+    def _build_reverse_indexes(self) -> None:
+        providers, replacements, groups = {}, {}, {}
+        # self.packages preserves repo order, so the first entry of each list is what pacman would pick.
+        for metadata in self.packages.values():
+            for spec in metadata.provides:
+                providers.setdefault(strip_version(spec), []).append(metadata.name)
+            for spec in metadata.replaces:
+                replacements.setdefault(strip_version(spec), []).append(metadata.name)
+            for group in metadata.groups:
+                groups.setdefault(group, []).append(metadata.name)
+        self._providers, self._replacements, self._groups = providers, replacements, groups
+
+    def providers(self, name: str) -> list:
+        """Packages that list `name` in their provides array."""
+        if self._providers is None:
+            self._build_reverse_indexes()
+        return self._providers.get(name, [])
+
+    def replacements(self, name: str) -> list:
+        """Packages that list `name` in their replaces array (i.e. renamed packages)."""
+        if self._replacements is None:
+            self._build_reverse_indexes()
+        return self._replacements.get(name, [])
+
+    def group_members(self, group: str) -> list:
+        if self._groups is None:
+            self._build_reverse_indexes()
+        return self._groups.get(group, [])
+
+    @classmethod
+    def from_sync_dbs(cls, db_paths: list | None = None, log: LogFile | None = None) -> 'PackageIndex':
+        index = cls()
+        for db_path in sync_db_paths() if db_paths is None else db_paths:
+            try:
+                entries = read_sync_db(Path(db_path))
+            except Exception as e:
+                if log:
+                    log.warn(f"Could not read sync database {db_path}: {e}")
+                continue
+            for metadata in entries:
+                index.packages.setdefault(metadata.name, metadata)
+        if log:
+            log.info(f"Package index loaded: {len(index.packages)} packages")
+        return index
+
+    @classmethod
+    def from_cache(cls, cache_file: Path, fingerprint: list) -> 'PackageIndex':
+        """Return the cached index if it was built from exactly these databases, else None."""
+        if not cache_file.exists():
+            return None
+        uri = f"{cache_file.resolve().as_uri()}?mode=ro"
+        with closing(sqlite3.connect(uri, uri=True)) as conn:
+            conn.execute('PRAGMA mmap_size = 268435456')
+            try:
+                meta = dict(conn.execute('SELECT key, value FROM meta'))
+            except sqlite3.DatabaseError:
+                return None
+            if meta.get('version') != str(INDEX_CACHE_VERSION) or meta.get('fingerprint') != json.dumps(fingerprint):
+                return None
+            index = cls()
+            for row in conn.execute('SELECT * FROM packages'):
+                metadata = PackageMetadata(*row)
+                for name in LIST_FIELDS:
+                    value = getattr(metadata, name)
+                    setattr(metadata, name, value.split('\n') if value else [])
+                index.packages[metadata.name] = metadata
+        return index
+
+    def save_cache(self, cache_file: Path, fingerprint: list) -> None:
+        """Write the index as a name-sorted sqlite table next to its db fingerprint."""
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = cache_file.with_name(f"{cache_file.name}.{os.getpid()}.tmp")
+        tmp_file.unlink(missing_ok=True)
+        with closing(sqlite3.connect(tmp_file)) as conn, conn:
+            conn.execute('CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)')
+            conn.execute(
+                'CREATE TABLE packages (name TEXT PRIMARY KEY, repo TEXT, version TEXT, filename TEXT, '
+                'csize INTEGER, isize INTEGER, sha256sum TEXT, depends TEXT, provides TEXT, replaces TEXT, '
+                '"groups" TEXT) WITHOUT ROWID'
+            )
+            conn.executemany('INSERT INTO meta VALUES (?, ?)', [
+                ('version', str(INDEX_CACHE_VERSION)),
+                ('fingerprint', json.dumps(fingerprint)),
+            ])
+            conn.executemany('INSERT INTO packages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', [
+                (m.name, m.repo, m.version, m.filename, m.csize, m.isize, m.sha256sum,
+                 *('\n'.join(getattr(m, name)) for name in LIST_FIELDS))
+                for m in sorted(self.packages.values(), key=lambda m: m.name)
+            ])
+        os.replace(tmp_file, cache_file)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.packages
+
+    def __len__(self) -> int:
+        return len(self.packages)
+
+    def get(self, name: str) -> PackageMetadata:
+        return self.packages.get(name)
+
+    def is_available(self, name: str) -> bool:
+        return name in self.packages
+
+
+def db_fingerprint(db_paths: list) -> list:
+    """Identify the exact sync databases an index was built from (path, size, mtime, sha256)."""
+    fingerprint = []
+    for db_path in db_paths:
+        stat = os.stat(db_path)
+        with open(db_path, 'rb') as f:
+            digest = hashlib.file_digest(f, 'sha256').hexdigest()
+        fingerprint.append([str(db_path), stat.st_size, stat.st_mtime_ns, digest])
+    return fingerprint
+
+
+def load_package_index(log: LogFile | None = None, cache_file: Path = INDEX_CACHE_FILE) -> PackageIndex:
+    """Load the index from the on-disk cache, re-parsing the sync databases only when they changed."""
+    db_paths = sync_db_paths()
+    try:
+        fingerprint = db_fingerprint(db_paths)
+        index = PackageIndex.from_cache(cache_file, fingerprint)
+    except (OSError, sqlite3.Error) as e:
+        if log:
+            log.warn(f"Package index cache unusable: {e}")
+        fingerprint, index = None, None
+    if index is not None:
+        if log:
+            log.info(f"Package index loaded from cache {cache_file}: {len(index.packages)} packages")
+        return index
+
+    index = PackageIndex.from_sync_dbs(db_paths, log=log)
+    if fingerprint and len(index):
+        try:
+            index.save_cache(cache_file, fingerprint)
+        except (OSError, sqlite3.Error) as e:
+            if log:
+                log.warn(f"Could not write package index cache {cache_file}: {e}")
+    return index
+
+
+_package_index = None
+
+
+def get_package_index(log: LogFile | None = None) -> PackageIndex:
+    """Load the sync databases once per process and share the result.
+
+    An empty index (no sync databases yet) is not kept, so the first call after `pacman -Sy` loads them.
+    """
+    global _package_index
+    if _package_index is None:
+        index = load_package_index(log)
+        if not len(index):
+            return index
+        _package_index = index
+    return _package_index
+
+
+def use_package_index(index: PackageIndex) -> None:
+    """Share `index` instead of loading the sync databases (e.g. a synthetic one for benchmarks)."""
+    global _package_index
+    _package_index = index
+
+
+def benchmark_availability(packages: list) -> dict:
+    """Compare the per-package `pacman -Si` fork loop with a single index load."""
+    started = time.perf_counter()
+    forked = [run(['pacman', '-Si', package]).returncode == 0 for package in packages]
+    fork_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    index = PackageIndex.from_sync_dbs()
+    load_seconds = time.perf_counter() - started
+    indexed = [index.is_available(package) for package in packages]
+    index_seconds = time.perf_counter() - started
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cache_file = Path(tmp) / 'package_index.sqlite'
+        fingerprint = db_fingerprint(sync_db_paths())
+        index.save_cache(cache_file, fingerprint)
+        started = time.perf_counter()
+        PackageIndex.from_cache(cache_file, db_fingerprint(sync_db_paths()))
+        cache_load_seconds = time.perf_counter() - started
+
+    return {
+        'packages': len(packages),
+        'fork_seconds': fork_seconds,
+        'index_load_seconds': load_seconds,
+        'index_seconds': index_seconds,
+        'cache_load_seconds': cache_load_seconds,
+        'mismatches': [package for package, a, b in zip(packages, forked, indexed, strict=True) if a != b],
+    }
+
+
+if __name__ == "__main__":
+    from .full_installation import BASE_PACKAGES, DESKTOP_PACKAGES
+
+    result = benchmark_availability(BASE_PACKAGES + DESKTOP_PACKAGES)
+    print(f"Packages checked:      {result['packages']}")
+    print(f"pacman -Si fork loop:  {result['fork_seconds']:.3f}s")
+    print(f"Index load + lookups:  {result['index_seconds']:.3f}s (load {result['index_load_seconds']:.3f}s)")
+    print(f"Warm cache load:       {result['cache_load_seconds']:.3f}s")
+    if result['mismatches']:
+        print("Mismatched answers: " + ", ".join(result['mismatches']))
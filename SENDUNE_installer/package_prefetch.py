@@ -0,0 +1,215 @@
+import platform
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from pathlib import Path
+
+from .custom_classes import LogFile
+from .downloader import DownloadCancelled, Downloader, MirrorPool
+from .package_index import OFFLINE_REPO_NAME, PackageIndex, PackageMetadata
+
+try:
+    import fcntl
+except ImportError:
+    # Windows (mock mode): no other installer shares the cache there.
+    fcntl = None
+
+PACMAN_CACHE_DIR = Path('/var/cache/pacman/pkg')
+MIRRORLIST = Path('/etc/pacman.d/mirrorlist')
+PREFETCH_WORKERS = 4
+# Per-file lock files, so installs sharing a cache directory download each package once.
+LOCK_DIR_NAME = '.sendune-locks'
+
+
+def read_mirrorlist(mirrorlist: Path = MIRRORLIST) -> list:
+    """Return the active `Server =` URL templates in mirrorlist order."""
+    servers = []
+    try:
+        for line in mirrorlist.read_text(encoding='utf-8').splitlines():
+            key, _, value = line.strip().partition('=')
+            if key.strip() == 'Server' and value.strip():
+                servers.append(value.strip())
+    except OSError:
+        pass
+    return servers
+
+
+def package_url(server: str, repo: str, filename: str) -> str:
+    base = server.replace('$repo', repo).replace('$arch', platform.machine() or 'x86_64')
+    return f"{base.rstrip('/')}/{filename}"
+
+
+def is_cached(metadata: PackageMetadata, cache_dir: Path) -> bool:
+    target = Path(cache_dir) / metadata.filename
+    return target.exists() and (not metadata.csize or target.stat().st_size == metadata.csize)
+
+
+def downloadable(metadata: PackageMetadata) -> bool:
+    # Packages in the ISO's offline repo are already on local disk.
+    return metadata is not None and bool(metadata.filename) and metadata.repo != OFFLINE_REPO_NAME
+
+
+@contextmanager
+def cache_file_lock(cache_dir: Path, filename: str):
+    """Hold an exclusive lock on `filename` in `cache_dir`, across threads and processes."""
+    if fcntl is None:
+        yield
+        return
+    lock_dir = Path(cache_dir) / LOCK_DIR_NAME
+    lock_dir.mkdir(parents=True, exist_ok=True)
+    with (lock_dir / filename).open('a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def fetch_package(metadata: PackageMetadata, cache_dir: Path, downloader: Downloader, cancelled=None) -> int:
+    """Download one package into `cache_dir` unless it is already there; return the bytes fetched.
+
+    A download of the same file already running elsewhere (another fleet worker) is waited
+    for instead of repeated.
+    """
+    if is_cached(metadata, cache_dir):
+        return 0
+    with cache_file_lock(cache_dir, metadata.filename):
+        if is_cached(metadata, cache_dir):
+            return 0
+        return downloader.fetch(
+            lambda server: package_url(server, metadata.repo, metadata.filename),
+            cache_dir / metadata.filename,
+            metadata.sha256sum,
+            cancelled
+        )
+
+
+def download_packages(index: PackageIndex, packages, downloader: Downloader, log: LogFile,
+                      cache_dir: Path = PACMAN_CACHE_DIR, max_workers: int = PREFETCH_WORKERS) -> dict:
+    """Fetch every package of `packages` missing from `cache_dir`; return {package: error} for failures."""
+    cache_dir = Path(cache_dir)
+    wanted = [package for package in packages if downloadable(index.get(package))]
+    missing = [package for package in wanted if not is_cached(index.get(package), cache_dir)]
+    failed = {}
+    if not missing:
+        return failed
+    log.info(f"Downloading {len(missing)} of {len(wanted)} packages into {cache_dir}")
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='download') as executor:
+        futures = {
+            executor.submit(fetch_package, index.get(package), cache_dir, downloader): package
+            for package in missing
+        }
+        for future, package in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                failed[package] = str(e)
+    for package, error in sorted(failed.items()):
+        log.warn(f"Download of {package} failed: {error}")
+    return failed
+
+
+class PackagePrefetcher():
+    """Download the selected package closure into pacman's cache while the wizard is still running.
+
+    `sync()` is called with the full wanted set whenever the selection changes; packages that
+    dropped out (e.g. the previous desktop) are cancelled, new ones are queued.
+    """
+
+    def __init__(self, index: PackageIndex, log: LogFile, cache_dir: Path = PACMAN_CACHE_DIR,
+                 downloader: Downloader | None = None, max_workers: int = PREFETCH_WORKERS) -> None:
+        self.index = index
+        self.log = log
+        self.cache_dir = Path(cache_dir)
+        self.downloader = downloader or Downloader(MirrorPool(read_mirrorlist(), log), log)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='prefetch')
+        # Re-entrant: cancelling a future runs its done-callback, which takes the lock again.
+        self._lock = threading.RLock()
+        self._wanted = set()
+        self._inflight = {}
+        self._present = set()
+        self._excluded = set()
+        self._accepting = True
+        self._closed = False
+        self.downloaded = []
+        self.failed = {}
+        self.bytes_downloaded = 0
+
+    @property
+    def mirrors(self) -> list:
+        return self.downloader.pool.servers
+
+    def is_cached(self, package: str) -> bool:
+        return is_cached(self.index.get(package), self.cache_dir)
+
+    def _wants(self, package: str) -> bool:
+        return package not in self._excluded and downloadable(self.index.get(package))
+
+    def sync(self, packages) -> None:
+        """Make the set of prefetched packages match `packages`."""
+        with self._lock:
+            if not self._accepting or not self.mirrors:
+                return
+            self._wanted = {package for package in packages if self._wants(package)}
+            for package, future in list(self._inflight.items()):
+                if package not in self._wanted:
+                    # Pending jobs are dropped outright; running ones stop at their next chunk.
+                    future.cancel()
+            for package in self._wanted:
+                if package in self._inflight or package in self._present:
+                    continue
+                self.failed.pop(package, None)
+                future = self._executor.submit(self._download, package)
+                self._inflight[package] = future
+                future.add_done_callback(lambda _, package=package: self._finished(package))
+
+    def exclude(self, packages) -> None:
+        """Stop prefetching `packages`, e.g. because pacstrap is already downloading them."""
+        with self._lock:
+            self._excluded.update(packages)
+            wanted = set(self._wanted)
+        self.sync(wanted)
+
+    def _finished(self, package: str) -> None:
+        with self._lock:
+            self._inflight.pop(package, None)
+
+    def _still_wanted(self, package: str) -> bool:
+        with self._lock:
+            return not self._closed and package in self._wanted
+
+    def _download(self, package: str) -> None:
+        try:
+            size = fetch_package(
+                self.index.get(package), self.cache_dir, self.downloader,
+                lambda: not self._still_wanted(package)
+            )
+        except DownloadCancelled:
+            return
+        except Exception as e:
+            with self._lock:
+                self.failed[package] = str(e)
+            return
+        with self._lock:
+            self._present.add(package)
+            if size:
+                self.downloaded.append(package)
+                self.bytes_downloaded += size
+
+    def finish(self, timeout: float | None = None) -> None:
+        """Stop queueing, drop pending jobs and wait for downloads already on the wire."""
+        with self._lock:
+            self._accepting = False
+            pending = list(self._inflight.values())
+            for future in pending:
+                future.cancel()
+        wait(pending, timeout=timeout)
+        with self._lock:
+            self._closed = True
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self.log.info(
+            f"Prefetch finished: {len(self.downloaded)} packages ({self.bytes_downloaded // (1024 * 1024)} MiB) "
+            f"downloaded, {len(self.failed)} failed"
+        )
+        for package, error in sorted(self.failed.items()):
+            self.log.warn(f"Prefetch of {package} failed: {error}")
@@ -0,0 +1,101 @@
+from dataclasses import dataclass, field
+
+from .custom_classes import LogFile
+from .package_index import PackageIndex, get_package_index, strip_version
+
+EXACT = 'exact'
+REPLACED = 'replaced'
+PROVIDED = 'provided'
+GROUP = 'group'
+UNRESOLVED = 'unresolved'
+
+
+@dataclass
+class Resolution:
+    """How one requested name maps onto concrete repo packages."""
+    requested: str
+    method: str
+    packages: list = field(default_factory=list)
+    alternatives: list = field(default_factory=list)
+
+
+@dataclass
+class ResolutionReport:
+    resolutions: list = field(default_factory=list)
+
+    @property
+    def packages(self) -> list:
+        """Concrete package names to hand to pacman, deduplicated in request order."""
+        seen = set()
+        ordered = []
+        for resolution in self.resolutions:
+            for package in resolution.packages:
+                if package not in seen:
+                    seen.add(package)
+                    ordered.append(package)
+        return ordered
+
+    @property
+    def unresolved(self) -> list:
+        return [r.requested for r in self.resolutions if r.method == UNRESOLVED]
+
+    @property
+    def substituted(self) -> list:
+        return [r for r in self.resolutions if r.method not in (EXACT, UNRESOLVED)]
+
+    def format_lines(self) -> list:
+        lines = []
+        for resolution in self.substituted:
+            line = f"{resolution.requested!r} -> {', '.join(resolution.packages)} ({resolution.method})"
+            if resolution.alternatives:
+                line += f"; other candidates: {', '.join(resolution.alternatives)}"
+            lines.append(line)
+        if self.unresolved:
+            lines.append(f"Not found in any sync repository: {', '.join(repr(name) for name in self.unresolved)}")
+        return lines
+
+    def log_to(self, log: LogFile) -> None:
+        exact = sum(1 for r in self.resolutions if r.method == EXACT)
+        log.info(
+            f"Package resolution: {exact} exact, {len(self.substituted)} substituted, "
+            f"{len(self.unresolved)} unresolved"
+        )
+        for line in self.format_lines():
+            if line.startswith('Not found'):
+                log.warn(line)
+            else:
+                log.info(f"Resolved {line}")
+
+
+def resolve_package_name(name: str, index: PackageIndex) -> Resolution:
+    """Resolve a single name the way pacman would: exact, then replaces, provides and groups."""
+    requested = name
+    name = strip_version(name.strip())
+    if not name:
+        return Resolution(requested, UNRESOLVED)
+    if index.is_available(name):
+        return Resolution(requested, EXACT, [name])
+
+    for method, candidates in (
+        (REPLACED, index.replacements(name)),
+        (PROVIDED, index.providers(name)),
+    ):
+        if candidates:
+            return Resolution(requested, method, [candidates[0]], list(candidates[1:]))
+
+    members = index.group_members(name)
+    if members:
+        return Resolution(requested, GROUP, list(members))
+    return Resolution(requested, UNRESOLVED)
+
+
+def resolve_package_names(names, index: PackageIndex | None = None, log: LogFile | None = None) -> ResolutionReport:
+    index = index if index is not None else get_package_index(log)
+    report = ResolutionReport()
+    seen = set()
+    for name in names:
+        if not name or name in seen:
+            continue
+        seen.add(name)
+        report.resolutions.append(resolve_package_name(name, index))
+    return report
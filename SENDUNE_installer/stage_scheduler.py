@@ -0,0 +1,165 @@
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from .custom_classes import LogFile
+from .install_journal import InstallJournal, Stage, restore_stage, run_stage
+
+STAGE_WORKERS = 4
+CRITICAL_PATH_SHOWN = 5
+
+
+class ScheduleConflict(Exception):
+    pass
+
+
+def is_barrier(stage: Stage) -> bool:
+    """Stages that declare no resources (e.g. the interactive ones) run alone, in list order."""
+    return not stage.reads and not stage.writes
+
+
+def stage_dependencies(stages: list) -> dict:
+    """{stage name: names of the stages it waits for}, from list order and declared resources.
+
+    A stage waits for every earlier stage that writes what it reads or writes, or reads what
+    it writes. Reading a resource that only a later stage writes is an ordering mistake in
+    the list and raises ScheduleConflict rather than silently reading stale state.
+    """
+    names = [stage.name for stage in stages]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ScheduleConflict(f"Duplicate stage names: {', '.join(duplicates)}")
+
+    dependencies = {}
+    for index, stage in enumerate(stages):
+        earlier = stages[:index]
+        reads, writes = set(stage.reads), set(stage.writes)
+        if is_barrier(stage):
+            dependencies[stage.name] = {other.name for other in earlier}
+            continue
+        dependencies[stage.name] = {
+            other.name for other in earlier
+            if is_barrier(other) or set(other.writes) & (reads | writes) or set(other.reads) & writes
+        }
+        for resource in sorted(reads):
+            if any(resource in other.writes for other in earlier):
+                continue
+            later = [other.name for other in stages[index + 1:] if resource in other.writes]
+            if later:
+                raise ScheduleConflict(
+                    f"Stage {stage.name} reads {resource!r}, which {later[0]} writes later; "
+                    f"move {stage.name} after {later[0]}"
+                )
+    return dependencies
+
+
+class StageScheduler():
+    """Run stages as a DAG: independent ones on a thread pool, barriers on the calling thread.
+
+    Stages the journal has as done are skipped. After a failure no new stages start; the
+    ones already running finish and the first error is raised.
+    """
+
+    def __init__(self, stages: list, journal: InstallJournal, log: LogFile, max_workers: int = STAGE_WORKERS) -> None:
+        self.stages = list(stages)
+        self.dependencies = stage_dependencies(self.stages)
+        self.journal = journal
+        self.log = log
+        self.max_workers = max_workers
+        self.durations = {}
+        self.skipped = []
+        self.wall_time = 0.0
+
+    def run(self, installer, *args) -> None:
+        pending = list(self.stages)
+        finished = set()
+        running = {}
+        error = None
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='stage') as executor:
+            try:
+                while pending or running:
+                    progressed = True
+                    while progressed and error is None:
+                        progressed = False
+                        for stage in [stage for stage in pending if self.dependencies[stage.name] <= finished]:
+                            pending.remove(stage)
+                            progressed = True
+                            if stage.journaled and self.journal.is_done(stage.name):
+                                restore_stage(stage, self.journal, installer, self.log)
+                                self.durations[stage.name] = 0.0
+                                self.skipped.append(stage.name)
+                                finished.add(stage.name)
+                            elif is_barrier(stage):
+                                # Everything before it is finished, and nothing after it can start.
+                                self.durations[stage.name] = run_stage(stage, self.journal, installer, self.log, *args)
+                                finished.add(stage.name)
+                            else:
+                                running[executor.submit(
+                                    run_stage, stage, self.journal, installer, self.log, *args
+                                )] = stage
+                    if not running:
+                        break
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        stage = running.pop(future)
+                        try:
+                            self.durations[stage.name] = future.result()
+                        except BaseException as e:
+                            self.log.error(f"Stage {stage.name} failed: {e}")
+                            error = error or e
+                            continue
+                        finished.add(stage.name)
+            finally:
+                self.wall_time = time.monotonic() - started
+        if error is not None:
+            raise error
+
+    def critical_path(self) -> tuple:
+        """(seconds, [stage names]) of the longest dependency chain by measured duration."""
+        length, previous = {}, {}
+        for stage in self.stages:
+            if stage.name not in self.durations:
+                continue
+            before = [name for name in self.dependencies[stage.name] if name in length]
+            best = max(before, key=lambda name: length[name], default=None)
+            length[stage.name] = self.durations[stage.name] + (length[best] if best else 0.0)
+            previous[stage.name] = best
+        if not length:
+            return 0.0, []
+        name = max(length, key=length.get)
+        total, path = length[name], []
+        while name:
+            path.append(name)
+            name = previous[name]
+        return total, path[::-1]
+
+    def format_report(self) -> list:
+        total, path = self.critical_path()
+        sequential = sum(self.durations.values())
+        lines = [
+            (
+                f"Stages: {len(self.durations) - len(self.skipped)} run, {len(self.skipped)} skipped; "
+                f"{self.wall_time:.1f}s wall time, {sequential:.1f}s if run one after another"
+            ),
+            f"Critical path: {total:.1f}s over {len(path)} stages",
+        ]
+        longest = sorted(path, key=lambda name: self.durations[name], reverse=True)[:CRITICAL_PATH_SHOWN]
+        for name in [name for name in longest if self.durations[name] >= 0.05]:
+            lines.append(f"  {name}: {self.durations[name]:.1f}s")
+        return lines
+
+    def log_report(self) -> None:
+        _, path = self.critical_path()
+        for line in self.format_report():
+            self.log.info(line)
+        self.log.info(f"Critical path: {' -> '.join(f'{name} ({self.durations[name]:.1f}s)' for name in path)}")
+
+
+def run_stage_graph(stages: list, journal: InstallJournal, installer, log: LogFile, *args,
+                    max_workers: int = STAGE_WORKERS) -> StageScheduler:
+    scheduler = StageScheduler(stages, journal, log, max_workers)
+    try:
+        scheduler.run(installer, *args)
+    finally:
+        scheduler.log_report()
+    return scheduler
@@ -0,0 +1,248 @@
+import os
+from collections import deque
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from .custom_classes import LogFile
+
+SYSTEM_UNIT_PATHS = ('etc/systemd/system', 'usr/local/lib/systemd/system', 'usr/lib/systemd/system')
+USER_UNIT_PATHS = ('etc/systemd/user', 'usr/local/lib/systemd/user', 'usr/lib/systemd/user')
+SYSTEM_CONFIG_DIR = 'etc/systemd/system'
+USER_CONFIG_DIR = 'etc/systemd/user'
+UNIT_SUFFIXES = (
+    '.service', '.socket', '.timer', '.path', '.target', '.mount',
+    '.automount', '.swap', '.slice', '.scope', '.device',
+)
+INSTALL_LIST_KEYS = ('WantedBy', 'RequiredBy', 'UpheldBy', 'Alias', 'Also')
+DEPENDENCY_DIRS = {'WantedBy': 'wants', 'RequiredBy': 'requires', 'UpheldBy': 'upholds'}
+MAX_SYMLINK_HOPS = 40
+
+SYSTEM = 'system'
+USER = 'user'
+
+
+def unit_name(name: str) -> str:
+    """`sshd` -> `sshd.service`, like systemctl does for bare names."""
+    name = name.strip()
+    return name if name.endswith(UNIT_SUFFIXES) else f"{name}.service"
+
+
+def split_instance(name: str) -> tuple:
+    """`getty@tty1.service` -> ('getty@.service', 'tty1'); non-templates give (name, None)."""
+    prefix, at, rest = name.partition('@')
+    if not at:
+        return name, None
+    instance, _, suffix = rest.rpartition('.')
+    return f"{prefix}@.{suffix}", instance or None
+
+
+def parse_install_section(text: str) -> dict:
+    """Return the [Install] keys of a unit file; list keys accumulate, an empty value resets them."""
+    install = {key: [] for key in INSTALL_LIST_KEYS}
+    install['DefaultInstance'] = None
+    section = None
+    pending = ''
+    for raw_line in text.splitlines():
+        line = pending + raw_line.strip()
+        if line.endswith('\\'):
+            pending = line[:-1] + ' '
+            continue
+        pending = ''
+        if not line or line[0] in '#;':
+            continue
+        if line.startswith('[') and line.endswith(']'):
+            section = line[1:-1]
+            continue
+        if section != 'Install' or '=' not in line:
+            continue
+        key, _, value = line.partition('=')
+        key, value = key.strip(), value.strip()
+        if key == 'DefaultInstance':
+            install[key] = value or None
+        elif key in INSTALL_LIST_KEYS:
+            if value:
+                install[key].extend(value.split())
+            else:
+                install[key] = []
+    return install
+
+
+def expand_specifiers(value: str, name: str) -> str:
+    """Expand the specifiers that are meaningful in [Install]: %n %N %p %i %I %%."""
+    template, instance = split_instance(name)
+    prefix = template.partition('@')[0] if instance is not None else name.rpartition('.')[0]
+    replacements = {
+        'n': name,
+        'N': name.rpartition('.')[0],
+        'p': prefix,
+        'i': instance or '',
+        'I': instance or '',
+        '%': '%',
+    }
+    out = []
+    chars = iter(value)
+    for char in chars:
+        if char == '%':
+            specifier = next(chars, '')
+            out.append(replacements.get(specifier, f"%{specifier}"))
+        else:
+            out.append(char)
+    return ''.join(out)
+
+
+def resolve_in_root(root: Path, path: str) -> str:
+    """Follow symlinks of `path` (absolute inside `root`) without escaping to the host.
+
+    Returns the final absolute in-target path, or None for broken links and loops.
+    """
+    for _ in range(MAX_SYMLINK_HOPS):
+        host_path = root / path.lstrip('/')
+        if not host_path.is_symlink():
+            return path if host_path.exists() or path == '/dev/null' else None
+        link = os.readlink(host_path)
+        path = link if link.startswith('/') else os.path.normpath(os.path.join(os.path.dirname(path), link))
+    return None
+
+
+@dataclass
+class UnitFile:
+    name: str
+    scope: str
+    path: str
+    install: dict
+
+
+@dataclass
+class UnitEnableReport:
+    enabled: dict = field(default_factory=dict)
+    user: list = field(default_factory=list)
+    static: list = field(default_factory=list)
+    masked: list = field(default_factory=list)
+    missing: list = field(default_factory=list)
+
+    def format_lines(self) -> list:
+        lines = []
+        for unit, links in self.enabled.items():
+            scope = 'user unit, enabled globally' if unit in self.user else 'system unit'
+            lines.append(f"Enabled {unit} ({scope}): {', '.join(links) if links else 'already enabled'}")
+        if self.static:
+            lines.append(f"No [Install] section, nothing to enable: {', '.join(self.static)}")
+        if self.masked:
+            lines.append(f"Masked, not enabled: {', '.join(self.masked)}")
+        if self.missing:
+            lines.append(f"Unit file not found in the target: {', '.join(self.missing)}")
+        return lines
+
+    def log_to(self, log: LogFile) -> None:
+        log.info(
+            f"Unit enablement: {len(self.enabled)} enabled ({len(self.user)} user), "
+            f"{len(self.static)} static, {len(self.masked)} masked, {len(self.missing)} missing"
+        )
+        for line in self.format_lines():
+            if line.startswith(('Masked', 'Unit file not found')):
+                log.warn(line)
+            else:
+                log.info(line)
+
+
+class UnitEnabler():
+    """Enable units in an offline root the way `systemctl enable` does, without forking.
+
+    Units are looked up in the target's system unit paths first and then in the user unit
+    paths; user units are enabled globally under /etc/systemd/user like `systemctl --global`.
+    """
+
+    def __init__(self, root: Path) -> None:
+        self.root = Path(root)
+
+    def find_unit(self, name: str, scopes=(SYSTEM, USER)) -> tuple:
+        """Return (UnitFile, None), (None, 'masked') or (None, 'missing')."""
+        template, instance = split_instance(name)
+        search = {SYSTEM: SYSTEM_UNIT_PATHS, USER: USER_UNIT_PATHS}
+        for scope in scopes:
+            for directory in search[scope]:
+                for candidate in (name, template) if instance is not None else (name,):
+                    resolved = resolve_in_root(self.root, f"/{directory}/{candidate}")
+                    if resolved == '/dev/null':
+                        return None, 'masked'
+                    if resolved is None:
+                        continue
+                    if instance is None:
+                        # Enabling an alias enables the unit it points to.
+                        name = os.path.basename(resolved)
+                    text = (self.root / resolved.lstrip('/')).read_text(encoding='utf-8', errors='replace')
+                    return UnitFile(name, scope, resolved, parse_install_section(text)), None
+        return None, 'missing'
+
+    def _link(self, scope: str, link: str, target: str) -> bool:
+        """Create `link` (relative to the scope's config dir) -> `target`; False if already there."""
+        config_dir = SYSTEM_CONFIG_DIR if scope == SYSTEM else USER_CONFIG_DIR
+        host_link = self.root / config_dir / link
+        if host_link.is_symlink() and os.readlink(host_link) == target:
+            return False
+        host_link.parent.mkdir(parents=True, exist_ok=True)
+        staging = host_link.with_name(f".{host_link.name}.sendune-tmp")
+        staging.unlink(missing_ok=True)
+        os.symlink(target, staging)
+        os.replace(staging, host_link)
+        return True
+
+    def _enable_unit(self, unit: UnitFile, report: UnitEnableReport) -> list:
+        """Create the unit's links and return the units named by Also=."""
+        install = unit.install
+        name = unit.name
+        if '@.' in name:
+            # A bare template can only be enabled through its DefaultInstance=.
+            if not install['DefaultInstance']:
+                report.static.append(name)
+                return list(install['Also'])
+            name = name.replace('@.', f"@{install['DefaultInstance']}.")
+
+        links = []
+        for key, suffix in DEPENDENCY_DIRS.items():
+            for target in install[key]:
+                target = expand_specifiers(target, name)
+                link = f"{target}.{suffix}/{name}"
+                if self._link(unit.scope, link, unit.path):
+                    links.append(link)
+        for alias in install['Alias']:
+            alias = expand_specifiers(alias, name)
+            if self._link(unit.scope, alias, unit.path):
+                links.append(alias)
+
+        if not any(install[key] for key in INSTALL_LIST_KEYS):
+            report.static.append(name)
+        elif any(install[key] for key in ('WantedBy', 'RequiredBy', 'UpheldBy', 'Alias')):
+            report.enabled[name] = links
+            if unit.scope == USER:
+                report.user.append(name)
+        return [expand_specifiers(also, name) for also in install['Also']]
+
+    def enable(self, names) -> UnitEnableReport:
+        """Enable every unit in `names` (plus their Also= units) in one pass."""
+        report = UnitEnableReport()
+        seen = set()
+        queue = deque((unit_name(name), (SYSTEM, USER)) for name in names if name and name.strip())
+        while queue:
+            name, scopes = queue.popleft()
+            if name in seen:
+                continue
+            seen.add(name)
+            unit, problem = self.find_unit(name, scopes)
+            if unit is None:
+                getattr(report, problem).append(name)
+                continue
+            if unit.name != name:
+                if unit.name in seen:
+                    continue
+                seen.add(unit.name)
+            for also in self._enable_unit(unit, report):
+                queue.append((unit_name(also), (unit.scope,)))
+        return report
+
+
+def enable_units(root: Path, names, log: LogFile | None = None) -> UnitEnableReport:
+    report = UnitEnabler(root).enable(names)
+    if log is not None:
+        report.log_to(log)
+    return report
@@ -0,0 +1,169 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+
+# Span categories. Time spent in USER spans (waiting at a prompt) is think time; it is
+# subtracted from every span around it to get that span's machine time.
+STAGE = 'stage'
+STEP = 'step'
+CHROOT = 'chroot'
+COMMAND = 'command'
+PACSTRAP = 'pacstrap'
+DOWNLOAD = 'download'
+BUILD = 'build'
+USER = 'user'
+SUMMARY_ROWS = 20
+NAME_WIDTH = 48
+
+
+@dataclass
+class Span:
+    name: str
+    category: str
+    start: float
+    thread: int
+    args: dict = field(default_factory=dict)
+    duration: float = 0.0
+    think: float = 0.0
+    error: str = ''
+
+    @property
+    def machine(self) -> float:
+        return self.duration - self.think
+
+
+class Tracer():
+    """Nested, per-thread timing spans for one installer process."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.origin = time.monotonic()
+            self.spans = []
+            self.thread_names = {}
+
+    def _stack(self) -> list:
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    @contextmanager
+    def span(self, name: str, category: str, **args):
+        thread = threading.get_ident()
+        item = Span(name, category, time.monotonic() - self.origin, thread, args)
+        stack = self._stack()
+        stack.append(item)
+        try:
+            yield item
+        except BaseException as e:
+            item.error = str(e) or type(e).__name__
+            raise
+        finally:
+            item.duration = time.monotonic() - self.origin - item.start
+            stack.pop()
+            if category == USER:
+                item.think = item.duration
+                for parent in stack:
+                    parent.think += item.duration
+            with self._lock:
+                self.thread_names.setdefault(thread, threading.current_thread().name)
+                self.spans.append(item)
+
+    def current(self, category: str) -> str:
+        """Name of the innermost open span of `category` on this thread, or None."""
+        for span in reversed(self._stack()):
+            if span.category == category:
+                return span.name
+        return None
+
+    def think_time(self) -> float:
+        with self._lock:
+            return sum(span.duration for span in self.spans if span.category == USER)
+
+    def chrome_trace(self) -> dict:
+        """The spans as Chrome trace events (chrome://tracing, Perfetto)."""
+        pid = os.getpid()
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span.start)
+            thread_names = dict(self.thread_names)
+        events = [
+            {'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': thread, 'args': {'name': name}}
+            for thread, name in thread_names.items()
+        ]
+        for span in spans:
+            args = dict(span.args, think_ms=round(span.think * 1000, 3), machine_ms=round(span.machine * 1000, 3))
+            if span.error:
+                args['error'] = span.error
+            events.append({
+                'name': span.name,
+                'cat': span.category,
+                'ph': 'X',
+                'ts': round(span.start * 1e6),
+                'dur': round(span.duration * 1e6),
+                'pid': pid,
+                'tid': span.thread,
+                'args': args,
+            })
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def export(self, path: Path) -> Path:
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f"{path.name}.tmp")
+        tmp_path.write_text(json.dumps(self.chrome_trace()), encoding='utf-8')
+        os.replace(tmp_path, path)
+        return path
+
+    def summary_lines(self, rows: int = SUMMARY_ROWS) -> list:
+        """Totals per (category, name), longest machine time first, plus think vs machine time overall."""
+        with self._lock:
+            spans = list(self.spans)
+        if not spans:
+            return []
+        totals = {}
+        for span in spans:
+            if span.category == USER:
+                continue
+            total = totals.setdefault((span.category, span.name), [0, 0.0, 0.0])
+            total[0] += 1
+            total[1] += span.duration
+            total[2] += span.think
+        wall = max(span.start + span.duration for span in spans) - min(span.start for span in spans)
+        think = sum(span.duration for span in spans if span.category == USER)
+        prompts = sum(1 for span in spans if span.category == USER)
+        lines = [
+            f"{'category':<9} {'name':<{NAME_WIDTH}} {'count':>5} {'wall':>9} {'think':>9} {'machine':>9}",
+        ]
+        ranked = sorted(totals.items(), key=lambda item: item[1][1] - item[1][2], reverse=True)
+        for (category, name), (count, duration, span_think) in ranked[:rows]:
+            if len(name) > NAME_WIDTH:
+                name = name[:NAME_WIDTH - 3] + '...'
+            lines.append(
+                f"{category:<9} {name:<{NAME_WIDTH}} {count:>5} {duration:>8.1f}s {span_think:>8.1f}s "
+                f"{duration - span_think:>8.1f}s"
+            )
+        lines.append(
+            f"Total {wall:.1f}s: {think:.1f}s waiting on the operator at {prompts} prompts, "
+            f"{wall - think:.1f}s machine time"
+        )
+        return lines
+
+
+TRACER = Tracer()
+
+
+def trace_span(name: str, category: str, **args):
+    """`with trace_span(...):` records a span on the process-wide tracer."""
+    return TRACER.span(name, category, **args)
+
+
+def trace_path(log_path: Path) -> Path:
+    return Path(log_path).with_name(f"{Path(log_path).stem}.trace.json")
@@ -0,0 +1,524 @@
+import argparse
+import contextlib
+import hashlib
+import json
+import platform
+import re
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from .benchmark import SyntheticIndex, benchmark_installer, benchmark_stages
+from .chroot_session import CHROOT_LISTENERS, CHROOT_SOURCES
+from .commands import COMMAND_LISTENERS, COMMAND_SOURCES, CommandResult, command_tool
+from .custom_classes import LogFile
+from .full_installation import full_installation
+from .install_journal import SECRET_PLACEHOLDER, SECRET_PROMPT_RE, STAGE_LISTENERS, InstallJournal
+from .installer_functions import BASE_PACKAGES, DESKTOP_PACKAGES
+from .narchs_logos import ANSWER_LISTENERS, ANSWER_SOURCES, RGB3DLogo
+from .package_index import PackageIndex, get_package_index, use_package_index
+from .tracing import STAGE, TRACER, USER
+
+TRANSCRIPT_VERSION = 1
+# Output up to this size is kept so a replay can hand it back; larger output keeps only its digest.
+OUTPUT_LIMIT = 64 * 1024
+TARGET_PLACEHOLDER = '<target>'
+# Installer state a replay cannot rebuild from the answers alone (creating accounts needs archinstall).
+RECORDED_STATE = ('user_names', 'aur_candidates')
+DOWNLOAD_SIZE_RE = re.compile(r'Total Download Size:\s*([\d.]+)\s*(B|KiB|MiB|GiB)')
+SIZE_UNITS = {'B': 1, 'KiB': 1024, 'MiB': 1024 ** 2, 'GiB': 1024 ** 3}
+# Replays sleep the recorded durations times this factor; the reported times add the rest back.
+REPLAY_SPEED = 0.1
+# Assumed mirror throughput (MiB/s) for the prefetch what-if.
+PREFETCH_BANDWIDTH = 10.0
+# Their work is Python-side network I/O, which a replay cannot reproduce offline; they keep the recorded time.
+OFFLINE_SKIPPED_STAGES = ('aur-packages',)
+# Recorded answers to these steps would rank mirrors over the network or create accounts through
+# archinstall; the replay skips both and restores the accounts from RECORDED_STATE instead.
+REPLAY_ANSWERS = {
+    'interactive_find_mirrors': ['n'],
+    'interactive_add_users': ['n', '', '', 'n', 'n'],
+}
+STAGES_SHOWN = 15
+
+
+class TranscriptError(Exception):
+    pass
+
+
+def output_digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def download_bytes(stdout: str) -> int:
+    """What pacman said it would download ("Total Download Size"), summed over its transactions."""
+    return int(sum(float(size) * SIZE_UNITS[unit] for size, unit in DOWNLOAD_SIZE_RE.findall(stdout)))
+
+
+def masked_config(config: dict) -> dict:
+    """The unattended config with its secret (`!`-prefixed) values replaced by a placeholder."""
+    if config is None:
+        return None
+    return {key: SECRET_PLACEHOLDER if key.startswith('!') else value for key, value in config.items()}
+
+
+def covered_time(intervals) -> float:
+    """Length of the union of (start, end) intervals."""
+    total, covered_until = 0.0, None
+    for start, end in sorted(intervals):
+        if covered_until is None or start > covered_until:
+            total += end - start
+            covered_until = end
+        elif end > covered_until:
+            total += end - covered_until
+            covered_until = end
+    return total
+
+
+def think_time(prompt: str) -> float:
+    """How long the operator took on `prompt`: the latest USER span of this thread with its name."""
+    thread = threading.get_ident()
+    for span in reversed(list(TRACER.spans)):
+        if span.category == USER and span.thread == thread and span.name == prompt.strip():
+            return span.duration
+    return 0.0
+
+
+class TranscriptRecorder():
+    """Writes every external command, chroot command, operator answer and stage event of one install
+    to a JSON lines file, enough to replay the install offline with `replay_transcript`.
+
+    Command input (passwords on stdin) is never written, command lines whose display hides part of
+    them are written as displayed, and answers to secret prompts and secret config values are masked.
+    """
+
+    def __init__(self, path: Path, installer, log: LogFile) -> None:
+        self.path = Path(path)
+        self.installer = installer
+        self.log = log
+        self._lock = threading.Lock()
+        self._origin = time.monotonic()
+        self._state = {}
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = self.path.open('w', encoding='utf-8')
+        self._write({
+            'kind': 'header',
+            'version': TRANSCRIPT_VERSION,
+            'recorded': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'host': platform.node(),
+            'mount_point': str(installer.mount_point),
+            'install_config': masked_config(getattr(installer, 'install_config', None)),
+            # Without sync databases every availability check was a `pacman -Si` the transcript holds.
+            'package_index': len(get_package_index(log)) > 0,
+        })
+
+    def _write(self, entry: dict) -> None:
+        entry['t'] = round(time.monotonic() - self._origin, 6)
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(json.dumps(entry) + '\n')
+            self._file.flush()
+
+    def attach(self) -> 'TranscriptRecorder':
+        COMMAND_LISTENERS.append(self.record_command)
+        CHROOT_LISTENERS.append(self.record_chroot)
+        ANSWER_LISTENERS.append(self.record_answer)
+        STAGE_LISTENERS.append(self.record_stage)
+        self.log.info(f"Recording the install transcript to {self.path}")
+        return self
+
+    def close(self) -> None:
+        for listeners, listener in (
+            (COMMAND_LISTENERS, self.record_command),
+            (CHROOT_LISTENERS, self.record_chroot),
+            (ANSWER_LISTENERS, self.record_answer),
+            (STAGE_LISTENERS, self.record_stage),
+        ):
+            if listener in listeners:
+                listeners.remove(listener)
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def record_command(self, result: CommandResult, cwd) -> None:
+        data = result.output or result.stdout.encode()
+        self._write({
+            'kind': 'command',
+            'stage': TRACER.current(STAGE),
+            'display': result.display,
+            'tool': result.tool,
+            'cwd': str(cwd) if cwd else None,
+            'returncode': result.returncode,
+            'timed_out': result.timed_out,
+            'duration': round(result.wall, 6),
+            'digest': output_digest(data),
+            'stdout': result.stdout if not result.output and len(data) <= OUTPUT_LIMIT else None,
+            'stderr': result.stderr[-OUTPUT_LIMIT:],
+            'download_bytes': download_bytes(result.stdout),
+        })
+
+    def record_chroot(self, result) -> None:
+        data = result.output.encode()
+        self._write({
+            'kind': 'chroot',
+            'stage': TRACER.current(STAGE),
+            'command': result.command,
+            'returncode': result.returncode,
+            'timed_out': result.timed_out,
+            'duration': round(result.duration, 6),
+            'digest': output_digest(data),
+            'output': result.output if len(data) <= OUTPUT_LIMIT else None,
+        })
+
+    def record_answer(self, prompt: str, response: str) -> None:
+        self._write({
+            'kind': 'answer',
+            'step': getattr(self.installer, 'current_step', None),
+            'prompt': prompt.strip(),
+            'answer': SECRET_PLACEHOLDER if response and SECRET_PROMPT_RE.search(prompt) else response,
+            'think': round(think_time(prompt), 6),
+        })
+
+    def record_stage(self, name: str, status: str) -> None:
+        self._write({'kind': 'stage', 'name': name, 'status': status})
+        if status != 'done':
+            return
+        for attribute in RECORDED_STATE:
+            value = getattr(self.installer, attribute, None)
+            if value is not None and value != self._state.get(attribute):
+                self._state[attribute] = list(value)
+                self._write({'kind': 'state', 'name': attribute, 'value': list(value)})
+
+
+def read_transcript(path: Path) -> list:
+    try:
+        entries = [json.loads(line) for line in Path(path).read_text(encoding='utf-8').splitlines() if line]
+    except (OSError, ValueError) as e:
+        raise TranscriptError(f"Cannot read transcript {path}: {e}") from e
+    if not entries or entries[0].get('kind') != 'header':
+        raise TranscriptError(f"{path} is not an install transcript")
+    if entries[0].get('version') != TRANSCRIPT_VERSION:
+        raise TranscriptError(f"Transcript {path} has unknown version {entries[0].get('version')}")
+    return entries
+
+
+def recorded_state(entries: list) -> dict:
+    return {entry['name']: entry['value'] for entry in entries if entry['kind'] == 'state'}
+
+
+def stage_durations(entries: list) -> dict:
+    """{stage: seconds} between each stage's last `running` and the `done`/`failed` after it."""
+    started, durations = {}, {}
+    for entry in entries:
+        if entry['kind'] != 'stage':
+            continue
+        if entry['status'] == 'running':
+            started[entry['name']] = entry['t']
+        elif entry['name'] in started:
+            durations[entry['name']] = entry['t'] - started.pop(entry['name'])
+    return durations
+
+
+def recorded_wall_time(entries: list) -> float:
+    times = [entry['t'] for entry in entries if entry['kind'] == 'stage']
+    return max(times) - min(times) if times else 0.0
+
+
+def batch_chroot_commands(entries: list, bandwidth: float = PREFETCH_BANDWIDTH) -> list:
+    """What if each stage sent all its chroot commands in one exchange.
+
+    Every command after a stage's first saves one round trip through the session shell,
+    estimated as the fastest recorded chroot command.
+    """
+    commands = [entry for entry in entries if entry['kind'] == 'chroot']
+    if not commands:
+        return entries
+    round_trip = min(entry['duration'] for entry in commands)
+    batched = set()
+    for entry in commands:
+        if entry['stage'] in batched:
+            entry['duration'] = max(0.0, entry['duration'] - round_trip)
+        batched.add(entry['stage'])
+    return entries
+
+
+def prefetch_packages(entries: list, bandwidth: float = PREFETCH_BANDWIDTH) -> list:
+    """What if the packages had been downloaded while the operator answered the wizard.
+
+    pacstrap loses its download time (download size at `bandwidth` MiB/s) as far as the
+    recorded think time, spent first come first served, can hide it.
+    """
+    hideable = sum(entry['think'] for entry in entries if entry['kind'] == 'answer')
+    for entry in entries:
+        if entry['kind'] != 'command' or not entry.get('download_bytes'):
+            continue
+        hidden = min(entry['duration'], entry['download_bytes'] / (bandwidth * 1024 ** 2), hideable)
+        entry['duration'] -= hidden
+        hideable -= hidden
+    return entries
+
+
+WHAT_IFS = {
+    'batch-chroot': batch_chroot_commands,
+    'prefetch': prefetch_packages,
+}
+
+
+class TranscriptPlayer():
+    """Answers commands, chroot commands and prompts from a transcript instead of running them.
+
+    A command takes the next unused recorded command with the same command line (the recorded
+    mount point replaced by the replay's), else the next unused one of the same tool. Each takes
+    its recorded duration times `speed`; anything the transcript lacks succeeds at once.
+    Every wait is kept as (stage, start, end) so `waited` can scale the replay back up.
+    """
+
+    def __init__(self, entries: list, installer, log: LogFile, speed: float = REPLAY_SPEED) -> None:
+        self.installer = installer
+        self.log = log
+        self.speed = speed
+        self.recorded_root = entries[0]['mount_point']
+        self.replay_root = str(installer.mount_point)
+        self.commands = [entry for entry in entries if entry['kind'] == 'command']
+        self.chroot_commands = [entry for entry in entries if entry['kind'] == 'chroot']
+        self.answers = {}
+        for entry in entries:
+            if entry['kind'] == 'answer':
+                key = entry['step'] if entry['step'] is not None else entry['prompt']
+                self.answers.setdefault(key, []).append((entry['answer'], entry['think']))
+        for step, answers in REPLAY_ANSWERS.items():
+            think = sum(recorded_think for _, recorded_think in self.answers.get(step, []))
+            self.answers[step] = [(answer, think if position == 0 else 0.0) for position, answer in enumerate(answers)]
+        self.unmatched = []
+        self.waits = []
+        self._used = set()
+        self._lock = threading.Lock()
+
+    def attach(self) -> 'TranscriptPlayer':
+        COMMAND_SOURCES.append(self.command_source)
+        CHROOT_SOURCES.append(self.chroot_source)
+        ANSWER_SOURCES.append(self.answer_source)
+        return self
+
+    def detach(self) -> None:
+        for sources, source in (
+            (COMMAND_SOURCES, self.command_source),
+            (CHROOT_SOURCES, self.chroot_source),
+            (ANSWER_SOURCES, self.answer_source),
+        ):
+            if source in sources:
+                sources.remove(source)
+
+    def _take(self, entries: list, key: str, text_field: str, loose) -> dict:
+        """The next unused entry whose normalized `text_field` is `key`, else the first `loose` one."""
+        with self._lock:
+            unused = [entry for entry in entries if id(entry) not in self._used]
+            entry = next(
+                (entry for entry in unused if entry[text_field].replace(self.recorded_root, TARGET_PLACEHOLDER) == key),
+                next((entry for entry in unused if loose(entry)), None)
+            )
+            if entry is not None:
+                self._used.add(id(entry))
+            return entry
+
+    def _wait(self, seconds: float) -> None:
+        if seconds <= 0:
+            return
+        started = time.monotonic()
+        time.sleep(seconds * self.speed)
+        with self._lock:
+            self.waits.append((TRACER.current(STAGE), started, time.monotonic()))
+
+    def waited(self, stage: str | None = None) -> float:
+        """Wall time during which something (in `stage`, if given) waited on the transcript."""
+        with self._lock:
+            return covered_time((start, end) for name, start, end in self.waits if stage is None or name == stage)
+
+    def _unmatched(self, text: str) -> None:
+        with self._lock:
+            self.unmatched.append(text)
+        self.log.warn(f"Replay: not in the transcript, treated as succeeded: {text}")
+
+    def command_source(self, argv: list, display: str) -> CommandResult:
+        tool = command_tool(argv)
+        entry = self._take(
+            self.commands, display.replace(self.replay_root, TARGET_PLACEHOLDER), 'display',
+            lambda entry: entry['tool'] == tool
+        )
+        if entry is None:
+            self._unmatched(display)
+            return CommandResult(argv, display, 0)
+        self._wait(entry['duration'])
+        return CommandResult(
+            argv, display, entry['returncode'], stdout=entry['stdout'] or '', stderr=entry['stderr'],
+            wall=entry['duration'], timed_out=entry['timed_out']
+        )
+
+    def chroot_source(self, command: str) -> tuple:
+        words = command.split()[:1]
+        entry = self._take(
+            self.chroot_commands, command.replace(self.replay_root, TARGET_PLACEHOLDER), 'command',
+            lambda entry: entry['command'].split()[:1] == words
+        )
+        if entry is None:
+            self._unmatched(f"chroot: {command}")
+            return 0, ''
+        self._wait(entry['duration'])
+        return entry['returncode'], entry['output'] or ''
+
+    def answer_source(self, prompt: str) -> str:
+        step = getattr(self.installer, 'current_step', None)
+        with self._lock:
+            answers = self.answers.get(step if step is not None else prompt.strip())
+            answer, think = answers.pop(0) if answers else ('', 0.0)
+        self._wait(think)
+        return answer
+
+    def unused(self) -> int:
+        with self._lock:
+            return len(self.commands) + len(self.chroot_commands) - len(self._used)
+
+
+def replay_transcript(path: Path, what_ifs=(), speed: float = REPLAY_SPEED,
+                      bandwidth: float = PREFETCH_BANDWIDTH, log: LogFile | None = None) -> dict:
+    """Run the installer stages against a recorded transcript, offline, in a scratch target.
+
+    Returns the recorded and the replayed wall time and stage times, the replayed ones as they
+    would be had every wait taken its full recorded time.
+    """
+    entries = read_transcript(path)
+    recorded_stages = stage_durations(entries)
+    recorded_wall = recorded_wall_time(entries)
+    for name in what_ifs:
+        entries = WHAT_IFS[name](entries, bandwidth)
+    header, state = entries[0], recorded_state(entries)
+
+    with tempfile.TemporaryDirectory(prefix='sendune-replay-') as tmp:
+        workdir = Path(tmp)
+        target = workdir / 'target'
+        # What pacstrap would have created; the later stages write below these.
+        for directory in ('etc', 'boot'):
+            (target / directory).mkdir(parents=True)
+        replay_log = log or LogFile(workdir / 'replay.log')
+        use_package_index(
+            SyntheticIndex(BASE_PACKAGES + DESKTOP_PACKAGES, state.get('aur_candidates', []))
+            if header['package_index'] else PackageIndex()
+        )
+        installer = benchmark_installer(target, replay_log, state.get('user_names', []))
+        installer.install_config = header['install_config']
+        installer.journal = InstallJournal.open(replay_log, workdir / 'journal')
+        player = TranscriptPlayer(entries, installer, replay_log, speed).attach()
+        started = time.monotonic()
+        try:
+            with (workdir / 'console.log').open('w', encoding='utf-8') as console, contextlib.redirect_stdout(console):
+                full_installation(installer, replay_log, RGB3DLogo(), benchmark_stages(OFFLINE_SKIPPED_STAGES))
+        finally:
+            player.detach()
+            if log is None:
+                replay_log.close()
+        wall = time.monotonic() - started
+
+    # A wait replayed in `speed` of its recorded time is missing the rest; Python time is not scaled.
+    stretch = 1 / speed - 1
+    replayed_stages = {}
+    for span in list(TRACER.spans):
+        if span.category == STAGE:
+            replayed_stages[span.name] = span.duration + player.waited(span.name) * stretch
+    for name in OFFLINE_SKIPPED_STAGES:
+        if name in recorded_stages:
+            replayed_stages[name] = recorded_stages[name]
+    return {
+        'what_ifs': list(what_ifs),
+        'recorded_wall': recorded_wall,
+        'replayed_wall': (
+            wall + player.waited() * stretch + sum(recorded_stages.get(name, 0.0) for name in OFFLINE_SKIPPED_STAGES)
+        ),
+        'stages': {
+            name: (recorded_stages.get(name), replayed_stages.get(name))
+            for name in dict.fromkeys([*recorded_stages, *replayed_stages])
+        },
+        'unmatched': player.unmatched,
+        'unused': player.unused(),
+    }
+
+
+def format_replay(result: dict) -> list:
+    what_if = ', '.join(result['what_ifs']) or 'as recorded'
+    change = result['replayed_wall'] - result['recorded_wall']
+    lines = [
+        f"Replay ({what_if}): {result['replayed_wall']:.1f}s, recorded {result['recorded_wall']:.1f}s ({change:+.1f}s)",
+        f"  {'stage':<44} {'recorded':>9} {'replayed':>9}",
+    ]
+    ranked = sorted(result['stages'].items(), key=lambda item: max(seconds or 0.0 for seconds in item[1]), reverse=True)
+    for name, (recorded, replayed) in ranked[:STAGES_SHOWN]:
+        recorded = f"{recorded:8.1f}s" if recorded is not None else f"{'-':>9}"
+        replayed = f"{replayed:8.1f}s" if replayed is not None else f"{'-':>9}"
+        lines.append(f"  {name[:44]:<44} {recorded} {replayed}")
+    if result['unmatched']:
+        lines.append(f"  {len(result['unmatched'])} commands were not in the transcript: {', '.join(result['unmatched'][:5])}")
+    if result['unused']:
+        lines.append(f"  {result['unused']} recorded commands were not asked for by the replay")
+    return lines
+
+
+def summarize_transcript(entries: list) -> list:
+    """Where the recorded install spent its time, by kind of work."""
+    commands = [entry for entry in entries if entry['kind'] == 'command']
+    chroot = [entry for entry in entries if entry['kind'] == 'chroot']
+    answers = [entry for entry in entries if entry['kind'] == 'answer']
+    header = entries[0]
+    lines = [
+        f"Transcript of {header['host']} recorded {header['recorded']}: {recorded_wall_time(entries):.1f}s",
+        (
+            f"  {len(commands)} commands, {sum(entry['duration'] for entry in commands):.1f}s "
+            f"(downloads announced: {sum(entry['download_bytes'] for entry in commands) / 1024 ** 2:.0f} MiB)"
+        ),
+    ]
+    if chroot:
+        lines.append(
+            f"  {len(chroot)} chroot commands, {sum(entry['duration'] for entry in chroot):.1f}s "
+            f"(median {statistics.median(entry['duration'] for entry in chroot):.2f}s)"
+        )
+    lines.append(f"  {len(answers)} answers, {sum(entry['think'] for entry in answers):.1f}s operator think time")
+    return lines
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python3 -m SENDUNE_installer.transcript',
+        description='Replay a recorded install transcript offline, optionally with what-if changes'
+    )
+    parser.add_argument('transcript', type=Path, help='transcript written by --record-transcript')
+    parser.add_argument('--what-if', action='append', choices=WHAT_IFS, default=[],
+                        help='replay with this change as well; repeat to combine')
+    parser.add_argument('--speed', type=float, default=REPLAY_SPEED,
+                        help='fraction of the recorded durations the replay actually waits (default %(default)s)')
+    parser.add_argument('--bandwidth', type=float, default=PREFETCH_BANDWIDTH,
+                        help='mirror throughput in MiB/s assumed by the prefetch what-if (default %(default)s)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_arguments(argv)
+    try:
+        entries = read_transcript(args.transcript)
+    except TranscriptError as e:
+        print(e)
+        return 1
+    for line in summarize_transcript(entries):
+        print(line)
+    for what_ifs in ([], args.what_if) if args.what_if else ([],):
+        TRACER.reset()
+        print()
+        for line in format_replay(replay_transcript(args.transcript, what_ifs, args.speed, args.bandwidth)):
+            print(line)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,288 @@
+import json
+import re
+from pathlib import Path
+
+from .installer_functions import DEFAULT_SERVICES
+
+# The archinstall-style schema shipped at the repo root; build_arch_iso.sh copies it next to the package.
+SCHEMA_PATHS = [
+    Path(__file__).parent / 'schema.json',
+    Path(__file__).parent.parent / 'schema.json',
+]
+# Installer-specific settings live under this key, which the archinstall schema leaves open.
+SENDUNE_KEY = 'sendune'
+SCHEMA_KEYWORDS = {'type', 'enum', 'properties', 'items', 'required', 'anyOf', 'description'}
+JSON_TYPES = {
+    'string': str,
+    'boolean': bool,
+    'array': list,
+    'object': dict,
+    'null': type(None),
+}
+
+# archinstall choices -> menu keys of the interactive steps.
+DESKTOP_PROFILES = {
+    'gnome': '2',
+    'plasma': '3',
+    'xfce4': '4',
+    'lxqt': '5',
+    'cinnamon': '6',
+    'mate': '7',
+    'i3-wm': '8',
+    'awesome': '9',
+    # Not an archinstall profile, but SENDUNE's default desktop.
+    'hyprland': '1',
+}
+SERVER_PROFILES = {
+    'cockpit': (['cockpit'], ['cockpit.socket']),
+    'docker': (['docker'], ['docker']),
+    'httpd': (['apache'], ['httpd']),
+    'lighttpd': (['lighttpd'], ['lighttpd']),
+    'mariadb': (['mariadb'], ['mariadb']),
+    'nginx': (['nginx'], ['nginx']),
+    'postgresql': (['postgresql'], ['postgresql']),
+    'sshd': (['openssh'], ['sshd']),
+    'tomcat': (['tomcat10'], ['tomcat10']),
+}
+GFX_DRIVERS = {
+    'Nvidia (proprietary)': '1',
+    'Nvidia (open kernel module for newer GPUs, Turing+)': '2',
+    'AMD / ATI (open-source)': '3',
+    'Intel (open-source)': '4',
+    'VirtualBox (open-source)': '6',
+}
+GREETERS = {'lightdm': '1', 'gdm': '2', 'sddm': '3'}
+AUDIO_SERVERS = {'pipewire': '1', 'pulseaudio': '2'}
+BOOTLOADERS = {'grub-install': '1', 'systemd-bootctl': '2'}
+SECURITY_FEATURES = {
+    'ufw': '1',
+    'apparmor': '2',
+    'selinux': '3',
+    'fail2ban': '4',
+    'clamav': '5',
+    'pwquality': '6',
+    'audit': '7',
+}
+
+
+class ConfigError(Exception):
+    def __init__(self, path: Path, errors: list) -> None:
+        super().__init__(f"{path}: " + '; '.join(errors))
+        self.path = path
+        self.errors = errors
+
+
+def _subschema(schema) -> dict:
+    """Normalise the loose forms in schema.json: `"string"` for a type, bare property maps."""
+    if isinstance(schema, str):
+        return {'type': schema}
+    if not isinstance(schema, dict):
+        return {}
+    if not SCHEMA_KEYWORDS & schema.keys():
+        return {'type': 'object', 'properties': schema}
+    return schema
+
+
+def validate(instance, schema, path: str = '$') -> list:
+    """Validate against the subset of JSON Schema that schema.json uses; return error messages."""
+    schema = _subschema(schema)
+    errors = []
+    expected = schema.get('type')
+    if isinstance(expected, str) and expected in JSON_TYPES:
+        if not isinstance(instance, JSON_TYPES[expected]) or (expected != 'boolean' and isinstance(instance, bool)):
+            return [f"{path}: expected {expected}, got {type(instance).__name__}"]
+    if 'enum' in schema and instance not in schema['enum']:
+        errors.append(f"{path}: {instance!r} is not one of {', '.join(map(str, schema['enum']))}")
+
+    if isinstance(instance, dict):
+        required = schema.get('required', [])
+        properties = dict(schema.get('properties') or {})
+        if isinstance(required, dict):
+            # `"required": {"name": <schema>}` in schema.json: required and described in one go.
+            properties.update(required)
+        for name in required:
+            if name not in instance:
+                errors.append(f"{path}: missing required key {name!r}")
+        for name, subschema in properties.items():
+            if name in instance and isinstance(subschema, (dict, str)):
+                errors.extend(validate(instance[name], subschema, f"{path}.{name}"))
+        alternatives = schema.get('anyOf')
+        if alternatives and all(validate(instance, alternative, path) for alternative in alternatives):
+            errors.append(f"{path}: must match one of: " + ' | '.join(
+                ', '.join(_subschema(alternative).get('required', [])) for alternative in alternatives
+            ))
+
+    if isinstance(instance, list) and 'items' in schema:
+        for index, item in enumerate(instance):
+            errors.extend(validate(item, schema['items'], f"{path}[{index}]"))
+    return errors
+
+
+def load_schema() -> dict:
+    for path in SCHEMA_PATHS:
+        if path.exists():
+            return json.loads(path.read_text(encoding='utf-8'))
+    raise FileNotFoundError(f"schema.json not found in {', '.join(str(path.parent) for path in SCHEMA_PATHS)}")
+
+
+def load_install_config(path: Path) -> dict:
+    """Read and validate an unattended install config; raises ConfigError listing every problem."""
+    path = Path(path)
+    try:
+        config = json.loads(path.read_text(encoding='utf-8'))
+    except (OSError, ValueError) as e:
+        raise ConfigError(path, [str(e)]) from e
+    errors = validate(config, load_schema())
+    sendune = config.get(SENDUNE_KEY, {})
+    if not isinstance(sendune, dict):
+        errors.append(f"$.{SENDUNE_KEY}: expected object")
+    elif not isinstance(sendune.get('answers', {}), dict):
+        errors.append(f"$.{SENDUNE_KEY}.answers: expected object of step name -> list of answers")
+    if errors:
+        raise ConfigError(path, errors)
+    return config
+
+
+def config_users(config: dict) -> list:
+    """`!users` as a list of dicts (archinstall accepts one object or a list)."""
+    users = config.get('!users', [])
+    return [users] if isinstance(users, dict) else list(users)
+
+
+def answers_from_config(config: dict) -> tuple:
+    """Translate a config into ({step name: [answers]}, [warnings]).
+
+    Steps without scripted answers get empty answers, which every step treats as skip/no.
+    `sendune.answers` overrides whole steps for anything the archinstall keys cannot express.
+    """
+    sendune = config.get(SENDUNE_KEY, {})
+    answers, warnings = {}, []
+
+    answers['interactive_find_mirrors'] = ['y' if sendune.get('rank_mirrors', True) else 'n']
+
+    profile = config.get('profile', {})
+    desktop = sendune.get('desktop') or profile.get('details')
+    if profile.get('main') in ('minimal', 'server', 'xorg'):
+        answers['interactive_desktop_environment'] = ['10']
+    elif desktop in DESKTOP_PROFILES:
+        answers['interactive_desktop_environment'] = [DESKTOP_PROFILES[desktop]]
+    elif desktop and desktop not in SERVER_PROFILES:
+        warnings.append(f"Desktop profile {desktop!r} has no SENDUNE equivalent; keeping the default desktop")
+    if profile.get('gfx_driver') in GFX_DRIVERS:
+        answers['interactive_graphics_drivers'] = [GFX_DRIVERS[profile['gfx_driver']]]
+    if profile.get('greeter_type') in GREETERS:
+        answers['interactive_login_manager'] = [GREETERS[profile['greeter_type']]]
+
+    security = sendune.get('security', [])
+    unknown = [name for name in security if name not in SECURITY_FEATURES]
+    if unknown:
+        warnings.append(f"Unknown security features ignored: {', '.join(unknown)}")
+    if security:
+        answers['interactive_security_hardening'] = [
+            ','.join(SECURITY_FEATURES[name] for name in security if name in SECURITY_FEATURES)
+        ]
+
+    audio = config.get('audio_config', {}).get('audio')
+    if audio in AUDIO_SERVERS:
+        answers['interactive_audio_setup'] = [AUDIO_SERVERS[audio]]
+
+    # Custom entries take any code the locale/keymap/timezone menus do not list.
+    locale = config.get('sys-language')
+    keymap = config.get('keyboard-language')
+    if locale or keymap:
+        answers['interactive_locale_setup'] = (['14', locale] if locale else ['0']) + (['9', keymap] if keymap else ['0'])
+    if config.get('timezone'):
+        answers['interactive_timezone'] = ['10', config['timezone']]
+
+    services = set(config.get('services', []))
+    answers['interactive_services'] = ['y' if service in services else 'n' for service in DEFAULT_SERVICES]
+
+    users = config_users(config)
+    if users:
+        user_answers = ['n']
+        for index, user in enumerate(users):
+            user_answers += [user.get('username', ''), user.get('!password', ''), 'y' if user.get('sudo') else 'n']
+            user_answers.append('y' if index + 1 < len(users) else 'n')
+    else:
+        # No users in the config: create the default account only.
+        user_answers = ['y', '', '', '', 'n']
+    answers['interactive_add_users'] = user_answers
+
+    bootloader = config.get('bootloader')
+    answers['interactive_bootloader'] = [BOOTLOADERS.get(bootloader, '3')]
+    if bootloader not in BOOTLOADERS:
+        warnings.append(f"Bootloader {bootloader!r} is not supported by the installer; skipping bootloader setup")
+
+    for step, step_answers in sendune.get('answers', {}).items():
+        answers[step] = [str(answer) for answer in step_answers]
+    return answers, warnings
+
+
+class AnswerFeed():
+    """Answers prompts from a config instead of the keyboard, keyed by the installer's current step.
+
+    Each step's answers are consumed in order, starting over whenever the step is entered again
+    (a resumed install). Prompts outside any step are matched against `prompt_answers`.
+    """
+
+    def __init__(self, answers: dict, prompt_answers: list | None = None, warnings: list | None = None) -> None:
+        self.answers = answers
+        self.prompt_answers = [(re.compile(pattern, re.IGNORECASE), answer) for pattern, answer in prompt_answers or []]
+        self.warnings = warnings or []
+        self.installer = None
+        self._step = None
+        self._position = 0
+
+    def bind(self, installer) -> None:
+        self.installer = installer
+
+    def __call__(self, prompt: str) -> str:
+        step = getattr(self.installer, 'current_step', None)
+        if step != self._step:
+            self._step, self._position = step, 0
+        if step is None:
+            for pattern, answer in self.prompt_answers:
+                if pattern.search(prompt):
+                    return answer
+            return ''
+        step_answers = self.answers.get(step, [])
+        if self._position >= len(step_answers):
+            return ''
+        answer = step_answers[self._position]
+        self._position += 1
+        return answer
+
+
+def answer_feed_from_config(config: dict) -> AnswerFeed:
+    answers, warnings = answers_from_config(config)
+    sendune = config.get(SENDUNE_KEY, {})
+    return AnswerFeed(answers, [
+        (r'mount point', sendune.get('mount_point', '/mnt')),
+        (r'resume it\?', 'y' if sendune.get('resume', True) else 'n'),
+        # Nobody is there to decide after a failure: exit and leave the journal for a resumed run.
+        (r'choice \(1/2/3\)', '3'),
+        (r'choice \(1/2\)', '2'),
+    ], warnings)
+
+
+def config_packages_and_services(config: dict) -> tuple:
+    """Packages and services the config asks for beyond what the wizard steps select."""
+    packages = list(config.get('packages', []))
+    packages += [kernel for kernel in config.get('kernels', []) if kernel != 'linux']
+    services = list(config.get('services', []))
+    profile = config.get('profile', {})
+    if profile.get('main') == 'xorg':
+        packages.append('xorg-server')
+    if profile.get('details') in SERVER_PROFILES:
+        profile_packages, profile_services = SERVER_PROFILES[profile['details']]
+        packages += profile_packages
+        services += profile_services
+    for entry in profile.get('custom', []):
+        if entry.get('enabled', True):
+            packages += str(entry.get('packages', '')).split()
+            services += str(entry.get('services', '')).split()
+    if config.get('ntp'):
+        services.append('systemd-timesyncd')
+    if config.get('network_config', {}).get('type', 'nm') == 'nm':
+        services.append('NetworkManager')
+    return packages, services
@@ -28,23 +28,46 @@ OUTPUT_ISO="${SCRIPT_DIR}/out-iso/SENDUNE.iso"
 ISO_NAME="SENDUNE"
 CLEAN=0
 VERBOSE=0
+# AUR packages built once here and shipped on the ISO as a local pacman repo.
+AUR_PACKAGES=(yay)
+BUILD_AUR=1
+AUR_REPO_NAME="sendune-aur"
+AUR_REPO_PATH="opt/sendune/repo"
+# Default install closure downloaded at build time so installs work without network.
+BUILD_OFFLINE_REPO=0
+OFFLINE_REPO_NAME="sendune-offline"
+OFFLINE_REPO_PATH="opt/sendune/offline-repo"
+# Writable partition on the install stick used as a persistent package cache.
+CACHE_DEVICE=""
+CACHE_LABEL="SENDUNE_CACHE"
 
 usage() {
     cat <<'EOF'
 Usage:
   ./build_arch_iso.sh <installer_dir> [options]
+  ./build_arch_iso.sh --add-cache-partition DEVICE
 
 Options:
   -o, --output FILE   Output ISO path (default: ./out-iso/SENDUNE.iso)
   -n, --name NAME     ISO name/label (default: SENDUNE)
   -c, --clean         Remove previous build artifacts before building
   -v, --verbose       Enable verbose mkarchiso output
+  -a, --aur PKG       Also build AUR package PKG into the ISO's local repo (repeatable)
+      --no-aur        Do not build AUR packages; the installer builds yay in the target
+      --offline-repo  Bake the default install packages and their dependencies into the ISO
+      --add-cache-partition DEVICE
+                      On a stick the ISO was already written to, turn the free space after
+                      the image into an ext4 partition labelled SENDUNE_CACHE that the
+                      installer uses as a persistent package cache
   -h, --help          Show this help message
 
 Examples:
   ./build_arch_iso.sh SENDUNE_installer
   ./build_arch_iso.sh SENDUNE_installer -o ~/Downloads/sendune.iso
   ./build_arch_iso.sh SENDUNE_installer -n MyDistro --clean
+  ./build_arch_iso.sh SENDUNE_installer --aur paru
+  ./build_arch_iso.sh SENDUNE_installer --offline-repo
+  ./build_arch_iso.sh --add-cache-partition /dev/sdX
 EOF
 }
 
@@ -111,6 +134,24 @@ parse_args() {
                 VERBOSE=1
                 shift
                 ;;
+            -a|--aur)
+                [[ $# -ge 2 ]] || error "Missing value for $1"
+                AUR_PACKAGES+=("$2")
+                shift 2
+                ;;
+            --no-aur)
+                BUILD_AUR=0
+                shift
+                ;;
+            --offline-repo)
+                BUILD_OFFLINE_REPO=1
+                shift
+                ;;
+            --add-cache-partition)
+                [[ $# -ge 2 ]] || error "Missing value for $1"
+                CACHE_DEVICE="$2"
+                shift 2
+                ;;
             -h|--help)
                 usage
                 exit 0
@@ -133,6 +174,7 @@ parse_args() {
         esac
     done
 
+    [[ -z "$CACHE_DEVICE" ]] || return 0
     [[ -n "$INSTALLER_DIR" ]] || error "Missing required argument: installer_dir"
     [[ -d "$INSTALLER_DIR" ]] || error "Installer directory not found: $INSTALLER_DIR"
 
@@ -353,6 +395,10 @@ EOF
 
     info "Copying installer into ISO profile..."
     cp -R "$INSTALLER_DIR" "$PROFILE_DIR/airootfs/root/SENDUNE_installer"
+    # Unattended installs (--config) validate against it.
+    if [[ -f "$SCRIPT_DIR/schema.json" ]]; then
+        cp "$SCRIPT_DIR/schema.json" "$PROFILE_DIR/airootfs/root/SENDUNE_installer/schema.json"
+    fi
 
     cat > "$PROFILE_DIR/airootfs/usr/local/bin/sendune-installer" <<'EOF'
 #!/bin/bash
@@ -413,6 +459,124 @@ EOF
     fi
 }
 
+write_aur_build_script() {
+    cat > "$BUILD_ROOT/aur-build.sh" <<EOF
+#!/usr/bin/env bash
+# Build AUR packages into a pacman repo: aur-build.sh <repo_dir> <pkg>...
+set -euo pipefail
+
+repo_dir="\$1"
+shift
+src_dir="\$(mktemp -d)"
+trap 'rm -rf "\$src_dir"' EXIT
+mkdir -p "\$repo_dir"
+rm -f "\$repo_dir"/*.pkg.tar.* "\$repo_dir/${AUR_REPO_NAME}".*
+
+for pkg in "\$@"; do
+    git clone --depth 1 "https://aur.archlinux.org/\${pkg}.git" "\$src_dir/\$pkg"
+    (cd "\$src_dir/\$pkg" && PKGDEST="\$repo_dir" makepkg --syncdeps --noconfirm --needed)
+done
+
+# Debug split packages are not needed on the ISO.
+rm -f "\$repo_dir"/*-debug-*.pkg.tar.*
+repo-add "\$repo_dir/${AUR_REPO_NAME}.db.tar.gz" "\$repo_dir"/*.pkg.tar.*
+EOF
+    chmod +x "$BUILD_ROOT/aur-build.sh"
+}
+
+build_aur_native() {
+    [[ "$BUILD_AUR" -eq 1 && ${#AUR_PACKAGES[@]} -gt 0 ]] || return 0
+    [[ "$EUID" -ne 0 ]] || error "makepkg cannot run as root; run the build as a regular user or pass --no-aur."
+
+    info "Building AUR packages into the ISO repo: $(printf '%s ' "${AUR_PACKAGES[@]}")"
+    write_aur_build_script
+    bash "$BUILD_ROOT/aur-build.sh" "$PROFILE_DIR/airootfs/$AUR_REPO_PATH" "${AUR_PACKAGES[@]}" \
+        || error "Failed to build AUR packages (use --no-aur to skip)."
+    success "AUR repo ready at /$AUR_REPO_PATH"
+}
+
+write_offline_repo_script() {
+    command -v python3 >/dev/null 2>&1 || error "python3 is required to read the installer's package lists."
+    info "Collecting the default install package set from the installer..."
+    PYTHONPATH="$(dirname "$INSTALLER_DIR")" python3 - "$(basename "$INSTALLER_DIR")" > "$BUILD_ROOT/offline-packages.txt" <<'EOF'
+import importlib
+import sys
+
+installation = importlib.import_module(f"{sys.argv[1]}.full_installation")
+for name in dict.fromkeys(installation.BASE_PACKAGES + installation.DESKTOP_PACKAGES):
+    print(name)
+EOF
+
+    cat > "$BUILD_ROOT/offline-repo.sh" <<EOF
+#!/usr/bin/env bash
+# Download packages plus all dependencies into a pacman repo: offline-repo.sh <pacman.conf> <repo_dir> <list>
+set -euo pipefail
+
+config="\$1"
+repo_dir="\$2"
+list="\$3"
+db_dir="\$(mktemp -d)"
+trap 'rm -rf "\$db_dir"' EXIT
+mkdir -p "\$repo_dir"
+
+pacman --config "\$config" --dbpath "\$db_dir" -Sy
+# Names the repos do not carry (AUR-only, typos) would abort the whole download.
+known="\$(pacman --config "\$config" --dbpath "\$db_dir" -Slq; pacman --config "\$config" --dbpath "\$db_dir" -Sg)"
+mapfile -t wanted < <(grep -Fxf <(printf '%s\n' "\$known") "\$list")
+missing="\$(grep -Fxvf <(printf '%s\n' "\$known") "\$list" | tr '\n' ' ' || true)"
+[[ -z "\$missing" ]] || echo "Not in the sync repos, left out of the offline repo: \$missing"
+
+# An empty dbpath makes pacman treat every dependency as missing, so the full closure is fetched.
+pacman --config "\$config" --dbpath "\$db_dir" --cachedir "\$repo_dir" -Sw --noconfirm "\${wanted[@]}"
+rm -f "\$repo_dir/${OFFLINE_REPO_NAME}".*
+repo-add -q "\$repo_dir/${OFFLINE_REPO_NAME}.db.tar.gz" "\$repo_dir"/*.pkg.tar.*
+EOF
+    chmod +x "$BUILD_ROOT/offline-repo.sh"
+}
+
+build_offline_repo_native() {
+    [[ "$BUILD_OFFLINE_REPO" -eq 1 ]] || return 0
+
+    write_offline_repo_script
+    info "Downloading the default install closure into the ISO's offline repo..."
+    sudo bash "$BUILD_ROOT/offline-repo.sh" "$PROFILE_DIR/pacman.conf" \
+        "$PROFILE_DIR/airootfs/$OFFLINE_REPO_PATH" "$BUILD_ROOT/offline-packages.txt" \
+        || error "Failed to build the offline package repo."
+    success "Offline repo ready at /$OFFLINE_REPO_PATH ($(du -sh "$PROFILE_DIR/airootfs/$OFFLINE_REPO_PATH" | awk '{print $1}'))"
+}
+
+add_cache_partition() {
+    local device="$CACHE_DEVICE"
+    [[ -b "$device" ]] || error "Not a block device: $device"
+    [[ "$(lsblk -dno TYPE "$device")" == "disk" ]] || error "$device is a partition; pass the whole stick (e.g. /dev/sdX)."
+    for tool in sfdisk mkfs.ext4 partprobe; do
+        command -v "$tool" >/dev/null 2>&1 || error "$tool is required to add a cache partition."
+    done
+    if lsblk -no LABEL "$device" | grep -qx "$CACHE_LABEL"; then
+        success "$device already has a $CACHE_LABEL partition."
+        return 0
+    fi
+
+    warn "This adds a partition in the free space after the image on $device:"
+    lsblk -o NAME,SIZE,FSTYPE,LABEL "$device"
+    local answer
+    read -r -p "Type YES to continue: " answer
+    [[ "$answer" == "YES" ]] || error "Aborted."
+
+    local before after partition
+    before="$(lsblk -lnpo NAME "$device")"
+    # The ISO is a hybrid image; appending to its MBR leaves the ISO 9660 data untouched.
+    printf ',,L\n' | sudo sfdisk --append --no-reread "$device" || error "Failed to add the partition to $device."
+    sudo partprobe "$device" || true
+    sleep 1
+    after="$(lsblk -lnpo NAME "$device")"
+    partition="$(comm -13 <(printf '%s\n' "$before" | sort) <(printf '%s\n' "$after" | sort) | tail -1)"
+    [[ -n "$partition" ]] || error "Could not find the new partition on $device."
+
+    sudo mkfs.ext4 -F -L "$CACHE_LABEL" "$partition" || error "Failed to format $partition."
+    success "Cache partition $partition ($CACHE_LABEL) ready; installs from this stick will keep downloaded packages on it."
+}
+
 find_built_iso() {
     find "$(dirname "$OUTPUT_ISO")" -maxdepth 1 -type f -name '*.iso' -printf '%T@ %p\n' \
         | sort -n \
@@ -436,10 +600,12 @@ build_native_arch() {
     info "Running native Arch build..."
     command -v pacman >/dev/null 2>&1 || error "pacman is required for native Arch builds."
 
-    sudo pacman -Syu --needed --noconfirm archiso git imagemagick || error "Failed to install native build dependencies."
+    sudo pacman -Syu --needed --noconfirm archiso git imagemagick base-devel || error "Failed to install native build dependencies."
 
     prepare_build_root
     write_common_profile
+    build_aur_native
+    build_offline_repo_native
 
     rm -f "$(dirname "$OUTPUT_ISO")"/*.iso
 
@@ -478,8 +644,10 @@ FROM archlinux:latest
 RUN pacman-key --init && \
     pacman-key --populate archlinux && \
     pacman -Syu --noconfirm && \
-    pacman -S --noconfirm archiso git imagemagick && \
-    pacman -Scc --noconfirm
+    pacman -S --noconfirm archiso git imagemagick base-devel sudo && \
+    pacman -Scc --noconfirm && \
+    useradd -m builder && \
+    echo 'builder ALL=(ALL) NOPASSWD: ALL' > /etc/sudoers.d/builder
 
 WORKDIR /workdir
 CMD ["/bin/bash"]
@@ -491,6 +659,37 @@ EOF
     local container_work="${SCRIPT_DIR}/docker-work"
     mkdir -p "$container_work"
 
+    if [[ "$BUILD_AUR" -eq 1 && ${#AUR_PACKAGES[@]} -gt 0 ]]; then
+        local aur_repo_dir="$PROFILE_DIR/airootfs/$AUR_REPO_PATH"
+        local aur_list
+        aur_list="$(printf '%s ' "${AUR_PACKAGES[@]}")"
+        write_aur_build_script
+        mkdir -p "$aur_repo_dir"
+
+        info "Building AUR packages inside Docker: $aur_list"
+        eval "$docker run --rm \
+            -v \"$BUILD_ROOT/aur-build.sh:/aur-build.sh:ro\" \
+            -v \"$aur_repo_dir:/repo\" \
+            sendune-iso-builder \
+            bash -lc 'set -euo pipefail; chown builder /repo; sudo -u builder bash /aur-build.sh /repo $aur_list; chown -R $(id -u):$(id -g) /repo'" \
+            || error "Failed to build AUR packages (use --no-aur to skip)."
+    fi
+
+    if [[ "$BUILD_OFFLINE_REPO" -eq 1 ]]; then
+        write_offline_repo_script
+        mkdir -p "$PROFILE_DIR/airootfs/$OFFLINE_REPO_PATH"
+
+        info "Downloading the default install closure inside Docker..."
+        eval "$docker run --rm \
+            -v \"$BUILD_ROOT/offline-repo.sh:/offline-repo.sh:ro\" \
+            -v \"$BUILD_ROOT/offline-packages.txt:/offline-packages.txt:ro\" \
+            -v \"$PROFILE_DIR/pacman.conf:/offline-pacman.conf:ro\" \
+            -v \"$PROFILE_DIR/airootfs/$OFFLINE_REPO_PATH:/repo\" \
+            sendune-iso-builder \
+            bash -lc 'set -euo pipefail; bash /offline-repo.sh /offline-pacman.conf /repo /offline-packages.txt; chown -R $(id -u):$(id -g) /repo'" \
+            || error "Failed to build the offline package repo."
+    fi
+
     local mkarchiso_flags=""
     [[ "$VERBOSE" -eq 1 ]] && mkarchiso_flags="-v"
 
@@ -508,6 +707,11 @@ EOF
 main() {
     parse_args "$@"
 
+    if [[ -n "$CACHE_DEVICE" ]]; then
+        add_cache_partition
+        exit 0
+    fi
+
     local os_id
     os_id="$(detect_os)"
     info "Detected OS: $os_id"
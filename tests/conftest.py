@@ -0,0 +1,43 @@
+import io
+import tarfile
+
+import pytest
+
+
+def desc_text(fields: dict) -> str:
+    """A sync db `desc` file: one %FIELD% block per key, list values one per line."""
+    blocks = []
+    for key, value in fields.items():
+        values = value if isinstance(value, list) else [value]
+        blocks.append(f"%{key}%\n" + ''.join(f"{item}\n" for item in values))
+    return '\n'.join(blocks)
+
+
+def package(name: str, version: str = '1.0-1', csize: int = 1000, isize: int = 4000, **fields) -> dict:
+    desc = {
+        'NAME': name,
+        'VERSION': version,
+        'FILENAME': f"{name}-{version}-x86_64.pkg.tar.zst",
+        'CSIZE': str(csize),
+        'ISIZE': str(isize),
+        'SHA256SUM': '0' * 64,
+    }
+    desc.update({key.upper(): value for key, value in fields.items()})
+    return desc
+
+
+@pytest.fixture
+def sync_db(tmp_path):
+    """Write a gzip sync database `<repo>.db` with one `<name>-<version>/desc` entry per package."""
+
+    def write(repo: str, packages: list, directory=tmp_path):
+        path = directory / f"{repo}.db"
+        with tarfile.open(path, 'w:gz') as archive:
+            for fields in packages:
+                data = desc_text(fields).encode()
+                member = tarfile.TarInfo(f"{fields['NAME']}-{fields['VERSION']}/desc")
+                member.size = len(data)
+                archive.addfile(member, io.BytesIO(data))
+        return path
+
+    return write
@@ -0,0 +1,119 @@
+import http.client
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from SENDUNE_installer.cache_server import CacheServer, ReadThroughCache
+from SENDUNE_installer.custom_classes import LogFile
+
+PACKAGE = 'tmux-3.5-1-x86_64.pkg.tar.zst'
+PAYLOAD = bytes(range(256)) * 4096
+
+
+class Upstream(BaseHTTPRequestHandler):
+    """A mirror on localhost that sends half of every file, then waits for `release`."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        self.server.requests.append(self.path)
+        if not self.path.endswith(PACKAGE):
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(PAYLOAD)))
+        self.end_headers()
+        half = len(PAYLOAD) // 2
+        self.wfile.write(PAYLOAD[:half])
+        self.wfile.flush()
+        self.server.release.wait(10)
+        self.wfile.write(PAYLOAD[half:])
+
+
+def start(server) -> None:
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+
+@pytest.fixture
+def servers(tmp_path):
+    upstream = ThreadingHTTPServer(('127.0.0.1', 0), Upstream)
+    upstream.daemon_threads = True
+    upstream.requests = []
+    upstream.release = threading.Event()
+    start(upstream)
+
+    log = LogFile(tmp_path / 'cache.log')
+    cache = ReadThroughCache(tmp_path / 'cache', [f"http://127.0.0.1:{upstream.server_port}/$repo/os/$arch"], log)
+    server = CacheServer(('127.0.0.1', 0), cache, log)
+    start(server)
+    yield upstream, server
+    upstream.release.set()
+    server.shutdown()
+    server.server_close()
+    upstream.shutdown()
+    upstream.server_close()
+    log.close()
+
+
+def wait_for(path, timeout: float = 10) -> bool:
+    """The last byte reaches the client just before the download is moved into place."""
+    deadline = time.monotonic() + timeout
+    while not path.exists() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return path.exists()
+
+
+def request(server, path: str) -> http.client.HTTPResponse:
+    connection = http.client.HTTPConnection('127.0.0.1', server.server_port, timeout=10)
+    connection.request('GET', path)
+    return connection.getresponse()
+
+
+def test_paths_outside_the_cache_are_rejected(servers, tmp_path):
+    upstream, server = servers
+    for path in ('/../os/../core.db', '/./os/./core.db', '/core/os/../../core.db', '/core/os/x86_64/..'):
+        assert request(server, path).status == 404
+    assert upstream.requests == []
+    assert not list(tmp_path.glob('*.db'))
+    with pytest.raises(ValueError):
+        server.cache.local_path('..', '..', 'core.db')
+
+
+def test_first_client_is_streamed_before_the_download_finishes(servers, tmp_path):
+    upstream, server = servers
+    response = request(server, f'/extra/os/x86_64/{PACKAGE}')
+    assert response.status == 200
+    assert int(response.headers['Content-Length']) == len(PAYLOAD)
+    half = len(PAYLOAD) // 2
+    # The upstream holds back the second half until released, so this only returns if streamed.
+    assert response.read(half) == PAYLOAD[:half]
+
+    upstream.release.set()
+    assert response.read() == PAYLOAD[half:]
+    assert wait_for(tmp_path / 'cache' / PACKAGE)
+    assert (tmp_path / 'cache' / PACKAGE).read_bytes() == PAYLOAD
+
+    assert request(server, f'/extra/os/x86_64/{PACKAGE}').read() == PAYLOAD
+    assert len(upstream.requests) == 1
+    assert server.cache.hits == 1
+
+
+def test_concurrent_requests_share_one_download(servers):
+    upstream, server = servers
+    first = request(server, f'/extra/os/x86_64/{PACKAGE}')
+    second = request(server, f'/extra/os/x86_64/{PACKAGE}')
+    upstream.release.set()
+    assert first.read() == PAYLOAD
+    assert second.read() == PAYLOAD
+    assert len(upstream.requests) == 1
+    assert server.cache.coalesced == 1
+
+
+def test_missing_upstream_file_is_404(servers):
+    _, server = servers
+    assert request(server, '/extra/os/x86_64/missing-1-1-x86_64.pkg.tar.zst').status == 404
@@ -0,0 +1,71 @@
+import os
+import threading
+
+import pytest
+
+from SENDUNE_installer.chroot_session import ChrootPool
+from SENDUNE_installer.custom_classes import LogFile
+
+# Records its own name, then serves the session protocol from a profile-free shell in place of the target's.
+SHIM = '#!/bin/sh\necho "$(basename "$0")" >> "$SHIM_CALLS"\nexec bash --noprofile --norc -s\n'
+
+
+@pytest.fixture
+def chroot_pool(tmp_path, monkeypatch):
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    for tool in ('arch-chroot', 'chroot'):
+        (bin_dir / tool).write_text(SHIM)
+        (bin_dir / tool).chmod(0o755)
+    calls = tmp_path / 'calls'
+    monkeypatch.setenv('PATH', f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setenv('SHIM_CALLS', str(calls))
+    log = LogFile(tmp_path / 'chroot.log')
+    pool = ChrootPool(tmp_path / 'target', log, size=3, echo=False)
+    yield pool, calls
+    pool.close()
+    log.close()
+
+
+def test_sequential_commands_share_one_arch_chroot(chroot_pool):
+    pool, calls = chroot_pool
+    results = [pool.run(f"echo {number}") for number in range(5)]
+    assert [result.output for result in results] == [f"{number}\n" for number in range(5)]
+    assert calls.read_text().split() == ['arch-chroot']
+
+
+def test_concurrent_commands_chroot_into_the_mounted_root(chroot_pool):
+    pool, calls = chroot_pool
+    barrier = threading.Barrier(6)
+    results = []
+
+    def stage():
+        barrier.wait()
+        results.append(pool.run("sleep 0.2; echo done"))
+
+    threads = [threading.Thread(target=stage) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(30)
+
+    assert [result.output for result in results] == ['done\n'] * 6
+    invoked = calls.read_text().split()
+    # One mount, and never more shells than the pool's size, however many stages ask at once.
+    assert invoked.count('arch-chroot') == 1
+    assert invoked[0] == 'arch-chroot'
+    assert invoked.count('chroot') == 2
+
+
+def test_run_queue_stops_at_the_first_failure(chroot_pool):
+    pool, _ = chroot_pool
+    results = pool.run_queue(['true', 'false', 'echo never'])
+    assert [result.returncode for result in results] == [0, 1]
+
+
+def test_closed_pool_mounts_again_on_next_use(chroot_pool):
+    pool, calls = chroot_pool
+    pool.run('true')
+    pool.close()
+    pool.run('true')
+    assert calls.read_text().split() == ['arch-chroot', 'arch-chroot']
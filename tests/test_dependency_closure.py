@@ -0,0 +1,63 @@
+from conftest import package
+
+from SENDUNE_installer.dependency_closure import DependencyClosure, format_size
+from SENDUNE_installer.package_index import PackageIndex
+
+
+def closure_of(sync_db) -> DependencyClosure:
+    db = sync_db('core', [
+        package('base', csize=100, isize=1000, depends=['bash', 'glibc>=2.38']),
+        package('bash', csize=200, isize=2000, depends=['glibc', 'readline', 'sh-missing']),
+        package('glibc', csize=400, isize=4000),
+        package('readline', csize=800, isize=8000, depends=['glibc']),
+        package('plasma-desktop', csize=1600, isize=16000, depends=['qt6-base', 'bash']),
+        package('qt6-base', csize=3200, isize=32000, depends=['glibc']),
+        package('xfce4-session', csize=6400, isize=64000, depends=['glibc']),
+        package('pipewire-jack', csize=12800, isize=128000, provides=['jack']),
+    ])
+    return DependencyClosure(PackageIndex.from_sync_dbs([db]))
+
+
+def test_packages_are_attributed_to_the_first_step_that_needs_them(sync_db):
+    closure = closure_of(sync_db)
+    closure.add('base', ['base'])
+    closure.add('desktop', ['plasma-desktop'])
+    assert set(closure.packages) == {'base', 'bash', 'glibc', 'readline', 'plasma-desktop', 'qt6-base'}
+
+    summary = closure.summary()
+    assert summary['steps']['base'] == {'packages': 4, 'download': 1500, 'installed': 15000}
+    assert summary['steps']['desktop'] == {'packages': 2, 'download': 4800, 'installed': 48000}
+    assert (summary['packages'], summary['download'], summary['installed']) == (6, 6300, 63000)
+    assert summary['unresolved'] == {'base': ['sh-missing']}
+
+
+def test_virtual_dependencies_and_requests_resolve_through_provides(sync_db):
+    closure = closure_of(sync_db)
+    closure.add('audio', ['jack'])
+    assert closure.packages == ['pipewire-jack']
+    assert closure.summary()['download'] == 12800
+
+
+def test_replace_recomputes_the_closure(sync_db):
+    closure = closure_of(sync_db)
+    closure.add('base', ['base'])
+    closure.add('desktop', ['plasma-desktop'])
+    seen = []
+    closure.listeners.append(seen.append)
+
+    closure.replace('desktop', ['xfce4-session'])
+    assert 'qt6-base' not in closure.packages
+    assert closure.summary()['steps']['desktop'] == {'packages': 1, 'download': 6400, 'installed': 64000}
+    assert seen == [closure.packages]
+
+
+def test_format_summary(sync_db):
+    closure = closure_of(sync_db)
+    closure.add('base', ['base'])
+    lines = closure.format_summary()
+    assert lines[0] == "4 packages, 1.5 KiB to download, 14.6 KiB installed"
+    assert lines[1].split() == ['base', '4', 'pkgs', '1.5', 'KiB', 'download', '14.6', 'KiB', 'installed']
+    assert lines[2] == "  base: unresolved sh-missing"
+    assert [format_size(size) for size in (512, 2048, 3 * 1024 ** 2, 5 * 1024 ** 3)] == [
+        '512 B', '2.0 KiB', '3.0 MiB', '5.0 GiB',
+    ]
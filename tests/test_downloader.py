@@ -0,0 +1,197 @@
+import hashlib
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from SENDUNE_installer.custom_classes import LogFile
+from SENDUNE_installer.downloader import (
+    MAX_CONSECUTIVE_FAILURES,
+    Downloader,
+    DownloadFailed,
+    MirrorPool,
+)
+
+PACKAGE = 'tmux-3.5-1-x86_64.pkg.tar.zst'
+PAYLOAD = bytes(range(256)) * 1024
+SHA256 = hashlib.sha256(PAYLOAD).hexdigest()
+
+
+class FaultyMirror(BaseHTTPRequestHandler):
+    """A mirror on localhost that answers each request with the next of its `faults`, the last one repeating.
+
+    ok: the file; error: HTTP 500; drop: half the file, then the connection closes;
+    corrupt: as many bytes, but not the file's; trickle: 1 KiB every 50 ms.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        self.server.requests.append(self.path)
+        faults = self.server.faults
+        fault = faults.popleft() if len(faults) > 1 else faults[0]
+        if fault == 'error':
+            self.send_error(500)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(PAYLOAD)))
+        self.end_headers()
+        try:
+            if fault == 'ok':
+                self.wfile.write(PAYLOAD)
+            elif fault == 'corrupt':
+                self.wfile.write(PAYLOAD[::-1])
+            elif fault == 'drop':
+                self.wfile.write(PAYLOAD[:len(PAYLOAD) // 2])
+                self.close_connection = True
+            elif fault == 'trickle':
+                for offset in range(0, len(PAYLOAD), 1024):
+                    self.wfile.write(PAYLOAD[offset:offset + 1024])
+                    self.wfile.flush()
+                    time.sleep(0.05)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+@pytest.fixture
+def mirrors(tmp_path):
+    started = []
+    log = LogFile(tmp_path / 'download.log')
+
+    def start(*faults):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), FaultyMirror)
+        server.daemon_threads = True
+        server.requests = []
+        server.faults = deque(faults)
+        threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True).start()
+        started.append(server)
+        return server, f"http://127.0.0.1:{server.server_port}"
+
+    yield start, log
+    for server in started:
+        server.shutdown()
+        server.server_close()
+    log.close()
+
+
+def downloader(pool, log, **options) -> Downloader:
+    """A Downloader that records its backoff delays instead of sleeping them."""
+    options.setdefault('grace', 0.3)
+    downloader = Downloader(pool, log, **options)
+    downloader.delays = []
+    downloader._sleep = lambda delay, cancelled: downloader.delays.append(delay)
+    return downloader
+
+
+def url_for(server: str) -> str:
+    return f"{server}/{PACKAGE}"
+
+
+@pytest.mark.parametrize('fault', ['error', 'drop', 'corrupt'])
+def test_each_file_fails_over_to_the_next_mirror(mirrors, tmp_path, fault):
+    start, log = mirrors
+    broken, first = start(fault)
+    working, second = start('ok')
+    pool = MirrorPool([first, second], log)
+    target = tmp_path / PACKAGE
+
+    assert downloader(pool, log).fetch(url_for, target, SHA256) == len(PAYLOAD)
+    assert target.read_bytes() == PAYLOAD
+    assert not target.with_name(f"{PACKAGE}.sendune-part").exists()
+    assert len(broken.requests) == len(working.requests) == 1
+    assert pool.stats[first].failures == 1
+    assert pool.stats[second].bytes == len(PAYLOAD)
+
+
+def test_truncated_body_is_a_failure_without_a_checksum(mirrors, tmp_path):
+    start, log = mirrors
+    _, first = start('drop')
+    _, second = start('ok')
+    target = tmp_path / PACKAGE
+    downloader(MirrorPool([first, second], log), log).fetch(url_for, target)
+    assert target.read_bytes() == PAYLOAD
+
+
+def test_sha256_mismatch_is_rejected(mirrors, tmp_path):
+    start, log = mirrors
+    _, only = start('corrupt')
+    target = tmp_path / PACKAGE
+    with pytest.raises(DownloadFailed, match='sha256 mismatch'):
+        downloader(MirrorPool([only], log), log, retries=2).fetch(url_for, target, SHA256)
+    assert not target.exists()
+    assert not target.with_name(f"{PACKAGE}.sendune-part").exists()
+
+
+def test_retry_rounds_back_off(mirrors, tmp_path):
+    start, log = mirrors
+    failing, only = start('error', 'error', 'error', 'ok')
+    fetcher = downloader(MirrorPool([only], log, max_failures=10), log, backoff_base=0.5, backoff_max=1.5)
+    fetcher.fetch(url_for, tmp_path / PACKAGE)
+
+    assert len(failing.requests) == 4
+    # base * 2^(round - 1), capped at backoff_max, with jitter of up to half of it.
+    assert len(fetcher.delays) == 3
+    for delay, full in zip(fetcher.delays, (0.5, 1.0, 1.5), strict=True):
+        assert full / 2 <= delay <= full
+
+
+def test_slow_mirror_moves_to_the_back(mirrors, tmp_path):
+    start, log = mirrors
+    trickling, slow = start('trickle')
+    _, fast = start('ok')
+    pool = MirrorPool([slow, fast], log)
+
+    started = time.monotonic()
+    downloader(pool, log).fetch(url_for, tmp_path / PACKAGE, SHA256)
+    assert time.monotonic() - started < 2
+    assert 'KiB/s' in pool.stats[slow].blacklisted
+    assert pool.candidates() == [fast, slow]
+
+    downloader(pool, log).fetch(url_for, tmp_path / 'second.pkg.tar.zst', SHA256)
+    assert len(trickling.requests) == 1
+
+
+def test_consecutive_failures_move_a_mirror_to_the_back(mirrors, tmp_path):
+    start, log = mirrors
+    failing, flaky = start('error')
+    _, steady = start('ok')
+    pool = MirrorPool([flaky, steady], log)
+    fetcher = downloader(pool, log)
+
+    for number in range(MAX_CONSECUTIVE_FAILURES):
+        assert pool.candidates() == [flaky, steady]
+        fetcher.fetch(url_for, tmp_path / f"{number}.pkg.tar.zst")
+    assert pool.stats[flaky].blacklisted.startswith(f"{MAX_CONSECUTIVE_FAILURES} failures in a row")
+    assert pool.candidates() == [steady, flaky]
+
+    fetcher.fetch(url_for, tmp_path / 'next.pkg.tar.zst')
+    assert len(failing.requests) == MAX_CONSECUTIVE_FAILURES
+
+
+def test_download_fails_only_after_every_mirror_failed(mirrors, tmp_path):
+    start, log = mirrors
+    dropping, first = start('drop')
+    failing, second = start('error')
+    fetcher = downloader(MirrorPool([first, second], log), log, retries=3)
+
+    with pytest.raises(DownloadFailed, match='HTTP Error 500'):
+        fetcher.fetch(url_for, tmp_path / PACKAGE)
+    # Every round tries every mirror, the dropped ones included, before giving up.
+    assert len(dropping.requests) == len(failing.requests) == 3
+    assert len(fetcher.delays) == 2
+    assert not (tmp_path / PACKAGE).exists()
+
+
+def test_dropped_mirror_is_the_last_resort(mirrors, tmp_path):
+    start, log = mirrors
+    _, first = start('ok')
+    _, second = start('error')
+    pool = MirrorPool([first, second], log)
+    pool.blacklist(first, 'dropped for the test')
+    downloader(pool, log).fetch(url_for, tmp_path / PACKAGE, SHA256)
+    assert (tmp_path / PACKAGE).read_bytes() == PAYLOAD
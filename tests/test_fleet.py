@@ -0,0 +1,183 @@
+import io
+import os
+import shutil
+import stat
+import subprocess
+
+import pytest
+
+from SENDUNE_installer import fleet
+from SENDUNE_installer.commands import CommandError
+from SENDUNE_installer.custom_classes import LogFile
+from SENDUNE_installer.fleet import (
+    FleetError,
+    FleetProgress,
+    FleetTarget,
+    create_loop_targets,
+    detach_loop_targets,
+    parse_targets,
+    partition_path,
+    prepare_target,
+    run_tool,
+    worker_config,
+)
+from SENDUNE_installer.unattended import SENDUNE_KEY
+
+LOOP_SIZE = 64 * 1024 ** 2
+needs_loop_devices = pytest.mark.skipif(
+    os.geteuid() != 0 or shutil.which('losetup') is None, reason='needs root and losetup'
+)
+
+
+class Terminal(io.StringIO):
+    def isatty(self) -> bool:
+        return True
+
+
+@pytest.fixture
+def log(tmp_path):
+    log = LogFile(tmp_path / 'fleet.log')
+    yield log
+    log.close()
+
+
+@pytest.fixture
+def loop_targets(tmp_path, monkeypatch, log):
+    monkeypatch.setattr(fleet, 'FLEET_MOUNT_ROOT', tmp_path / 'mnt')
+    targets = []
+
+    def attach(count):
+        targets.extend(create_loop_targets(count, log, LOOP_SIZE, tmp_path / 'images'))
+        return targets
+
+    yield attach
+    detach_loop_targets(targets, log)
+
+
+def backing_devices(image) -> str:
+    return subprocess.run(['losetup', '--associated', str(image)], capture_output=True, text=True, check=False).stdout
+
+
+def test_parse_targets():
+    targets = parse_targets(['/dev/sda', '/dev/nvme0n1:/srv/node2'])
+    assert [(target.name, target.device) for target in targets] == [('sda', '/dev/sda'), ('nvme0n1', '/dev/nvme0n1')]
+    assert targets[0].mount_point == fleet.FLEET_MOUNT_ROOT / 'sda'
+    assert str(targets[1].mount_point) == '/srv/node2'
+    assert targets[0].image is None
+    with pytest.raises(FleetError, match='given twice'):
+        parse_targets(['/dev/sda', '/dev/disk/sda'])
+
+
+@pytest.mark.parametrize(('device', 'expected'), [
+    ('/dev/sda', '/dev/sda2'), ('/dev/nvme0n1', '/dev/nvme0n1p2'), ('/dev/loop3', '/dev/loop3p2'),
+])
+def test_partition_path(device, expected):
+    assert partition_path(device, 2) == expected
+
+
+def test_run_tool_failure_keeps_the_command_error(log):
+    with pytest.raises(FleetError) as raised:
+        run_tool(['sh', '-c', 'echo broken disk >&2; exit 3'], log)
+    assert isinstance(raised.value.__cause__, CommandError)
+    assert 'broken disk' in str(raised.value)
+
+
+def test_worker_config_leaves_the_original_alone():
+    config = {'hostname': 'node', SENDUNE_KEY: {'rank_mirrors': True}}
+    shared = worker_config(config)
+    assert shared[SENDUNE_KEY]['rank_mirrors'] is False
+    assert config[SENDUNE_KEY]['rank_mirrors'] is True
+    assert worker_config({})[SENDUNE_KEY] == {'rank_mirrors': False}
+
+
+def test_progress_follows_stage_events():
+    stream = io.StringIO()
+    targets = parse_targets(['/dev/sda', '/dev/sdb'])
+    progress = FleetProgress(targets, total=3, stream=stream)
+    progress.started('sda')
+    for event in [
+        ('sda', 'stage', 'base-install', 'running'),
+        ('sda', 'stage', 'users', 'running'),
+        ('sda', 'stage', 'base-install', 'done'),
+        ('sda', 'stage', 'locale', 'skipped'),
+        ('sda', 'stage', 'users', 'failed'),
+    ]:
+        progress.update(event)
+
+    sda = progress.targets['sda']
+    assert sda.finished == {'base-install', 'locale'}
+    assert sda.running == []
+    assert sda.status == 'running'
+    assert '2/3' in sda.line()
+    assert progress.targets['sdb'].status == 'waiting'
+
+    progress.update(('sda', 'failed', 'users failed', 0))
+    assert sda.status == 'failed'
+    assert sda.ended is not None
+    assert sda.line().endswith('(users failed)')
+
+
+def test_plain_output_prints_changed_lines_only():
+    stream = io.StringIO()
+    progress = FleetProgress(parse_targets(['/dev/sda', '/dev/sdb']), total=2, stream=stream)
+    progress.render()
+    assert len(stream.getvalue().splitlines()) == 2
+    progress.render()
+    assert len(stream.getvalue().splitlines()) == 2
+    progress.update(('sdb', 'stage', 'users', 'running'))
+    progress.render()
+    lines = stream.getvalue().splitlines()
+    assert len(lines) == 3
+    assert lines[-1].startswith('sdb') and lines[-1].endswith('users')
+
+
+def test_terminal_output_redraws_in_place():
+    stream = Terminal()
+    progress = FleetProgress(parse_targets(['/dev/sda', '/dev/sdb']), total=2, stream=stream)
+    progress.render()
+    assert '\033[1A' not in stream.getvalue()
+    progress.render()
+    # Moves up over both lines it drew before drawing them again.
+    assert stream.getvalue().count('\033[1A\033[2K') == 2
+
+
+def test_summary_lines():
+    progress = FleetProgress(parse_targets(['/dev/sda', '/dev/sdb', '/dev/sdc']), total=1, stream=io.StringIO())
+    progress.update(('sda', 'done', '', 300 * 1024 ** 2))
+    progress.update(('sdb', 'failed', 'pacstrap failed', 100 * 1024 ** 2))
+    assert progress.summary_lines() == [
+        '1/3 targets installed, 400 MiB downloaded from mirrors for all of them',
+        'sdb: pacstrap failed',
+        'sdc: waiting',
+    ]
+
+
+@needs_loop_devices
+def test_fleet_loop_targets_are_sparse_and_detached(tmp_path, loop_targets, log):
+    targets = loop_targets(2)
+    assert len({target.device for target in targets}) == 2
+    for target in targets:
+        assert isinstance(target, FleetTarget)
+        assert stat.S_ISBLK(os.stat(target.device).st_mode)
+        assert target.name == os.path.basename(target.device)
+        assert target.mount_point == tmp_path / 'mnt' / target.name
+        assert target.image.stat().st_size == LOOP_SIZE
+        # Sparse: nothing but the file's metadata is allocated yet.
+        assert target.image.stat().st_blocks * 512 < LOOP_SIZE // 16
+        assert target.device in backing_devices(target.image)
+
+    detach_loop_targets(targets, log)
+    for target in targets:
+        assert backing_devices(target.image) == ''
+
+
+@needs_loop_devices
+@pytest.mark.skipif(
+    any(shutil.which(tool) is None for tool in ('sgdisk', 'wipefs', 'partprobe', 'udevadm', 'mkfs.fat', 'mkfs.ext4')),
+    reason='needs the partitioning and mkfs tools'
+)
+def test_fleet_loop_target_is_partitioned_and_mounted(loop_targets, log):
+    target, = loop_targets(1)
+    prepare_target(target, log)
+    assert os.path.ismount(target.mount_point)
+    assert os.path.ismount(target.mount_point / 'boot')
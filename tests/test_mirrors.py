@@ -0,0 +1,123 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from SENDUNE_installer.custom_classes import LogFile
+from SENDUNE_installer.mirrors import PROBE_FILE, probe_mirrors, rank_mirrors
+
+PROBE_LIMIT = 128 * 1024
+BODY = bytes(range(256)) * 1024
+
+
+class Mirror(BaseHTTPRequestHandler):
+    """A mirror on localhost that answers after `delay` and sends its body in `chunk`-sized, `pause`-spaced writes."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        self.server.requests.append(self.path)
+        time.sleep(self.server.delay)
+        if self.server.status != 200 or not self.path.endswith(PROBE_FILE):
+            self.send_error(self.server.status if self.server.status != 200 else 404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(BODY)))
+        self.end_headers()
+        try:
+            for offset in range(0, len(BODY), self.server.chunk):
+                self.wfile.write(BODY[offset:offset + self.server.chunk])
+                self.wfile.flush()
+                time.sleep(self.server.pause)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+@pytest.fixture
+def mirrors():
+    started = []
+
+    def start(delay=0.0, chunk=len(BODY), pause=0.0, status=200):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Mirror)
+        server.daemon_threads = True
+        server.requests = []
+        server.delay, server.chunk, server.pause, server.status = delay, chunk, pause, status
+        threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True).start()
+        started.append(server)
+        return server, f"http://127.0.0.1:{server.server_port}/$repo/os/$arch"
+
+    yield start
+    for server in started:
+        server.shutdown()
+        server.server_close()
+
+
+def test_ranking_order(mirrors):
+    _, fast = mirrors()
+    _, late = mirrors(delay=0.3)
+    _, throttled = mirrors(chunk=16 * 1024, pause=0.05)
+    _, missing = mirrors(status=404)
+    ranking = probe_mirrors([missing, throttled, late, fast], budget=10, limit=PROBE_LIMIT)
+
+    assert [probe.server for probe in ranking] == [fast, late, throttled, missing]
+    assert ranking[1].ttfb >= 0.3
+    # About 16 KiB per 50 ms, far below the other two.
+    assert ranking[2].throughput < 1024 * 1024 < ranking[0].throughput
+    assert not ranking[3].ok
+    assert ranking[3].error == 'HTTP 404'
+
+
+def test_budget_and_probe_timeout_cut_slow_mirrors(mirrors):
+    _, fast = mirrors()
+    _, hanging = mirrors(delay=3)
+    _, trickling = mirrors(chunk=1024, pause=0.2)
+
+    started = time.monotonic()
+    ranking = probe_mirrors([hanging, trickling, fast], budget=1.0, timeout=0.5, limit=PROBE_LIMIT)
+    assert time.monotonic() - started < 2
+
+    by_server = {probe.server: probe for probe in ranking}
+    assert ranking[0].server == fast
+    assert by_server[hanging].error == 'timed out'
+    assert by_server[trickling].error == 'timed out'
+
+    ranking = probe_mirrors([hanging, fast], budget=0.5, timeout=5, limit=PROBE_LIMIT)
+    assert [probe.server for probe in ranking] == [fast, hanging]
+    assert ranking[1].error == 'not probed within the time budget'
+
+
+def test_ranking_is_cached_for_its_ttl(mirrors, tmp_path):
+    first_server, first = mirrors()
+    second_server, second = mirrors(delay=0.1)
+    cache_file = tmp_path / 'mirror-ranking.json'
+    log = LogFile(tmp_path / 'mirrors.log')
+
+    ranking = rank_mirrors(log, [first, second], cache_file=cache_file)
+    assert [probe.server for probe in ranking] == [first, second]
+    assert len(first_server.requests) == len(second_server.requests) == 1
+
+    # Same candidates in another order: answered from the cache without probing.
+    cached = rank_mirrors(log, [second, first], cache_file=cache_file)
+    assert cached == ranking
+    assert len(first_server.requests) == 1
+
+    # Expired, or made for other candidates: probed again.
+    rank_mirrors(log, [first, second], cache_file=cache_file, ttl=-1)
+    assert len(first_server.requests) == 2
+    rank_mirrors(log, [first], cache_file=cache_file)
+    assert len(first_server.requests) == 3
+    log.close()
+
+
+def test_unreachable_ranking_is_not_cached(mirrors, tmp_path):
+    _, missing = mirrors(status=404)
+    cache_file = tmp_path / 'mirror-ranking.json'
+    log = LogFile(tmp_path / 'mirrors.log')
+    ranking = rank_mirrors(log, [missing], cache_file=cache_file)
+    assert [probe.ok for probe in ranking] == [False]
+    assert not cache_file.exists()
+    log.close()
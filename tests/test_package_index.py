@@ -0,0 +1,172 @@
+import io
+import os
+import tarfile
+
+from conftest import package
+
+from SENDUNE_installer import package_index
+from SENDUNE_installer.package_index import (
+    PackageIndex,
+    db_fingerprint,
+    load_package_index,
+    parse_desc,
+    read_sync_db,
+    strip_version,
+    sync_db_paths,
+)
+
+
+def test_parse_desc_reads_list_fields():
+    fields = parse_desc("%NAME%\nbash\n\n%DEPENDS%\nglibc\nreadline>=8.0\n\n%CSIZE%\n123\n")
+    assert fields == {'NAME': ['bash'], 'DEPENDS': ['glibc', 'readline>=8.0'], 'CSIZE': ['123']}
+
+
+def test_strip_version():
+    assert [strip_version(spec) for spec in ('sh=5.2', 'glibc>=2.38', 'python<3.13', 'bash')] == [
+        'sh', 'glibc', 'python', 'bash',
+    ]
+
+
+def test_read_sync_db(sync_db):
+    path = sync_db('core', [
+        package('bash', '5.2-1', csize=1500, isize=9000, depends=['glibc', 'readline>=8.0'], provides=['sh']),
+        package('glibc', '2.40-1'),
+    ])
+    entries = {entry.name: entry for entry in read_sync_db(path)}
+    assert set(entries) == {'bash', 'glibc'}
+    bash = entries['bash']
+    assert (bash.repo, bash.version, bash.csize, bash.isize) == ('core', '5.2-1', 1500, 9000)
+    assert bash.filename == 'bash-5.2-1-x86_64.pkg.tar.zst'
+    assert bash.depends == ['glibc', 'readline>=8.0']
+    assert bash.provides == ['sh']
+
+
+def test_read_sync_db_merges_old_style_depends_file(tmp_path):
+    path = tmp_path / 'old.db'
+    with tarfile.open(path, 'w:gz') as archive:
+        for name, text in (('desc', "%NAME%\nzsh\n\n%VERSION%\n5.9-1\n"), ('depends', "%DEPENDS%\npcre\n")):
+            data = text.encode()
+            member = tarfile.TarInfo(f"zsh-5.9-1/{name}")
+            member.size = len(data)
+            archive.addfile(member, io.BytesIO(data))
+    [entry] = read_sync_db(path)
+    assert (entry.name, entry.version, entry.depends) == ('zsh', '5.9-1', ['pcre'])
+
+
+def test_sync_db_paths_follow_pacman_conf_with_offline_repo_first(tmp_path, sync_db):
+    sync_dir = tmp_path / 'sync'
+    sync_dir.mkdir()
+    for repo in ('core', 'extra', 'unlisted'):
+        sync_db(repo, [], sync_dir)
+    conf = tmp_path / 'pacman.conf'
+    conf.write_text("[options]\nArchitecture = auto\n[extra]\nInclude = x\n[core]\nInclude = x\n")
+    offline = sync_db('sendune-offline', [])
+    paths = sync_db_paths(sync_dir, conf, offline)
+    assert [path.name for path in paths] == ['sendune-offline.db', 'extra.db', 'core.db', 'unlisted.db']
+    assert sync_db_paths(sync_dir, conf, tmp_path / 'missing.db')[0].name == 'extra.db'
+
+
+def test_first_repo_wins_on_duplicates(tmp_path, sync_db):
+    testing = sync_db('testing', [package('linux', '6.10-1')])
+    core = sync_db('core', [package('linux', '6.9-1'), package('bash')])
+    index = PackageIndex.from_sync_dbs([testing, core])
+    assert index.get('linux').version == '6.10-1'
+    assert index.is_available('bash') and 'bash' in index
+    assert not index.is_available('zsh')
+    assert len(index) == 2
+
+
+def test_unreadable_database_is_skipped(tmp_path, sync_db):
+    broken = tmp_path / 'broken.db'
+    broken.write_bytes(b'not a tarball')
+    index = PackageIndex.from_sync_dbs([broken, sync_db('core', [package('bash')])])
+    assert index.packages.keys() == {'bash'}
+
+
+def test_shared_index_is_not_kept_while_empty(monkeypatch, tmp_path, sync_db):
+    monkeypatch.setattr(package_index, '_package_index', None)
+    load = package_index.load_package_index
+    monkeypatch.setattr(package_index, 'load_package_index', lambda log: load(log, tmp_path / 'index.sqlite'))
+    paths = []
+    monkeypatch.setattr(package_index, 'sync_db_paths', lambda: list(paths))
+    assert len(package_index.get_package_index()) == 0
+
+    paths.append(sync_db('core', [package('bash')]))
+    index = package_index.get_package_index()
+    assert index.is_available('bash')
+    assert package_index.get_package_index() is index
+
+
+def test_cache_round_trip(tmp_path, sync_db):
+    db = sync_db('core', [package('bash', depends=['glibc'], provides=['sh'], groups=['base']), package('glibc')])
+    index = PackageIndex.from_sync_dbs([db])
+    cache_file = tmp_path / 'index.sqlite'
+    fingerprint = db_fingerprint([db])
+    index.save_cache(cache_file, fingerprint)
+
+    cached = PackageIndex.from_cache(cache_file, fingerprint)
+    assert cached.packages == index.packages
+    assert cached.providers('sh') == ['bash']
+    assert cached.group_members('base') == ['bash']
+    assert PackageIndex.from_cache(tmp_path / 'missing.sqlite', fingerprint) is None
+
+
+def rewrite(path, data: bytes, mtime_ns: int) -> None:
+    path.write_bytes(data)
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+def test_fingerprint_changes_with_mtime_size_and_hash(sync_db):
+    db = sync_db('core', [package('bash')])
+    data, mtime_ns = db.read_bytes(), db.stat().st_mtime_ns
+    original = db_fingerprint([db])
+
+    rewrite(db, data, mtime_ns + 10 ** 9)
+    assert db_fingerprint([db]) != original
+
+    rewrite(db, data + b'\0', mtime_ns)
+    assert db_fingerprint([db]) != original
+
+    # Same size and mtime, different bytes: only the hash tells them apart.
+    rewrite(db, bytes([data[0] ^ 1]) + data[1:], mtime_ns)
+    assert db_fingerprint([db]) != original
+
+    rewrite(db, data, mtime_ns)
+    assert db_fingerprint([db]) == original
+
+
+def test_load_package_index_uses_the_cache_until_the_db_changes(monkeypatch, tmp_path, sync_db):
+    db = sync_db('core', [package('bash', '5.2-1')])
+    monkeypatch.setattr(package_index, 'sync_db_paths', lambda: [db])
+    cache_file = tmp_path / 'index.sqlite'
+    parsed = []
+    from_sync_dbs = PackageIndex.from_sync_dbs.__func__
+    monkeypatch.setattr(
+        PackageIndex, 'from_sync_dbs',
+        classmethod(lambda cls, db_paths=None, log=None: parsed.append(db_paths) or from_sync_dbs(cls, db_paths, log)),
+    )
+
+    assert load_package_index(cache_file=cache_file).get('bash').version == '5.2-1'
+    assert cache_file.exists() and len(parsed) == 1
+    assert load_package_index(cache_file=cache_file).get('bash').version == '5.2-1'
+    assert len(parsed) == 1
+
+    mtime_ns = db.stat().st_mtime_ns
+    sync_db('core', [package('bash', '5.3-1')])
+    os.utime(db, ns=(mtime_ns + 10 ** 9, mtime_ns + 10 ** 9))
+    assert load_package_index(cache_file=cache_file).get('bash').version == '5.3-1'
+    assert len(parsed) == 2
+    assert PackageIndex.from_cache(cache_file, db_fingerprint([db])).get('bash').version == '5.3-1'
+
+
+def test_empty_index_is_not_cached(monkeypatch, tmp_path):
+    monkeypatch.setattr(package_index, 'sync_db_paths', list)
+    cache_file = tmp_path / 'index.sqlite'
+    assert len(load_package_index(cache_file=cache_file)) == 0
+    assert not cache_file.exists()
+
+
+def test_corrupt_cache_is_ignored(tmp_path, sync_db):
+    cache_file = tmp_path / 'index.sqlite'
+    cache_file.write_bytes(b'garbage' * 100)
+    assert PackageIndex.from_cache(cache_file, db_fingerprint([sync_db('core', [package('bash')])])) is None
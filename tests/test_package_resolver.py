@@ -0,0 +1,63 @@
+from conftest import package
+
+from SENDUNE_installer.package_index import PackageIndex
+from SENDUNE_installer.package_resolver import (
+    EXACT,
+    GROUP,
+    PROVIDED,
+    REPLACED,
+    UNRESOLVED,
+    resolve_package_name,
+    resolve_package_names,
+)
+
+
+def index_of(*dbs) -> PackageIndex:
+    return PackageIndex.from_sync_dbs(list(dbs))
+
+
+def test_resolution_order(sync_db):
+    index = index_of(
+        sync_db('core', [
+            package('pipewire-pulse', provides=['pulseaudio'], groups=['audio']),
+            package('pulseaudio-new', replaces=['pulseaudio-old']),
+            package('jack2', provides=['jack'], groups=['audio']),
+            package('pipewire-jack', provides=['jack=1.0']),
+        ]),
+    )
+    assert resolve_package_name('jack2', index).method == EXACT
+    assert resolve_package_name('jack2>=1.9', index).packages == ['jack2']
+
+    renamed = resolve_package_name('pulseaudio-old', index)
+    assert (renamed.method, renamed.packages) == (REPLACED, ['pulseaudio-new'])
+
+    virtual = resolve_package_name('jack', index)
+    assert (virtual.method, virtual.packages, virtual.alternatives) == (PROVIDED, ['jack2'], ['pipewire-jack'])
+
+    group = resolve_package_name('audio', index)
+    assert (group.method, group.packages) == (GROUP, ['pipewire-pulse', 'jack2'])
+
+    assert resolve_package_name('nonexistent', index).method == UNRESOLVED
+    assert resolve_package_name('  ', index).method == UNRESOLVED
+
+
+def test_replaces_wins_over_provides(sync_db):
+    index = index_of(sync_db('extra', [package('new-name', replaces=['old']), package('other', provides=['old'])]))
+    assert resolve_package_name('old', index).packages == ['new-name']
+
+
+def test_provider_from_the_first_repo_is_preferred(sync_db):
+    index = index_of(sync_db('core', [package('a-sh', provides=['sh'])]), sync_db('extra', [package('b-sh', provides=['sh'])]))
+    assert resolve_package_name('sh', index).packages == ['a-sh']
+
+
+def test_report_deduplicates_and_lists_substitutions(sync_db):
+    index = index_of(sync_db('core', [package('bash', provides=['sh']), package('glibc')]))
+    report = resolve_package_names(['sh', 'bash', 'glibc', 'sh', '', 'missing'], index)
+    assert report.packages == ['bash', 'glibc']
+    assert report.unresolved == ['missing']
+    assert [resolution.requested for resolution in report.substituted] == ['sh']
+    assert report.format_lines() == [
+        "'sh' -> bash (provided)",
+        "Not found in any sync repository: 'missing'",
+    ]
@@ -0,0 +1,97 @@
+import os
+
+import pytest
+
+from SENDUNE_installer.systemd_units import enable_units, expand_specifiers, parse_install_section, split_instance
+
+
+def unit(root, directory, name, install):
+    path = root / directory / name
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(f"[Unit]\nDescription={name}\n\n[Service]\nExecStart=/bin/true\n\n[Install]\n{install}\n")
+    return f"/{directory}/{name}"
+
+
+def links(root, config_dir='etc/systemd/system'):
+    base = root / config_dir
+    return {
+        str(path.relative_to(base)): os.readlink(path)
+        for path in base.rglob('*') if path.is_symlink()
+    } if base.exists() else {}
+
+
+@pytest.mark.parametrize(('name', 'expected'), [
+    ('getty@tty1.service', ('getty@.service', 'tty1')),
+    ('getty@.service', ('getty@.service', None)),
+    ('sshd.service', ('sshd.service', None)),
+])
+def test_split_instance(name, expected):
+    assert split_instance(name) == expected
+
+
+def test_install_section_continuations_and_resets():
+    install = parse_install_section(
+        "[Service]\nWantedBy=ignored.target\n[Install]\nWantedBy=a.target \\\n  b.target\n"
+        "RequiredBy=x.target\nRequiredBy=\nAlias=%p-alias.service\n"
+    )
+    assert install['WantedBy'] == ['a.target', 'b.target']
+    assert install['RequiredBy'] == []
+    assert expand_specifiers(install['Alias'][0], 'getty@tty1.service') == 'getty-alias.service'
+
+
+def test_wanted_by_required_by_and_alias(tmp_path):
+    path = unit(tmp_path, 'usr/lib/systemd/system', 'sshd.service',
+                "WantedBy=multi-user.target\nRequiredBy=network-online.target\nAlias=ssh.service")
+    report = enable_units(tmp_path, ['sshd'])
+    assert links(tmp_path) == {
+        'multi-user.target.wants/sshd.service': path,
+        'network-online.target.requires/sshd.service': path,
+        'ssh.service': path,
+    }
+    assert report.enabled == {'sshd.service': [
+        'multi-user.target.wants/sshd.service', 'network-online.target.requires/sshd.service', 'ssh.service',
+    ]}
+
+
+def test_also_enables_the_named_units(tmp_path):
+    unit(tmp_path, 'usr/lib/systemd/system', 'cups.service', "WantedBy=multi-user.target\nAlso=cups.socket")
+    socket = unit(tmp_path, 'usr/lib/systemd/system', 'cups.socket', "WantedBy=sockets.target")
+    report = enable_units(tmp_path, ['cups.service'])
+    assert links(tmp_path)['sockets.target.wants/cups.socket'] == socket
+    assert set(report.enabled) == {'cups.service', 'cups.socket'}
+
+
+def test_default_instance_of_a_template(tmp_path):
+    template = unit(tmp_path, 'usr/lib/systemd/system', 'getty@.service',
+                    "WantedBy=getty.target\nDefaultInstance=tty1")
+    unit(tmp_path, 'usr/lib/systemd/system', 'serial@.service', "WantedBy=getty.target")
+    report = enable_units(tmp_path, ['getty@.service', 'serial@.service', 'getty@tty2.service'])
+    assert links(tmp_path) == {
+        'getty.target.wants/getty@tty1.service': template,
+        'getty.target.wants/getty@tty2.service': template,
+    }
+    assert report.static == ['serial@.service']
+
+
+def test_user_units_are_enabled_globally(tmp_path):
+    socket = unit(tmp_path, 'usr/lib/systemd/user', 'pipewire.socket', "WantedBy=sockets.target")
+    report = enable_units(tmp_path, ['pipewire.socket'])
+    assert links(tmp_path, 'etc/systemd/user') == {'sockets.target.wants/pipewire.socket': socket}
+    assert links(tmp_path) == {}
+    assert report.user == ['pipewire.socket']
+
+
+def test_masked_missing_static_and_repeated(tmp_path):
+    unit(tmp_path, 'usr/lib/systemd/system', 'fstrim.timer', "WantedBy=timers.target")
+    unit(tmp_path, 'usr/lib/systemd/system', 'masked.service', "WantedBy=multi-user.target")
+    (tmp_path / 'etc/systemd/system').mkdir(parents=True)
+    os.symlink('/dev/null', tmp_path / 'etc/systemd/system/masked.service')
+    static = tmp_path / 'usr/lib/systemd/system/static.service'
+    static.write_text("[Service]\nExecStart=/bin/true\n")
+
+    enable_units(tmp_path, ['fstrim.timer'])
+    report = enable_units(tmp_path, ['fstrim.timer', 'masked', 'static', 'nothere'])
+    assert report.enabled == {'fstrim.timer': []}
+    assert report.masked == ['masked.service']
+    assert report.static == ['static.service']
+    assert report.missing == ['nothere.service']